@@ -0,0 +1,202 @@
+from discovery_functions.target_set import parse_scope
+from discovery_functions.pipeline import run_pipeline
+from discovery_functions.concurrency import AdaptiveLimiter
+from discovery_functions.icmp_sweep import ICMPSweeper
+from discovery_functions.ssh_pool import SSHPool
+from discovery_functions.credentials import CredentialStrategy
+from discovery_functions.tracing import Tracer
+from discovery_functions.retry import RetryEngine
+from discovery_functions.ubnt_discovery import UBNTDiscovery
+from discovery_functions.snmp_screen import SNMPScreen
+from cleanup_functions.liveness_monitor import LivenessMonitor
+from cleanup_functions.restart_scheduler import RestartScheduler
+from device_cleanup import _run_ssh_commands, _restart_device, _resolve_restarts
+from collections import namedtuple
+import asyncio, re
+
+
+# discovery and cleanup for other programs to call from their own event loop. nothing here
+# prints, exits or opens files: results come back as records from async iterators and bad
+# input raises ValueError. a Session keeps the SSH pool, credentials and concurrency limits
+# warm between jobs, so many jobs can run in one process, one after the other or at once.
+#
+#   async with Session(inventory=DeviceInventory()) as session:
+#       radios = [x.device async for x in session.discover(['10.0.0.0/24']) if x.category == 'radio']
+#       async for result in session.cleanup(radios, dry_run=True):
+#           ...
+
+# category is 'radio', 'airfiber', 'maybe_switch' (logged in, but not a radio) or 'failed'
+# (no SSH login). device is the record cleanup() takes, None for anything but radios. reason
+# says why a failed host failed, e.g. 'invalid credentials' or 'connection reset by peer'
+discovered_host = namedtuple('discovered_host', ('ip', 'category', 'device', 'reason'), defaults=(None,) )
+
+# what cleanup() fixes on each radio, all of it unless told otherwise
+cleanup_flags = namedtuple('cleanup_flags', ('wds', 'snmp', 'ntp', 'traffic_shaper', 'timezone',
+                                                'ff_reporting_mode'), defaults=(True,) * 6)
+
+# the most operations in flight in each stage, shared by every job of a session. the AIMD
+# limits start below these and only grow up to them while the network keeps up
+concurrency = namedtuple('concurrency', ('port', 'ssh', 'configure', 'ping_rate'),
+                            defaults=(1024, 512, 512, 2000) )
+
+_NTP_SERVER = re.compile(r"[0-3]\.ubnt\.pool\.ntp\.org")
+
+# put on a job's queue once it has finished
+_DONE = object()
+
+
+def _quiet(*args, **kwargs):
+    pass
+
+
+def _limiters(limits):
+    return {
+        'port': AdaptiveLimiter('port 22', initial=min(128, limits.port), max_limit=limits.port,
+                                    group_initial=32, group_max=256),
+        'ssh': AdaptiveLimiter('ssh', initial=min(64, limits.ssh), max_limit=limits.ssh,
+                                    group_initial=16, group_max=64),
+        'configure': AdaptiveLimiter('configure', initial=min(64, limits.configure), max_limit=limits.configure,
+                                    group_initial=16, group_max=64),
+    }
+
+
+def _check_scopes(scopes):
+    # the CLI skips bad scopes with a message, a caller gets told straight away
+    if isinstance(scopes, str):
+        raise ValueError(f"expected a list of scopes, got {scopes!r}")
+    for scope in scopes:
+        parse_scope(scope.strip())
+
+
+async def _stream(job, queue):
+    # runs `job`, a coroutine that puts records on `queue`, and yields them as they come.
+    # the job's exception is raised once its records are used up, leaving early cancels it
+    task = asyncio.ensure_future(job)
+    task.add_done_callback(lambda _: queue.put_nowait(_DONE))
+
+    try:
+        while (record := await queue.get()) is not _DONE:
+            yield record
+        task.result()
+
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+
+class Session:
+    # the state jobs share. inventory is an optional DeviceInventory, used for known devices
+    # and the credentials they took; it is the caller's to close. tracer gets every span,
+    # by default they are only counted on the pool. with udp_discovery hosts are asked for
+    # their UDP 10001 discovery reply before anything is tried over SSH, with snmp_screen airFiber
+    # and switches are sorted out by SNMP and only radios and unknown hosts are logged in to
+
+    def __init__(self, inventory=None, limits=concurrency(), tracer=None, udp_discovery=False, snmp_screen=False):
+        self.inventory = inventory
+        self.limits = limits
+        self.pool = SSHPool(tracer=tracer or Tracer(keep_durations=False))
+        self.credentials = CredentialStrategy()
+        self.limiters = _limiters(limits)
+        # circuit breakers stay open between jobs, a later job on a dead tower skips it too
+        self.retry = RetryEngine()
+        self.udp = UBNTDiscovery() if udp_discovery else None
+        self.snmp = SNMPScreen() if snmp_screen else None
+
+        if inventory:
+            self.credentials.learn_from_inventory(inventory)
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+    def discover(self, targets, exclude=()):
+        # async iterator of discovered_host for every host in `targets` (scopes in any form the
+        # CLI takes) that answers ping and has port 22 open, as each one is identified. radios
+        # keep their SSH session in the pool for a cleanup() that follows
+        _check_scopes(targets)
+        _check_scopes(exclude)
+        found = asyncio.Queue()
+
+        def on_identify(category, item, reason=None, source=None):
+            if category == 'succeeded':
+                found.put_nowait(discovered_host(item.ip, 'radio', item))
+            else:
+                found.put_nowait(discovered_host(item, category, None, reason))
+
+        sweeper = ICMPSweeper(rate=self.limits.ping_rate)
+        return _stream(run_pipeline(list(targets), False, self.pool, list(exclude), sweeper=sweeper,
+                                    inventory=self.inventory, credentials=self.credentials,
+                                    limiters=self.limiters, progress=_quiet, on_identify=on_identify,
+                                    retain=False, retry=self.retry, udp=self.udp, snmp=self.snmp,
+                                    echo=_quiet), found)
+
+
+    def cleanup(self, devices, flags=cleanup_flags(), dry_run=False, canary_size=5, canary_threshold=0.2):
+        # async iterator of cleanup_result(ip, status, detail) for every radio in `devices`
+        # (discovered_host.device records), as each one is finished. status is 'compliant',
+        # 'dry_run' (detail lists the changes), 'still_up' or 'went_down' after the restart
+        # (detail is the time to recovery), 'not_restarted' or 'exception'. changed radios are
+        # written, saved and restarted in canary-first waves, like the CLI does
+        if not any(flags):
+            raise ValueError('at least one cleanup flag has to be set')
+
+        finished = asyncio.Queue()
+        return _stream(self._cleanup(list(devices), tuple(flags), dry_run, canary_size, canary_threshold, finished),
+                        finished)
+
+
+    async def _cleanup(self, devices, flags, dry_run, canary_size, canary_threshold, finished):
+        pool, credentials, limiter, retry = self.pool, self.credentials, self.limiters['configure'], self.retry
+        # every job watches its own restarts, so a wave only waits for the job's own radios
+        monitor = LivenessMonitor(sweeper=ICMPSweeper(rate=self.limits.ping_rate, attempts=2, max_timeout=1.0))
+
+        async def restart_device(device):
+            return await _restart_device(device, pool, credentials, limiter, monitor, retry, flags, _NTP_SERVER)
+
+        scheduler = RestartScheduler(restart_device, monitor, canary_size, canary_threshold, echo=_quiet)
+
+        async def configure(device):
+            result = await _run_ssh_commands(device, _NTP_SERVER, flags, False, pool, credentials, dry_run, limiter,
+                                                retry)
+            if result.status == 'pending':
+                scheduler.add(device, result.detail)
+            else:
+                finished.put_nowait(result)
+
+        try:
+            await asyncio.gather(*(configure(x) for x in devices))
+            restart_statuses = await scheduler.run()
+            recoveries = await monitor.wait()
+        finally:
+            await monitor.close()
+
+        for x in _resolve_restarts(restart_statuses, recoveries):
+            finished.put_nowait(x)
+
+
+    async def close(self):
+        await self.pool.close()
+        for screen in (self.udp, self.snmp):
+            if screen:
+                screen.close()
+
+
+
+async def discover(targets, exclude=(), inventory=None, limits=concurrency()):
+    # discovery on its own, in a session of its own
+    async with Session(inventory, limits) as session:
+        async for host in session.discover(targets, exclude):
+            yield host
+
+
+async def cleanup(devices, flags=cleanup_flags(), dry_run=False, inventory=None, limits=concurrency()):
+    # cleanup on its own, in a session of its own
+    async with Session(inventory, limits) as session:
+        async for result in session.cleanup(devices, flags, dry_run):
+            yield result
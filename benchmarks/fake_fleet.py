@@ -0,0 +1,368 @@
+from discovery_functions.credentials import _credentials
+from discovery_functions.target_set import parse_scope, TargetSet
+from discovery_functions.ubnt_discovery import DISCOVERY_PORT, DISCOVERY_REQUEST
+from discovery_functions.snmp_screen import (SNMP_PORT, GET_BULK, RESPONSE, END_OF_MIB_VIEW, SYS_DESCR, SYS_OBJECT_ID,
+                                                SYS_NAME, UBNT_AIRFIBER, UBNT_AIRMAX, encode_message, parse_message)
+from cleanup_functions.system_config import SNMP_SETTINGS, parse_system_cfg
+from collections import namedtuple
+import asyncio, bisect, random, struct, time
+import asyncssh
+
+
+# airCubes answer discovery but have no SSH, they only show up with --udp-discovery
+fleet_mix = namedtuple('fleet_mix', ('altpass', 'airfiber', 'switch', 'airrouter', 'ap', 'legacy', 'aircube'),
+                        defaults=(0.0,) )
+
+DEFAULT_MIX = fleet_mix(altpass=0.1, airfiber=0.02, switch=0.03, airrouter=0.1, ap=0.1, legacy=0.3)
+
+# what a radio fresh out of the field looks like, nothing on it is compliant yet
+_BASE_CFG = """radio.1.ff_cap_rep=0
+radio.1.mode={mode}
+snmp.status=disabled
+snmp.location=Unknown
+system.timezone=GMT
+tshaper.status=enabled
+wireless.1.wds.status={wds}
+"""
+
+_LEGACY_FIRMWARE = 'XM.ar7240.v6.3.2.33267.200922.1147'
+_FIRMWARE = 'XC.qca955x.v8.7.4.45112.210415.1103'
+_AIRFIBER_FIRMWARE = 'AF5XHD.v4.1.0'
+_SWITCH_FIRMWARE = 'ES.bcm5334x.v1.9.3.5088155.200706.1524'
+_AIRCUBE_FIRMWARE = 'ACB-ISP.ar934x.v2.5.0.5029.200416.1536'
+
+# (sysDescr, sysObjectID) per kind. airOS reports the Frogfoot tree, only its UBNT MIB says airMAX
+_SNMP_SYSTEM = {
+    'radio': ('Linux 2.6.32.71 #1 Thu Apr 15 11:03:48 EEST 2021 mips', (1, 3, 6, 1, 4, 1, 10002, 1)),
+    'airfiber': ('Linux 3.14.79 #1 airFiber 5XHD', UBNT_AIRFIBER),
+    'switch': ('EdgeSwitch 24-Port Lite, 1.9.3.5088155, Linux 3.6.5-f4a26ed5, 1.0.0.4857129', (1, 3, 6, 1, 4, 1, 4413)),
+    'aircube': ('Linux 4.4.60 #1 airCube ISP', (1, 3, 6, 1, 4, 1, 41112)),
+}
+
+
+def _tlv(kind, value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack('!BH', kind, len(value)) + value
+
+
+class FakeRadio:
+
+    def __init__(self, ip, rng, mix, latency, jitter):
+        self.ip = ip
+        self.mac = 'fc:ec:da:%02x:%02x:%02x' % tuple(int(x) for x in ip.split('.')[1:])
+        # one round trip per exchange, drawn once per device so some towers are slow ones
+        self.rtt = latency * rng.lognormvariate(0, jitter)
+        self.altpass = rng.random() < mix.altpass
+        self.kind = 'radio'
+        self.is_airrouter = self.is_ap = self.is_legacy = False
+
+        roll = rng.random()
+        if roll < mix.airfiber:
+            self.kind = 'airfiber'
+        elif roll < mix.airfiber + mix.switch:
+            self.kind = 'switch'
+        elif roll < mix.airfiber + mix.switch + mix.aircube:
+            self.kind = 'aircube'
+        else:
+            self.is_airrouter = rng.random() < mix.airrouter
+            self.is_ap = not self.is_airrouter and rng.random() < mix.ap
+            self.is_legacy = rng.random() < mix.legacy
+
+        self.saved_cfg = _BASE_CFG.format(mode='master' if self.is_ap else 'managed',
+                                            wds='enabled' if self.is_airrouter else 'disabled')
+        self.running_cfg = self.saved_cfg
+        # /tmp/system.cfg.new, None when there is no such file
+        self.new_cfg = None
+        # set to drop the session halfway through the next writes to system.cfg.new
+        self.interrupt_writes = False
+        self.down_until = 0.0
+        self.restarts = 0
+
+
+    @property
+    def password(self):
+        return _credentials('alternate' if self.altpass else 'primary')[1]
+
+
+    @property
+    def is_down(self):
+        return time.monotonic() < self.down_until
+
+
+    @property
+    def identity(self):
+        # (name, firmware, platform) as mca-status and the discovery reply give them
+        if self.kind == 'airfiber':
+            return f"af-{self.ip}", _AIRFIBER_FIRMWARE, 'airFiber 5XHD'
+        if self.kind == 'switch':
+            return f"sw-{self.ip}", _SWITCH_FIRMWARE, 'EdgeSwitch 24 Lite'
+        if self.kind == 'aircube':
+            return f"acb-{self.ip}", _AIRCUBE_FIRMWARE, 'airCube ISP'
+
+        if self.is_airrouter:
+            platform, firmware = 'AirRouter', _LEGACY_FIRMWARE
+        elif self.is_legacy:
+            platform, firmware = 'Rocket M5', _LEGACY_FIRMWARE
+        else:
+            platform, firmware = 'Rocket 5AC Prism', _FIRMWARE
+        return f"r-{self.ip}", firmware, platform
+
+
+    def mca_status(self):
+        name, firmware, platform = self.identity
+        return f"deviceName={name},deviceId={self.mac},firmwareVersion={firmware},platform={platform},deviceIp={self.ip}\n"
+
+
+    @property
+    def snmp_community(self):
+        # radios only answer SNMP once their configuration turns it on, the rest of the gear
+        # is set up with the FWB community
+        if self.kind != 'radio':
+            return SNMP_SETTINGS['snmp.community']
+        cfg = parse_system_cfg(self.running_cfg)
+        return cfg.get('snmp.community') if cfg.get('snmp.status') == 'enabled' else None
+
+
+    def mib(self):
+        # the sorted (oid, value) pairs the SNMP agent walks
+        name, _, _ = self.identity
+        descr, object_id = _SNMP_SYSTEM[self.kind]
+        objects = [(SYS_DESCR + (0,), descr), (SYS_OBJECT_ID + (0,), object_id), (SYS_NAME + (0,), name)]
+        if self.kind == 'radio':
+            # ubntRadioMode and ubntRadioCCode of the radio table
+            objects += [(UBNT_AIRMAX + (1, 1, 2, 1), 2 if self.is_ap else 1), (UBNT_AIRMAX + (1, 1, 3, 1), 840)]
+        elif self.kind == 'airfiber':
+            objects += [(UBNT_AIRFIBER + (1, 1, 2, 1), 1)]
+        return sorted(objects)
+
+
+    def discovery_reply(self):
+        name, firmware, platform = self.identity
+        mac = bytes(int(x, 16) for x in self.mac.split(':'))
+        ip = bytes(int(x) for x in self.ip.split('.'))
+        tlvs = (_tlv(0x02, mac + ip) + _tlv(0x01, mac) + _tlv(0x03, firmware) + _tlv(0x0b, name)
+                    + _tlv(0x0c, platform.replace(' ', '-')) + _tlv(0x14, platform))
+        return struct.pack('!BBH', 1, 0, len(tlvs)) + tlvs
+
+
+
+class _RadioServer(asyncssh.SSHServer):
+
+    def __init__(self, fleet, radio):
+        self.fleet = fleet
+        self.radio = radio
+
+
+    def connection_made(self, conn):
+        self.conn = conn
+        # a rebooting radio still has an address on loopback, so refuse it at the SSH layer
+        if self.radio.is_down:
+            conn.close()
+        self.fleet.connections += 1
+
+
+    def begin_auth(self, username):
+        return True
+
+
+    def password_auth_supported(self):
+        return True
+
+
+    async def validate_password(self, username, password):
+        await self.fleet.delay(self.radio)
+        return password == self.radio.password
+
+
+
+class _DiscoveryResponder(asyncio.DatagramProtocol):
+    # answers discovery requests on UDP 10001 after the radio's round trip, lost like any exchange
+
+    def __init__(self, fleet, radio):
+        self.fleet = fleet
+        self.radio = radio
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, address):
+        if data == DISCOVERY_REQUEST and not self.radio.is_down:
+            asyncio.ensure_future(self._reply(address))
+
+
+    async def _reply(self, address):
+        await self.fleet.delay(self.radio)
+        if not self.transport.is_closing():
+            self.transport.sendto(self.radio.discovery_reply(), address)
+
+
+
+class _SNMPAgent(asyncio.DatagramProtocol):
+    # an SNMPv2c agent stand-in on UDP 161 that answers GetBulk from the device's MIB, after the
+    # radio's round trip. requests with the wrong community are dropped, as a real agent does
+
+    def __init__(self, fleet, radio):
+        self.fleet = fleet
+        self.radio = radio
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, address):
+        try:
+            community, pdu_type, request_id, non_repeaters, max_repetitions, varbinds = parse_message(data)
+        except ValueError:
+            return
+        if pdu_type == GET_BULK and community == self.radio.snmp_community and not self.radio.is_down:
+            asyncio.ensure_future(self._reply(address, request_id, non_repeaters, max_repetitions, varbinds))
+
+
+    async def _reply(self, address, request_id, non_repeaters, max_repetitions, varbinds):
+        mib = self.radio.mib()
+        oids = [oid for oid, _ in mib]
+
+        def get_next(oid):
+            i = bisect.bisect_right(oids, oid)
+            return mib[i] if i < len(mib) else (oid, END_OF_MIB_VIEW)
+
+        answer = [get_next(oid) for oid, _ in varbinds[:non_repeaters]]
+        # the repeaters are walked side by side, a row at a time
+        cursors = [oid for oid, _ in varbinds[non_repeaters:]]
+        for _ in range(max_repetitions):
+            row = [get_next(oid) for oid in cursors]
+            answer += row
+            if all(value is END_OF_MIB_VIEW for _, value in row):
+                break
+            cursors = [oid for oid, _ in row]
+
+        await self.fleet.delay(self.radio)
+        if not self.transport.is_closing():
+            self.transport.sendto(encode_message(self.radio.snmp_community, RESPONSE, request_id, 0, 0, answer), address)
+
+
+
+class FakeFleet:
+    # a fleet of emulated radios, one asyncssh listener on port 22 of every address in `network`
+    # (all of 127.0.0.0/8 routes to loopback on linux, binding port 22 needs root). the radios
+    # answer mca-status, read /tmp/system.cfg, write it through system.cfg.new and mv, save and
+    # restart. every device also answers the discovery protocol on UDP 10001, airCubes only that,
+    # and SNMP GetBulk on UDP 161 (radios once their configuration has SNMP turned on). the same
+    # seed always builds the same fleet, so numbers from two runs can be compared
+
+    def __init__(self, network='127.20.0.0/22', mix=DEFAULT_MIX, latency=0.02, jitter=0.5, loss=0.0,
+                    stall=10.0, reboot_time=5.0, seed=0):
+        self.network = network
+        self.loss = loss
+        self.stall = stall
+        self.reboot_time = reboot_time
+        self.connections = self.commands = self.stalls = 0
+
+        rng = random.Random(seed)
+        self._loss_rng = random.Random(seed + 1)
+        # .0 and .1 are skipped the same way the discovery skips them
+        self.radios = {ip: FakeRadio(ip, rng, mix, latency, jitter) for ip in TargetSet([parse_scope(network)])}
+        self._listeners = []
+        self._responders = []
+
+
+    def __len__(self):
+        return len(self.radios)
+
+
+    def count(self, kind):
+        return sum(x.kind == kind for x in self.radios.values())
+
+
+    async def delay(self, radio):
+        # a lost packet costs a retransmit timeout, long enough for the client to give up
+        self.commands += 1
+        if self._loss_rng.random() < self.loss:
+            self.stalls += 1
+            await asyncio.sleep(self.stall)
+        await asyncio.sleep(radio.rtt)
+
+
+    async def _handle(self, process):
+        radio = self.fleet_radio(process)
+        command = process.command or ''
+        await self.delay(radio)
+
+        if command.startswith('mca-status'):
+            # an EdgeSwitch CLI takes the login and answers anything it doesn't know like this
+            process.stdout.write('% Invalid input detected\n' if radio.kind == 'switch' else radio.mca_status())
+
+        elif command.startswith('cat /tmp/system.cfg'):
+            process.stdout.write(radio.running_cfg)
+
+        elif command.startswith('cat > /tmp/system.cfg.new'):
+            text = await process.stdin.read()
+            if radio.interrupt_writes:
+                # half the file made it before the session dropped, the mv never ran
+                radio.new_cfg = text[:len(text) // 2]
+                process.channel.get_connection().close()
+                return
+
+            radio.new_cfg = text
+            if '&& mv /tmp/system.cfg.new /tmp/system.cfg' in command:
+                radio.running_cfg, radio.new_cfg = radio.new_cfg, None
+
+        elif command == 'save':
+            radio.saved_cfg = radio.running_cfg
+
+        elif command == 'restart':
+            radio.restarts += 1
+            radio.running_cfg = radio.saved_cfg
+            radio.down_until = time.monotonic() + self.reboot_time
+            process.exit(0)
+            process.channel.get_connection().close()
+            return
+
+        process.exit(0)
+
+
+    def fleet_radio(self, process):
+        return self.radios[process.get_extra_info('sockname')[0]]
+
+
+    async def start(self):
+        host_key = asyncssh.generate_private_key('ssh-ed25519')
+        loop = asyncio.get_running_loop()
+
+        for ip, radio in self.radios.items():
+            responder, _ = await loop.create_datagram_endpoint(lambda radio=radio: _DiscoveryResponder(self, radio),
+                                                                local_addr=(ip, DISCOVERY_PORT), reuse_port=True)
+            self._responders.append(responder)
+            agent, _ = await loop.create_datagram_endpoint(lambda radio=radio: _SNMPAgent(self, radio),
+                                                            local_addr=(ip, SNMP_PORT), reuse_port=True)
+            self._responders.append(agent)
+            if radio.kind == 'aircube':
+                continue
+
+            self._listeners.append(await asyncssh.listen(
+                ip, 22, server_host_keys=[host_key], process_factory=self._handle,
+                server_factory=lambda radio=radio: _RadioServer(self, radio), reuse_address=True) )
+
+        return self
+
+
+    async def close(self):
+        for responder in self._responders:
+            responder.close()
+        self._responders = []
+        for listener in self._listeners:
+            listener.close()
+        await asyncio.gather(*(x.wait_closed() for x in self._listeners), return_exceptions=True)
+        self._listeners = []
+
+
+    async def __aenter__(self):
+        return await self.start()
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,196 @@
+from benchmarks.fake_fleet import FakeFleet, fleet_mix, DEFAULT_MIX
+from discovery_functions.find_alive_hosts import find_ssh_open
+from discovery_functions.check_radio_ssh import check_radio_ssh
+from discovery_functions.pipeline import run_pipeline, default_limiters
+from discovery_functions.icmp_sweep import ICMPSweeper
+from discovery_functions.ssh_pool import SSHPool
+from discovery_functions.credentials import CredentialStrategy
+from discovery_functions.ubnt_discovery import UBNTDiscovery
+from discovery_functions.snmp_screen import SNMPScreen
+from cleanup_functions.liveness_monitor import LivenessMonitor
+from device_cleanup import _run_ssh_commands, _restart_device
+from collections import namedtuple
+from contextlib import contextmanager
+import asyncio, importlib, json, re, resource, time
+import click
+
+
+stage_result = namedtuple('stage_result', ('stage', 'devices', 'seconds', 'devices_per_s', 'p50_ms', 'p99_ms') )
+
+_FLAGS = (True, True, True, True, True, True)
+
+
+def _percentile(samples, pct):
+    # nearest rank, so the number is always a latency that was actually measured
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def _stage_result(stage, devices, seconds, samples):
+    return stage_result(stage, devices, round(seconds, 3), round(devices / seconds, 1) if seconds else None,
+                            *(None if x is None else round(x * 1000, 1) for x in (_percentile(samples, 50),
+                                                                                    _percentile(samples, 99))) )
+
+
+def _timed(func, samples):
+    async def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            samples.append(time.monotonic() - start)
+    return wrapper
+
+
+@contextmanager
+def _time_calls(module_name, func_name, samples):
+    # the stage functions are benchmarked as they are, only the per-host call is wrapped to time it
+    module = importlib.import_module(module_name)
+    func = getattr(module, func_name)
+    setattr(module, func_name, _timed(func, samples))
+    try:
+        yield
+    finally:
+        setattr(module, func_name, func)
+
+
+async def _bench_port_22(fleet, sweeper):
+    samples = []
+    start = time.monotonic()
+    with _time_calls('discovery_functions.find_alive_hosts', '_check_ssh_open', samples):
+        ssh_open = await find_ssh_open([fleet.network], False, sweeper=sweeper)
+    return _stage_result('port 22', len(samples), time.monotonic() - start, samples), ssh_open
+
+
+async def _bench_identify(ssh_open):
+    samples = []
+    start = time.monotonic()
+    with _time_calls('discovery_functions.check_radio_ssh', '_radio_discovery', samples):
+        devices = await check_radio_ssh(ssh_open, False, credentials=CredentialStrategy())
+    return _stage_result('identify', len(samples), time.monotonic() - start, samples), devices
+
+
+async def _bench_udp_discovery(ssh_open):
+    # the same hosts as the identify stage, one datagram each instead of a login
+    udp, samples = UBNTDiscovery(), []
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(_timed(udp.query, samples)(ip) for ip in ssh_open))
+    finally:
+        udp.close()
+    return _stage_result('udp disc', len(samples), time.monotonic() - start, samples)
+
+
+async def _bench_snmp_screen(ssh_open):
+    # run after configure and restart, radios only answer SNMP once the cleanup has turned it on
+    snmp, samples = SNMPScreen(), []
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(_timed(snmp.query, samples)(ip) for ip in ssh_open))
+    finally:
+        snmp.close()
+    return _stage_result('snmp', len(samples), time.monotonic() - start, samples)
+
+
+async def _bench_configure(fleet, sweeper):
+    # the whole streaming pipeline, with the compliance check as the last stage. the changes are
+    # written and saved with each restart, which is run separately so the liveness waits don't
+    # end up in the devices/s number
+    ntp_server_validate = re.compile("[0-3]\.ubnt\.pool\.ntp\.org")
+    pool, credentials, limiters = SSHPool(), CredentialStrategy(), default_limiters()
+    samples = []
+
+    async def device_worker(device, limiter):
+        return await _timed(_run_ssh_commands, samples)(device, ntp_server_validate, _FLAGS, False, pool,
+                                                            credentials, False, limiter)
+
+    start = time.monotonic()
+    try:
+        summary = await run_pipeline([fleet.network], False, pool, device_worker=device_worker, sweeper=sweeper,
+                                        credentials=credentials, limiters=limiters)
+        seconds = time.monotonic() - start
+        pending_ips = {x.ip for x in summary.results if x.status == 'pending'}
+        pending = [x for x in summary.devices.devices() if x.ip in pending_ips]
+        restart = await _bench_restart(pending, pool, credentials, limiters['configure'], ntp_server_validate)
+    finally:
+        await pool.close()
+
+    return _stage_result('configure', len(samples), seconds, samples), restart
+
+
+async def _bench_restart(devices, pool, credentials, limiter, ntp_server_validate):
+    # loopback addresses answer ping while the radio "reboots", so only the restart itself is timed
+    monitor = LivenessMonitor(initial_delay=0)
+    samples = []
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(_timed(_restart_device, samples)(x, pool, credentials, limiter, monitor, None, _FLAGS,
+                                                                    ntp_server_validate) for x in devices))
+    finally:
+        await monitor.close()
+    return _stage_result('restart', len(samples), time.monotonic() - start, samples)
+
+
+async def run_benchmark(fleet, ping_rate=2000):
+    sweeper = ICMPSweeper(rate=ping_rate)
+
+    async with fleet:
+        port_22, ssh_open = await _bench_port_22(fleet, sweeper)
+        identify, _ = await _bench_identify(ssh_open)
+        udp_discovery = await _bench_udp_discovery(ssh_open)
+        configure, restart = await _bench_configure(fleet, sweeper)
+        # the restarted radios are still rebooting
+        await asyncio.sleep(fleet.reboot_time)
+        snmp_screen = await _bench_snmp_screen(ssh_open)
+
+    return [port_22, identify, udp_discovery, snmp_screen, configure, restart]
+
+
+def _echo_results(results):
+    click.echo(f"\n{'stage':<10} {'devices':>8} {'seconds':>9} {'devices/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for x in results:
+        click.echo(f"{x.stage:<10} {x.devices:>8} {x.seconds:>9} {x.devices_per_s!s:>10} {x.p50_ms!s:>8} {x.p99_ms!s:>8}")
+
+
+@click.command()
+@click.option('--network', default='127.20.0.0/22', show_default=True, help='Loopback scope the fake radios listen on.')
+@click.option('--latency', default=0.02, show_default=True, help='Median round trip per SSH exchange, in seconds.')
+@click.option('--jitter', default=0.5, show_default=True, help='Spread of the per-device round trip (lognormal sigma).')
+@click.option('--loss', type=click.FloatRange(0, 1), default=0.0, show_default=True,
+                help='Fraction of SSH exchanges that stall long enough to time out.')
+@click.option('--altpass', type=click.FloatRange(0, 1), default=DEFAULT_MIX.altpass, show_default=True)
+@click.option('--airfiber', type=click.FloatRange(0, 1), default=DEFAULT_MIX.airfiber, show_default=True)
+@click.option('--switch', type=click.FloatRange(0, 1), default=DEFAULT_MIX.switch, show_default=True)
+@click.option('--airrouter', type=click.FloatRange(0, 1), default=DEFAULT_MIX.airrouter, show_default=True)
+@click.option('--ap', type=click.FloatRange(0, 1), default=DEFAULT_MIX.ap, show_default=True)
+@click.option('--legacy', type=click.FloatRange(0, 1), default=DEFAULT_MIX.legacy, show_default=True)
+@click.option('--aircube', type=click.FloatRange(0, 1), default=DEFAULT_MIX.aircube, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--ping-rate', default=2000, show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Write the results to this file as JSON.')
+def main(network, latency, jitter, loss, altpass, airfiber, switch, airrouter, ap, legacy, aircube, seed, ping_rate,
+            output):
+    # every emulated radio holds a listening socket and a few sessions
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    mix = fleet_mix(altpass, airfiber, switch, airrouter, ap, legacy, aircube)
+    fleet = FakeFleet(network, mix, latency, jitter, loss, seed=seed)
+    click.echo(f"Starting {len(fleet)} fake devices on {network} "
+                f"({fleet.count('airfiber')} airFiber, {fleet.count('switch')} switches, "
+                f"{fleet.count('aircube')} airCubes)...")
+
+    results = asyncio.run(run_benchmark(fleet, ping_rate))
+    _echo_results(results)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'fleet': {'network': network, 'devices': len(fleet), 'latency': latency, 'jitter': jitter,
+                                    'loss': loss, 'mix': mix._asdict(), 'seed': seed},
+                        'stages': [x._asdict() for x in results]}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
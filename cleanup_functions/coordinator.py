@@ -0,0 +1,225 @@
+from hmac import compare_digest
+import asyncio, json, socket, time
+import click
+
+
+# one JSON object per line in both directions:
+#   worker -> coordinator: hello {name, token}, heartbeat, progress {counts}, result {result},
+#                          done {unit_id, payload}, error {unit_id, error}
+#   coordinator -> worker: unit {unit_id, scopes, options}, shutdown
+_LIMIT = 64 * 1024 * 1024
+
+
+def parse_address(address):
+    # 'unix:/path/to/socket' or 'host:port'
+    if address.startswith('unix:'):
+        return 'unix', address[5:]
+
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(address)
+    return 'tcp', host or '0.0.0.0', int(port)
+
+
+async def _send(writer, message_type, **fields):
+    writer.write(json.dumps({'type': message_type, **fields}).encode() + b'\n')
+    await writer.drain()
+
+
+async def _receive(reader, timeout=None):
+    # None once the other side has gone away
+    line = await asyncio.wait_for(reader.readline(), timeout)
+    if not line:
+        return None
+    return json.loads(line)
+
+
+async def _open_connection(address):
+    kind, *where = parse_address(address)
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(where[0], limit=_LIMIT)
+    return await asyncio.open_connection(*where, limit=_LIMIT)
+
+
+
+class Coordinator:
+    # hands work units (lists of scopes) to worker agents that connect to it, one unit at a
+    # time per worker. a unit whose worker disconnects, goes quiet for heartbeat_timeout
+    # seconds or reports an error is put back for another worker, up to max_attempts times.
+    # results are (ip, status, detail), each ip of a unit is passed to on_result once however
+    # often the unit is run, the first result wins
+
+    def __init__(self, units, options, token=None, heartbeat_timeout=90, max_attempts=3,
+                    on_progress=None, on_result=None):
+        self.units = list(units)
+        self.options = options
+        self.token = token
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.on_progress = on_progress
+        self.on_result = on_result
+
+        self.payloads = {}
+        self.failed = {}        # unit_id -> last error
+        self.reassigned = 0
+        self._attempts = {}
+        self._reported = {}     # unit_id -> ips passed to on_result, while the unit isn't done
+        self._pending = asyncio.Queue()
+        for unit_id in range(len(self.units)):
+            self._pending.put_nowait(unit_id)
+        self._changed = asyncio.Event()
+        self._progress = {}
+        self._last_report = time.monotonic()
+
+
+    @property
+    def remaining(self):
+        return len(self.units) - len(self.payloads) - len(self.failed)
+
+
+    async def _next_unit(self):
+        # waits while units are still out with other workers, they might come back
+        while True:
+            if not self._pending.empty():
+                return self._pending.get_nowait()
+            if not self.remaining:
+                return None
+            self._changed.clear()
+            await self._changed.wait()
+
+
+    def _finish(self, unit_id, payload=None, error=None):
+        if error is None:
+            self.payloads[unit_id] = payload
+            self._reported.pop(unit_id, None)
+
+        elif self._attempts[unit_id] < self.max_attempts:
+            self.reassigned += 1
+            click.echo(f"Work unit {unit_id} ({', '.join(self.units[unit_id][:3])}...) failed, reassigning it: {error}")
+            self._pending.put_nowait(unit_id)
+
+        else:
+            self.failed[unit_id] = error
+            self._reported.pop(unit_id, None)
+
+        self._changed.set()
+
+
+    def _report_progress(self, name, counts):
+        self._progress[name] = counts
+        if self.on_progress and time.monotonic() - self._last_report >= 5:
+            self.on_progress(self._progress)
+            self._last_report = time.monotonic()
+
+
+    def _report_result(self, name, unit_id, result):
+        # a reassigned unit runs its devices again, a device the first worker finished would
+        # come back a second time, e.g. 'compliant' after it was reported 'still_up'
+        reported = self._reported.setdefault(unit_id, set())
+        if result[0] in reported:
+            return
+        reported.add(result[0])
+        if self.on_result:
+            self.on_result(name, result)
+
+
+    async def _run_unit(self, name, unit_id, reader, writer):
+        self._attempts[unit_id] = self._attempts.get(unit_id, 0) + 1
+        await _send(writer, 'unit', unit_id=unit_id, scopes=self.units[unit_id], options=self.options)
+
+        while True:
+            message = await _receive(reader, self.heartbeat_timeout)
+            if message is None:
+                raise ConnectionError('worker disconnected')
+
+            if message['type'] == 'progress':
+                self._report_progress(name, message['counts'])
+
+            elif message['type'] == 'result':
+                self._report_result(name, unit_id, message['result'])
+
+            elif message['type'] == 'done':
+                return self._finish(unit_id, payload=message['payload'])
+
+            elif message['type'] == 'error':
+                return self._finish(unit_id, error=message['error'])
+
+
+    async def _handle_worker(self, reader, writer):
+        unit_id = None
+        try:
+            hello = await _receive(reader, self.heartbeat_timeout)
+            if not hello or hello.get('type') != 'hello' or (
+                    self.token and not compare_digest(str(hello.get('token')), self.token)):
+                return
+
+            name = hello.get('name') or str(writer.get_extra_info('peername'))
+            click.echo(f"Worker {name} connected.")
+
+            while (unit_id := await self._next_unit()) is not None:
+                await self._run_unit(name, unit_id, reader, writer)
+                unit_id = None
+
+            await _send(writer, 'shutdown')
+
+        # a message without the fields it should have counts as a broken worker too
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, KeyError,
+                    IndexError, TypeError) as e:
+            if unit_id is not None:
+                self._finish(unit_id, error=repr(e))
+
+        finally:
+            writer.close()
+
+
+    async def serve(self, address):
+        # returns {unit_id: payload} once every unit is done or has failed max_attempts times
+        kind, *where = parse_address(address)
+        if kind == 'unix':
+            server = await asyncio.start_unix_server(self._handle_worker, where[0], limit=_LIMIT)
+        else:
+            server = await asyncio.start_server(self._handle_worker, *where, limit=_LIMIT)
+
+        click.echo(f"Waiting for workers on {address} ({len(self.units)} work units)...")
+        try:
+            while self.remaining:
+                self._changed.clear()
+                await self._changed.wait()
+        finally:
+            server.close()
+
+        return self.payloads
+
+
+
+async def _heartbeat(writer, interval):
+    while True:
+        await asyncio.sleep(interval)
+        await _send(writer, 'heartbeat')
+
+
+async def run_agent(address, run_unit, name=None, token=None, heartbeat_interval=15):
+    # connects to a coordinator and runs the units it hands out until it says there are no more.
+    # run_unit(unit_id, scopes, options, report) returns the unit's payload, report(type, value)
+    # streams 'progress' counts and per device 'result's back while it works
+    reader, writer = await _open_connection(address)
+    await _send(writer, 'hello', name=name or socket.gethostname(), token=token)
+    heartbeat = asyncio.ensure_future(_heartbeat(writer, heartbeat_interval))
+
+    def report(message_type, value):
+        field = 'counts' if message_type == 'progress' else message_type
+        writer.write(json.dumps({'type': message_type, field: value}).encode() + b'\n')
+
+    try:
+        while (message := await _receive(reader)) is not None and message['type'] == 'unit':
+            unit_id = message['unit_id']
+            try:
+                payload = await run_unit(unit_id, message['scopes'], message['options'], report)
+            except Exception as e:
+                await _send(writer, 'error', unit_id=unit_id, error=repr(e))
+            else:
+                await _send(writer, 'done', unit_id=unit_id, payload=payload)
+
+    finally:
+        heartbeat.cancel()
+        writer.close()
@@ -0,0 +1,225 @@
+from api import cleanup_flags
+from collections import Counter
+from contextlib import aclosing
+from hmac import compare_digest
+import asyncio, itertools, json, os, time
+import click
+
+
+# a job is one JSON object, a line of its own on the Unix socket or the body of an HTTP POST:
+#   {"type": "discover", "targets": [...], "exclude": [...]}
+#   {"type": "cleanup", "targets": [...], "exclude": [...], "flags": {"wds": false, ...},
+#    "dry_run": false, "canary_size": 5, "canary_threshold": 0.2}
+#   {"type": "status"}
+# with "token" on the socket, or an "Authorization: Bearer <token>" header over HTTP, when the
+# daemon has one. the answer is JSON lines: a host {ip, category, reason} per identified host for
+# discovery, a result {ip, status, detail} per device for cleanup, then done {counts, seconds}
+# or error {error}
+_LIMIT = 1024 * 1024
+
+_HTTP_ROUTES = {('POST', '/discover'): 'discover', ('POST', '/cleanup'): 'cleanup', ('GET', '/status'): 'status'}
+_HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found'}
+
+
+def _encode(message):
+    # exceptions in result details go over as their repr
+    return json.dumps(message, default=repr).encode() + b'\n'
+
+
+def _error(error):
+    return {'type': 'error', 'error': error}
+
+
+
+class JobServer:
+    # runs discovery and cleanup jobs for local clients on one warm api.Session, so every job
+    # shares its SSH pool, inventory and concurrency limits. at most max_jobs run at once, the
+    # others wait their turn. a radio that another job is cleaning up is reported as busy
+
+    def __init__(self, session, max_jobs=8, token=None):
+        self.session = session
+        self.token = token
+
+        self.jobs = {}      # job id -> (type, targets, start time)
+        self._slots = asyncio.Semaphore(max_jobs)
+        self._busy = set()
+        self._ids = itertools.count(1)
+
+
+    def _authorized(self, token):
+        return not self.token or (token is not None and compare_digest(str(token), self.token))
+
+
+    def _status(self):
+        now = time.monotonic()
+        hits, misses, *_ = self.session.pool.stats
+        return {'type': 'status', 'pool': {'hits': hits, 'misses': misses},
+                'jobs': [{'id': job_id, 'type': kind, 'targets': targets, 'seconds': round(now - start, 1)}
+                            for job_id, (kind, targets, start) in self.jobs.items()]}
+
+
+    async def _discover(self, request):
+        async for host in self.session.discover(request['targets'], request.get('exclude', ())):
+            yield {'type': 'host', 'ip': host.ip, 'category': host.category, 'reason': host.reason}
+
+
+    async def _cleanup(self, request):
+        flags = cleanup_flags(**request.get('flags', {}))
+        if not any(flags):
+            raise ValueError('at least one cleanup flag has to be set')
+
+        radios = []
+        try:
+            async for host in self.session.discover(request['targets'], request.get('exclude', ())):
+                if host.category != 'radio':
+                    yield {'type': 'result', 'ip': host.ip, 'status': host.category, 'detail': None}
+
+                elif host.ip in self._busy:
+                    yield {'type': 'result', 'ip': host.ip, 'status': 'busy',
+                            'detail': 'Being cleaned up by another job'}
+
+                else:
+                    self._busy.add(host.ip)
+                    radios.append(host.device)
+
+            async for x in self.session.cleanup(radios, flags, request.get('dry_run', False),
+                                                request.get('canary_size', 5), request.get('canary_threshold', 0.2)):
+                yield {'type': 'result', 'ip': x.ip, 'status': x.status, 'detail': x.detail}
+
+        finally:
+            self._busy.difference_update(x.ip for x in radios)
+
+
+    async def run_job(self, request):
+        # async iterator of the messages that answer one job request
+        kind = request.get('type')
+        if kind == 'status':
+            yield self._status()
+            return
+
+        if kind not in ('discover', 'cleanup') or not isinstance(request.get('targets'), list):
+            yield _error("a job needs a type of 'discover', 'cleanup' or 'status' and a list of targets")
+            return
+
+        async with self._slots:
+            job_id, start, counts = next(self._ids), time.monotonic(), Counter()
+            self.jobs[job_id] = (kind, request['targets'], start)
+            jobs = self._discover(request) if kind == 'discover' else self._cleanup(request)
+
+            try:
+                async with aclosing(jobs):
+                    async for message in jobs:
+                        counts[message.get('status') or message['category']] += 1
+                        yield message
+
+            except (ValueError, TypeError) as e:
+                # bad scopes or cleanup options
+                yield _error(str(e))
+                return
+
+            finally:
+                del self.jobs[job_id]
+
+        seconds = round(time.monotonic() - start, 3)
+        click.echo(f"Job {job_id} ({kind} {' '.join(request['targets'])}) finished in {seconds} s: {dict(counts)}")
+        yield {'type': 'done', 'counts': counts, 'seconds': seconds}
+
+
+    async def _answer(self, request, writer):
+        async with aclosing(self.run_job(request)) as messages:
+            async for message in messages:
+                writer.write(_encode(message))
+                await writer.drain()
+
+
+    async def _handle_socket(self, reader, writer):
+        try:
+            try:
+                request = json.loads(await reader.readline())
+            except ValueError:
+                request = None
+
+            if not isinstance(request, dict):
+                writer.write(_encode(_error('a job is one JSON object on one line')))
+                return
+
+            if not self._authorized(request.get('token')):
+                writer.write(_encode(_error('wrong or missing token')))
+                return
+
+            await self._answer(request, writer)
+
+        except ConnectionError:
+            # the client went away, its job has been cancelled
+            pass
+
+        finally:
+            writer.close()
+
+
+    async def _handle_http(self, reader, writer):
+        try:
+            method, path, *_ = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while (line := (await reader.readline()).decode('latin-1').strip()):
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            def respond(status, content_type='application/json'):
+                writer.write(f"HTTP/1.1 {status} {_HTTP_REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                                f"Connection: close\r\n\r\n".encode('latin-1'))
+
+            kind = _HTTP_ROUTES.get( (method, path.split('?')[0]) )
+            if kind is None:
+                respond(404)
+                writer.write(_encode(_error(f"{method} {path} isn't a job, use POST /discover, POST /cleanup or GET /status")))
+                return
+
+            if not self._authorized(headers.get('authorization', '').removeprefix('Bearer ') or None):
+                respond(401)
+                writer.write(_encode(_error('wrong or missing token')))
+                return
+
+            try:
+                request = {**json.loads(body or b'{}'), 'type': kind}
+            except (ValueError, TypeError):
+                respond(400)
+                writer.write(_encode(_error('the body has to be a JSON object')))
+                return
+
+            # the job's messages are streamed as JSON lines until the connection closes
+            respond(200, 'application/x-ndjson')
+            await self._answer(request, writer)
+
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+
+        finally:
+            writer.close()
+
+
+    async def serve(self, socket_path=None, http_port=None):
+        # serves until cancelled. the HTTP listener is only ever bound to localhost
+        servers = []
+
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            servers.append(await asyncio.start_unix_server(self._handle_socket, socket_path, limit=_LIMIT))
+            # only this user can hand the daemon jobs
+            os.chmod(socket_path, 0o600)
+            click.echo(f"Taking jobs on unix:{socket_path}")
+
+        if http_port:
+            servers.append(await asyncio.start_server(self._handle_http, '127.0.0.1', http_port, limit=_LIMIT))
+            click.echo(f"Taking jobs on http://127.0.0.1:{http_port}")
+
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            if socket_path and os.path.exists(socket_path):
+                os.unlink(socket_path)
@@ -0,0 +1,104 @@
+from discovery_functions.check_radio_ssh import valid_radio_namedtuple
+from collections import namedtuple
+import json, os, time
+
+
+# what a resumed run still has to do, worked out from the last state of every device in the journal.
+# finished is (ip, status, detail) for devices that are done, configure/restart/verify are device
+# records for the ones that stopped before that step, restart holds (device, role) pairs
+resume_plan = namedtuple('resume_plan', ('options', 'discovery_complete', 'radios', 'finished', 'configure',
+                                            'restart', 'verify', 'non_radios', 'seen') )
+
+# last journal state -> final status, for devices that need nothing more
+# not_restarted radios were left untouched by an aborted canary wave, a resume configures them again
+_FINISHED = {'compliant', 'dry_run', 'restart_failed', 'verified'}
+
+
+class RunJournal:
+    # append-only record of every device's progress through a configure run, one JSON line
+    # per transition: discovered, not_radio, compliant, dry_run, exception, pending, restarted,
+    # restart_failed, not_restarted and verified. each line is flushed as it is written so an
+    # interrupted run can be picked up again with --resume
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', buffering=1)
+
+
+    def record(self, state, ip=None, **fields):
+        self._file.write(json.dumps({'t': round(time.time(), 3), 'state': state, 'ip': ip, **fields}, default=repr)
+                            + '\n')
+
+
+    def sync(self):
+        # lines are flushed as they are written, this also gets them past a power cut
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+    def close(self):
+        if self._file:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+
+def _read_entries(path):
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the line that was being written when the run died
+                continue
+
+
+def load_resume_plan(path):
+    options, discovery_complete = None, False
+    devices, last = {}, {}
+
+    for entry in _read_entries(path):
+        state, ip = entry['state'], entry.get('ip')
+
+        if state == 'run':
+            options = options or entry['options']
+        elif state == 'discovery_complete':
+            discovery_complete = True
+        elif ip:
+            if state == 'discovered':
+                devices[ip] = valid_radio_namedtuple(*entry['device'])
+            last[ip] = entry
+
+    if options is None:
+        raise ValueError(f"{path} is not a cleanup journal")
+
+    finished, configure, restart, verify, non_radios = [], [], [], [], {}
+
+    for ip, entry in last.items():
+        state = entry['state']
+
+        if state == 'not_radio':
+            non_radios.setdefault(entry['category'], []).append(ip)
+
+        elif state == 'verified':
+            finished.append( (ip, 'still_up' if entry['still_up'] else 'went_down', entry['time_to_recovery']) )
+
+        elif state == 'restart_failed':
+            finished.append( (ip, 'exception', 'Restart command timed out') )
+
+        elif state in _FINISHED:
+            finished.append( (ip, state, entry.get('detail')) )
+
+        elif state == 'pending':
+            restart.append( (devices[ip], entry['role']) )
+
+        elif state == 'restarted':
+            verify.append(devices[ip])
+
+        else:
+            # discovered, or failed last time, both get configured (again)
+            configure.append(devices[ip])
+
+    return resume_plan(options, discovery_complete, list(devices.values()), finished, configure, restart, verify,
+                        non_radios, set(last))
@@ -0,0 +1,94 @@
+from discovery_functions.icmp_sweep import ICMPSweeper
+from collections import namedtuple
+import asyncio, time
+
+
+recovery = namedtuple('recovery', ('ip', 'still_up', 'time_to_recovery') )
+
+
+class LivenessMonitor:
+    # one shared watcher for radios that were just restarted. every device that is due for a
+    # check is pinged in the same sweep; a device that doesn't answer is checked again after
+    # first_interval seconds, doubling up to max_interval, until `deadline` seconds after its
+    # restart. the restart time is kept per device so the time to recovery is measured from it
+
+    def __init__(self, initial_delay=15, first_interval=2, max_interval=16, deadline=135, sweeper=None):
+        self.initial_delay = initial_delay
+        self.first_interval = first_interval
+        self.max_interval = max_interval
+        self.deadline = deadline
+        self.sweeper = sweeper or ICMPSweeper(attempts=2, max_timeout=1.0)
+
+        self.results = {}
+        self._watching = {}     # ip -> [restart time, next check, interval]
+        self._changed = asyncio.Event()
+        self._runner = None
+
+
+    @property
+    def pending(self):
+        return len(self._watching)
+
+
+    def register(self, ip):
+        now = time.monotonic()
+        self._watching[ip] = [now, now + self.initial_delay, self.first_interval]
+        self._changed.set()
+
+        if self._runner is None:
+            self._runner = asyncio.ensure_future(self._run())
+
+
+    async def _check_due(self, now):
+        due = [ip for ip, (_, next_check, _) in self._watching.items() if next_check <= now]
+        if not due:
+            return
+
+        async for result in self.sweeper.sweep(due):
+            restarted_at = self._watching.pop(result.ip)[0]
+            # the reply time, not the end of the sweep, is when the radio was back
+            replied_at = time.monotonic() - result.rtt / 2
+            self.results[result.ip] = recovery(result.ip, True, replied_at - restarted_at)
+
+        now = time.monotonic()
+        for ip in due:
+            if ip not in self._watching:
+                continue
+
+            restarted_at, _, interval = self._watching[ip]
+            if now - restarted_at >= self.deadline:
+                del self._watching[ip]
+                self.results[ip] = recovery(ip, False, None)
+            else:
+                self._watching[ip][1:] = [now + interval, min(interval * 2, self.max_interval)]
+
+
+    async def _run(self):
+        while True:
+            await self._check_due(time.monotonic())
+
+            self._changed.clear()
+            next_check = min((x[1] for x in self._watching.values()), default=None)
+            timeout = None if next_check is None else max(next_check - time.monotonic(), 0)
+
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def wait(self):
+        # returns {ip: recovery} once every registered device is back or past its deadline
+        while self._watching:
+            if self._runner.done():
+                # the sweep failed, e.g. no permission to open an ICMP socket
+                self._runner.result()
+            await asyncio.sleep(0.5)
+        return self.results
+
+
+    async def close(self):
+        if self._runner:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
@@ -0,0 +1,83 @@
+from collections import namedtuple
+import asyncio
+import click
+
+
+restart_candidate = namedtuple('restart_candidate', ('device', 'role', 'subnet') )
+
+# customer radios go first so no CPE is cut off mid-session by its AP restarting
+ROLE_ORDER = ('cpe', 'airrouter', 'ap')
+
+
+class RestartScheduler:
+    # restarts saved radios in waves. a small canary wave goes first and has to come back
+    # online before anything else is restarted; if too many canaries fail to restart or stay
+    # down, or none restart at all, the remaining radios keep their saved config but are not
+    # restarted. after that CPEs, airRouters and APs are restarted in that order, each wave
+    # waiting for the one before it to recover
+
+    def __init__(self, restart_device, monitor, canary_size=5, abort_threshold=0.2, echo=click.echo):
+        # restart_device(device) issues the restart and returns True, or False if it timed out
+        self.restart_device = restart_device
+        self.echo = echo
+        self.monitor = monitor
+        self.canary_size = canary_size
+        self.abort_threshold = abort_threshold
+
+        self.aborted = False
+        self._candidates = []
+
+
+    def add(self, device, role):
+        self._candidates.append(restart_candidate(device, role, device.ip.rsplit('.', 1)[0]))
+
+
+    def _waves(self):
+        by_role = sorted(self._candidates, key=lambda x: (ROLE_ORDER.index(x.role), x.subnet))
+
+        # canaries are spread over as many subnets as possible, taken from the least critical role
+        canaries, seen_subnets = [], set()
+        for candidate in by_role:
+            if len(canaries) < self.canary_size and candidate.subnet not in seen_subnets:
+                canaries.append(candidate)
+                seen_subnets.add(candidate.subnet)
+        for candidate in by_role:
+            if len(canaries) < self.canary_size and candidate not in canaries:
+                canaries.append(candidate)
+
+        rest = [x for x in by_role if x not in canaries]
+        waves = [('canary', canaries)]
+        waves.extend( (role, [x for x in rest if x.role == role]) for role in ROLE_ORDER )
+        return [(name, wave) for name, wave in waves if wave]
+
+
+    async def _restart_wave(self, wave):
+        issued = await asyncio.gather(*(self.restart_device(x.device) for x in wave))
+        return {x.device.ip: ('restarted' if ok else 'restart_failed') for x, ok in zip(wave, issued)}
+
+
+    async def run(self):
+        # returns {ip: 'restarted' | 'restart_failed' | 'not_restarted'}
+        statuses = {}
+
+        for name, wave in self._waves():
+            if self.aborted:
+                statuses.update( (x.device.ip, 'not_restarted') for x in wave )
+                continue
+
+            self.echo(f"Restarting {name} wave ({len(wave)} devices)...")
+            wave_statuses = await self._restart_wave(wave)
+            statuses.update(wave_statuses)
+
+            restarted = [ip for ip, status in wave_statuses.items() if status == 'restarted']
+            recoveries = await self.monitor.wait()
+            went_down = sum(not recoveries[ip].still_up for ip in restarted)
+            # a canary whose restart failed says as much about the rest as one that stayed down
+            failed = len(wave) - len(restarted)
+
+            if name == 'canary' and (not restarted or (failed + went_down) / len(wave) > self.abort_threshold):
+                self.echo(f"{failed} of {len(wave)} canary devices could not be restarted and {went_down} did not "
+                            f"come back online, not restarting the remaining devices.")
+                self.aborted = True
+
+        return statuses
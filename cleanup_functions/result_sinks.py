@@ -0,0 +1,154 @@
+from collections import Counter
+import csv, json, sys
+import click
+
+
+# every sink has write(ip, status, detail) and close(). statuses are the final ones a device
+# ends a run with: compliant, dry_run, still_up, went_down, not_restarted, exception, or the
+# category of a host that isn't a radio (failed, airfiber, maybe_switch). the ping-only and
+# ssh-check-only modes write alive and radio
+
+
+def _plain_detail(detail):
+    # exceptions don't go into JSON and don't pickle reliably, so they travel as their repr
+    if isinstance(detail, Exception):
+        return repr(detail)
+    return detail
+
+
+class JSONLSink:
+    # one JSON object per line, written and flushed as each device finishes. '-' is stdout
+
+    def __init__(self, path):
+        self._file = click.open_file(path, 'w')
+
+
+    def write(self, ip, status, detail=None):
+        self._file.write(json.dumps({'ip': ip, 'status': status, 'detail': _plain_detail(detail)}, default=repr) + '\n')
+        self._file.flush()
+
+
+    def close(self):
+        self._file.close()
+
+
+
+class CSVSink:
+    # ip,status,detail rows. dry run changes are joined with '; ' to keep one row per device
+
+    def __init__(self, path):
+        self._file = sys.stdout if path == '-' else open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow( ('ip', 'status', 'detail') )
+
+
+    def write(self, ip, status, detail=None):
+        detail = _plain_detail(detail)
+        if isinstance(detail, (list, tuple)):
+            detail = '; '.join(map(str, detail))
+        self._writer.writerow( (ip, status, '' if detail is None else detail) )
+        self._file.flush()
+
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+
+class CallbackSink:
+    # hands every result to callback(ip, status, detail), e.g. to send it to another process
+
+    def __init__(self, callback):
+        self.callback = callback
+
+
+    def write(self, ip, status, detail=None):
+        self.callback(ip, status, _plain_detail(detail))
+
+
+    def close(self):
+        pass
+
+
+
+def open_sink(path):
+    # CSV for names ending in .csv, JSON lines for anything else
+    if path.lower().endswith('.csv'):
+        return CSVSink(path)
+    return JSONLSink(path)
+
+
+
+class RunResults:
+    # where every device's outcome goes once it is known. each one is written to the sinks
+    # straight away and counted for the end of run report, only the first `keep` of each
+    # status are held on to for the console, so memory stays flat however big the scope is.
+    # tally() counts things that aren't device outcomes, like hosts alive or radios found
+
+    def __init__(self, sinks=(), keep=100):
+        self.sinks = list(sinks)
+        self.keep = keep
+
+        self.counts = Counter()
+        self.samples = {}           # status -> [(ip, detail), ...] up to keep
+        self.recovery = Counter()   # time to recovery rounded to 0.1 s -> radios
+
+
+    def write(self, ip, status, detail=None):
+        # sinks only, for results that are counted somewhere else
+        for sink in self.sinks:
+            sink.write(ip, status, detail)
+
+
+    def add(self, ip, status, detail=None):
+        self.write(ip, status, detail)
+        self.counts[status] += 1
+
+        samples = self.samples.setdefault(status, [])
+        if len(samples) < self.keep:
+            samples.append( (ip, _plain_detail(detail)) )
+
+        if status == 'still_up':
+            self.recovery[round(detail, 1)] += 1
+
+
+    def tally(self, key, count=1):
+        self.counts[key] += count
+
+
+    def remaining(self, *statuses):
+        # how many of these weren't kept for the console
+        return sum(self.counts[x] for x in statuses) - sum(len(self.samples.get(x, ())) for x in statuses)
+
+
+    def recovery_times(self):
+        # (median, max) time to recovery, or None if nothing was restarted
+        total = sum(self.recovery.values())
+        if not total:
+            return None
+
+        seen = 0
+        for seconds in sorted(self.recovery):
+            seen += self.recovery[seconds]
+            if seen > total // 2:
+                return seconds, max(self.recovery)
+
+
+    def state(self):
+        # plain values, for a shard or work unit to send its totals back with
+        return {'counts': dict(self.counts), 'samples': self.samples, 'recovery': list(self.recovery.items())}
+
+
+    def merge(self, state):
+        self.counts.update(state['counts'])
+        for status, samples in state['samples'].items():
+            kept = self.samples.setdefault(status, [])
+            kept.extend(tuple(x) for x in samples[:self.keep - len(kept)])
+        for seconds, radios in state['recovery']:
+            self.recovery[seconds] += radios
+
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
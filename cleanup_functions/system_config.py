@@ -0,0 +1,134 @@
+from random import randint
+import asyncssh
+
+
+SYSTEM_CFG = '/tmp/system.cfg'
+
+SNMP_SETTINGS = {'snmp.location': 'REDACTED', 'snmp.contact': 'REDACTED', 'snmp.community': 'REDACTED'}
+TIMEZONE = 'REDACTED'
+
+
+def parse_system_cfg(text):
+    # system.cfg is one key=value pair per line, values may contain '='
+    return {key: value for key, sep, value in (line.partition('=') for line in text.splitlines()) if sep}
+
+
+def _ntp_changes(cfg, ntp_server_validate):
+    changes = {}
+
+    if any('ntp' in key for key in cfg):
+        for key, value in cfg.items():
+            if 'ntpclient' in key and value == 'disabled':
+                changes[key] = 'enabled'
+
+        ntp_server = cfg.get('ntpclient.1.server')
+        if ntp_server is not None and not ntp_server_validate.match(ntp_server):
+            changes['ntpclient.1.server'] = f"{randint(0,3)}.ubnt.pool.ntp.org"
+
+    else:
+        changes['ntpclient.status'] = 'enabled'
+        changes['ntpclient.1.status'] = 'enabled'
+        changes['ntpclient.1.server'] = f"{randint(0,3)}.ubnt.pool.ntp.org"
+
+    return changes
+
+
+def _snmp_changes(cfg):
+    changes = {}
+
+    if cfg.get('snmp.status') != 'enabled':
+        changes['snmp.status'] = 'enabled'
+
+    for key, value in SNMP_SETTINGS.items():
+        if cfg.get(key) != value:
+            changes[key] = value
+
+    return changes
+
+
+def compute_changes(cfg, device_info, flags, ntp_server_validate):
+    wds, snmp, ntp, traffic_shaper, timezone_, ff_reporting_mode = flags
+    changes = {}
+
+    if wds:
+        wds_status = cfg.get('wireless.1.wds.status')
+        if device_info.is_airrouter and wds_status == 'enabled':
+            changes['wireless.1.wds.status'] = 'disabled'
+        elif not device_info.is_airrouter and wds_status == 'disabled':
+            changes['wireless.1.wds.status'] = 'enabled'
+
+    if ff_reporting_mode and device_info.is_rocket and not device_info.is_legacy:
+        if cfg.get('radio.1.ff_cap_rep') == '0':
+            changes['radio.1.ff_cap_rep'] = '1'
+
+    if timezone_ and cfg.get('system.timezone', TIMEZONE) != TIMEZONE:
+        changes['system.timezone'] = TIMEZONE
+
+    if traffic_shaper and cfg.get('tshaper.status') == 'enabled':
+        changes['tshaper.status'] = 'disabled'
+
+    if ntp:
+        changes.update(_ntp_changes(cfg, ntp_server_validate))
+
+    if snmp:
+        changes.update(_snmp_changes(cfg))
+
+    return changes
+
+
+def render_system_cfg(text, changes):
+    # existing keys are edited in place, new keys go after the last line of their
+    # section (e.g. 'snmp.') or at the end of the file if the section is missing
+    lines = text.splitlines()
+    new_keys = dict(changes)
+    rendered = []
+
+    for line in lines:
+        key, sep, _ = line.partition('=')
+        if sep and key in new_keys:
+            rendered.append(f"{key}={new_keys.pop(key)}")
+        else:
+            rendered.append(line)
+
+    for key, value in new_keys.items():
+        section = key.split('.', 1)[0] + '.'
+        section_lines = [i for i, line in enumerate(rendered) if line.startswith(section)]
+        line_num = section_lines[-1] + 1 if section_lines else len(rendered)
+        rendered.insert(line_num, f"{key}={value}")
+
+    return '\n'.join(rendered) + '\n'
+
+
+def device_role(cfg, device_info):
+    # 'ap', 'cpe' or 'airrouter', used to order restarts so APs go last
+    if device_info.is_airrouter:
+        return 'airrouter'
+    if cfg.get('radio.1.mode') == 'master':
+        return 'ap'
+    return 'cpe'
+
+
+async def read_system_cfg(conn, timeout=15):
+    cfg_output = await conn.run(f"cat {SYSTEM_CFG}", check=True, timeout=timeout)
+    return cfg_output.stdout
+
+
+async def write_system_cfg(conn, text, timeout=15):
+    # written to a temp file and moved over system.cfg so a dropped session can't leave half a config
+    result = await conn.run(f"cat > {SYSTEM_CFG}.new && mv {SYSTEM_CFG}.new {SYSTEM_CFG}", input=text, check=True,
+                                timeout=timeout)
+    # check only catches a non-zero exit, a session that dropped halfway has no exit status at all
+    if result.exit_status is None:
+        raise asyncssh.ConnectionLost(f"session closed while writing {SYSTEM_CFG}")
+
+
+async def evaluate_compliance(conn, device_info, flags, ntp_server_validate, timeout=15):
+    # an empty dict of changes means the radio already matches every enabled option
+    cfg_text = await read_system_cfg(conn, timeout)
+    cfg = parse_system_cfg(cfg_text)
+    changes = compute_changes(cfg, device_info, flags, ntp_server_validate)
+    return cfg_text, cfg, changes
+
+
+def describe_changes(cfg, changes):
+    return [f"{key}: {cfg.get(key, '<missing>')} -> {value}" for key, value in changes.items()]
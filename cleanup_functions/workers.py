@@ -0,0 +1,73 @@
+import multiprocessing, queue, time, traceback
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+def _run_worker(worker, worker_id, args, messages):
+    def report(message_type, value):
+        messages.put( (message_type, worker_id, value) )
+
+    try:
+        result = worker(args, report)
+    except BaseException:
+        messages.put( ('error', worker_id, traceback.format_exc()) )
+    else:
+        messages.put( ('done', worker_id, result) )
+
+
+def run_workers(worker, shard_args, on_progress=None, on_result=None, progress_interval=5):
+    # runs worker(args, report) for every entry of shard_args, each in its own process with its
+    # own event loop. the results come back in the order of shard_args. report(type, value) sends
+    # 'progress' or per device 'result's back while the worker runs: on_progress is called at
+    # most every progress_interval seconds with the last progress of every worker, on_result
+    # with every result as it arrives
+    ctx = multiprocessing.get_context('spawn')
+    messages = ctx.Queue()
+    processes = [ctx.Process(target=_run_worker, args=(worker, i, args, messages), daemon=True)
+                    for i, args in enumerate(shard_args)]
+
+    for process in processes:
+        process.start()
+
+    results, progress, last_report = {}, {}, time.monotonic()
+
+    try:
+        while len(results) < len(processes):
+            try:
+                kind, worker_id, payload = messages.get(timeout=1)
+
+            except queue.Empty:
+                # a worker that died without a word, e.g. killed by the OOM killer
+                for i, process in enumerate(processes):
+                    if i not in results and process.exitcode not in (None, 0):
+                        raise WorkerError(f"Worker {i} exited with code {process.exitcode}")
+                continue
+
+            if kind == 'error':
+                raise WorkerError(f"Worker {worker_id} failed:\n{payload}")
+
+            elif kind == 'done':
+                results[worker_id] = payload
+
+            elif kind == 'result':
+                if on_result:
+                    on_result(payload)
+
+            else:
+                progress[worker_id] = payload
+                if on_progress and time.monotonic() - last_report >= progress_interval:
+                    on_progress(progress)
+                    last_report = time.monotonic()
+
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+
+    finally:
+        for process in processes:
+            process.join()
+
+    return [results[i] for i in range(len(processes))]
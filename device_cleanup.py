@@ -1,271 +1,657 @@
-from discovery_functions.find_alive_hosts import find_alive_hosts, find_ssh_open
-from discovery_functions.check_radio_ssh import check_radio_ssh
-from random import randint
-import asyncio, re
-import asyncssh, aioping, click
+from discovery_functions.find_alive_hosts import find_alive_hosts, _get_ips_to_ping
+from discovery_functions.pipeline import run_pipeline, default_limiters
+from discovery_functions.ssh_pool import SSHPool
+from discovery_functions.icmp_sweep import ICMPSweeper
+from discovery_functions.inventory import DeviceInventory
+from discovery_functions.credentials import CredentialStrategy, login
+from discovery_functions.tracing import Tracer
+from discovery_functions.timeouts import timeouts_for
+from discovery_functions.retry import RetryEngine, POLICIES, with_retries
+from discovery_functions.ubnt_discovery import UBNTDiscovery
+from discovery_functions.snmp_screen import SNMPScreen
+from discovery_functions.profiling import LoopProfiler
+from cleanup_functions.system_config import (evaluate_compliance, describe_changes, render_system_cfg, 
+                                                write_system_cfg, device_role)
+from cleanup_functions.liveness_monitor import LivenessMonitor
+from cleanup_functions.restart_scheduler import RestartScheduler
+from cleanup_functions.workers import run_workers
+from cleanup_functions.coordinator import Coordinator
+from cleanup_functions.journal import RunJournal, load_resume_plan
+from cleanup_functions.result_sinks import RunResults, CallbackSink, open_sink
+from collections import namedtuple
+from contextlib import closing, nullcontext
+import asyncio, os, re, sys
+import asyncssh, click
 
 
+# status is one of 'still_up', 'went_down', 'exception', 'compliant', 'dry_run' or 'not_restarted'.
+# radios that need changes are 'pending' (detail is their role) until the restart waves have run,
+# nothing is written to them before their own restart
+cleanup_result = namedtuple('cleanup_result', ('ip', 'status', 'detail') )
 
-async def _ensure_snmp_settings(conn):
-    snmp_output = await conn.run("cat /tmp/system.cfg | grep -n snmp", timeout=15)
-    snmp_to_add = ['location', 'contact', 'community']
 
-    if snmp_output.stdout:
-        line_num = snmp_output.stdout[:6].split(':')[0]
-        snmp_check = snmp_output.stdout.rstrip().split('\n')
-        snmp_status = {k.split('.')[1]:v for k,v in [s.split('=') for s in snmp_check]}
 
-        for feature, field in snmp_status.items():
+async def _do_ssh_commands(conn, cfg_text, changes, timeouts):
 
-            if feature == 'status':
-                if field == 'disabled':
-                    await conn.run("sed -i 's/^snmp.status=disabled/snmp.status=enabled/' /tmp/system.cfg", check=True, timeout=15)
+    await write_system_cfg(conn, render_system_cfg(cfg_text, changes), timeouts.cfg)
+    await conn.run("save", timeout=timeouts.save)
 
-            elif field == 'REDACTED':
-                snmp_to_add.remove(feature)
 
-            elif field != 'REDACTED':
-                snmp_to_add.remove(feature)
-                await conn.run(f"sed -i 's/^snmp.{feature}={field}/snmp.{feature}=REDACTED/' /tmp/system.cfg", check=True, timeout=15)
 
-        for feature in snmp_to_add:
-            await conn.run(f"sed -i '{line_num} i snmp.{feature}=REDACTED' /tmp/system.cfg", check=True, timeout=15)
-
-    else:
-        await conn.run("sed -i 's/^snmp.status=disabled/snmp.status=enabled/' /tmp/system.cfg", check=True, timeout=15)
-        
-        for feature in snmp_to_add:
-            await conn.run(f'echo "snmp.{feature}=REDACTED" >> /tmp/system.cfg', check=True, timeout=15)
+async def _apply_changes(conn, device_info, flags, ntp_server_validate, timeouts):
+    # system.cfg is read again right before the restart, a radio that already has the changes
+    # saved (a run that died between the save and the restart) is only restarted
+    cfg_text, _, changes = await evaluate_compliance(conn, device_info, flags, ntp_server_validate, timeouts.cfg)
+    if changes:
+        await _do_ssh_commands(conn, cfg_text, changes, timeouts)
 
 
 
-async def _ensure_ntp_client(conn, ntp_server_validate):
-    ntp_output = await conn.run("cat /tmp/system.cfg | grep ntp", timeout=15)
-            
-    if ntp_output.stdout:
-        ntp_check = ntp_output.stdout.rstrip().split('\n')
-        ntp_status = [(k,v) for k,v in [s.split('=') for s in ntp_check]]
+async def _do_restart(conn, timeouts, policy=POLICIES['restart']):
+    # a radio still busy after its save can take longer than the restart timeout to answer,
+    # every retry gets 5 s more
+    async def restart(attempt):
+        await conn.run("restart", timeout=timeouts.restart + 5 * (attempt - 1))
 
-        for feature, field in ntp_status:
-            if 'ntpclient' in feature and field == 'disabled':
-                await conn.run(f"sed -i 's/^{feature}=disabled/{feature}=enabled/' /tmp/system.cfg", check=True, timeout=15)
+    try:
+        await with_retries(policy, restart, asyncssh.process.TimeoutError)
 
-            elif feature == 'ntpclient.1.server' and not ntp_server_validate.match(field):
-                await conn.run(f"sed -i 's/^ntpclient.1.server={field}/ntpclient.1.server={randint(0,3)}.ubnt.pool.ntp.org/' /tmp/system.cfg", check=True, timeout=15)        
+    except asyncssh.process.TimeoutError:
+        restarted = False
 
     else:
-        await conn.run('echo "ntpclient.status=enabled" >> /tmp/system.cfg', check=True, timeout=15)
-        await conn.run('echo "ntpclient.1.status=enabled" >> /tmp/system.cfg', check=True, timeout=15)
-        await conn.run(f'echo "ntpclient.1.server={randint(0,3)}.ubnt.pool.ntp.org" >> /tmp/system.cfg', check=True, timeout=15)
-
-
-
-async def _do_ssh_commands(conn, device_info, ntp_server_validate, flags):
-
-    wds, snmp, ntp, traffic_shaper, timezone_, ff_reporting_mode = flags
-    
-    if wds:
-        if device_info.is_airrouter:
-            await conn.run("sed -i 's/^wireless.1.wds.status=enabled/wireless.1.wds.status=disabled/' /tmp/system.cfg", check=True, timeout=15)
-        
-        else:   
-            await conn.run("sed -i 's/^wireless.1.wds.status=disabled/wireless.1.wds.status=enabled/' /tmp/system.cfg", check=True, timeout=15)
-    
-
-    if ff_reporting_mode and device_info.is_rocket and not device_info.is_legacy:
-        await conn.run("sed -i 's/^radio.1.ff_cap_rep=0/radio.1.ff_cap_rep=1/' /tmp/system.cfg", check=True, timeout=15)
-
-    if timezone_:
-        await conn.run("sed -i 's/^system.timezone=.*/system.timezone=REDACTED/' /tmp/system.cfg", check=True, timeout=15)
-    
-    if traffic_shaper:
-        await conn.run("sed -i 's/^tshaper.status=enabled/tshaper.status=disabled/' /tmp/system.cfg", check=True, timeout=15)
-    
-    if ntp:
-        await _ensure_ntp_client(conn, ntp_server_validate)
-    
-    if snmp:
-        await _ensure_snmp_settings(conn)
-
-    await conn.run("save", timeout=20)
-    await asyncio.sleep(2)
-    
+        restarted = True
+
+    return restarted
+
+
+
+async def _run_ssh_commands(device_info, ntp_server_validate, flags, verbose, pool, credentials, dry_run, limiter,
+                            retry=None):
+    ip = device_info.ip
+    timeouts = timeouts_for(device_info.rtt)
+    retry = retry or RetryEngine()
+
     try:
-        await conn.run("restart", timeout=15)
+        # a radio on a group that stopped answering waits for it outside the configure limit
+        await retry.wait(ip)
+        async with retry.guard(ip), limiter.slot(ip), login(pool, ip, credentials, timeout=timeouts.login) as (conn, _):
+            cfg_text, cfg, changes = await evaluate_compliance(conn, device_info, flags, ntp_server_validate, 
+                                                                timeouts.cfg)
+            if not changes or dry_run:
+                return _no_restart_result(ip, cfg, changes)
 
-    except asyncssh.process.TimeoutError:
-        await asyncio.sleep(30)
-        
+    except Exception as e:
+        pool.discard(ip)
+        if verbose:
+            click.echo(f"{ip}: {e!r}")
+        return cleanup_result(ip, 'exception', e)
+
+    if verbose:
+        click.echo(f"{ip}: {len(changes)} changes, written when its restart wave runs")
+
+    # the changes are only written and saved by _restart_device in the radio's wave, so a radio
+    # whose wave never runs (canary abort, a run that dies) is still found non-compliant next time
+    return cleanup_result(ip, 'pending', device_role(cfg, device_info))
+
+
+
+async def _restart_device(device_info, pool, credentials, limiter, monitor, retry=None, flags=None,
+                            ntp_server_validate=None):
+    # with flags the radio's changes are written and saved first, in the same session as the restart
+    ip = device_info.ip
+
+    timeouts = timeouts_for(device_info.rtt)
+    retry = retry or RetryEngine()
+
+    with pool.tracer.span('restart', ip) as span:
         try:
-            await conn.run("restart", timeout=20)
+            await retry.wait(ip)
+            async with retry.guard(ip), limiter.slot(ip), login(pool, ip, credentials, timeout=timeouts.login) as (conn, _):
+                if flags:
+                    await _apply_changes(conn, device_info, flags, ntp_server_validate, timeouts)
+                restarted = await _do_restart(conn, timeouts, retry.policies['restart'])
+
+        except Exception:
+            restarted = False
+
+        span.outcome = 'restarted' if restarted else 'restart_failed'
+
+    # the session does not survive the restart, don't hand it out again
+    pool.discard(ip)
+
+    if restarted:
+        # the configure slot is already free, the shared monitor watches the radio come back
+        monitor.register(ip)
+
+    return restarted
+
+
+
+def _no_restart_result(ip, cfg, changes):
+    # already compliant radios, and every radio in a dry run, are left untouched
+    if not changes:
+        return cleanup_result(ip, 'compliant', None)
+    return cleanup_result(ip, 'dry_run', describe_changes(cfg, changes))
+
+
+def _ping_only_mode(networks, verbose, exclude, sweeper, results):
+    return find_alive_hosts(networks, verbose, exclude, sweeper, results)
 
-        except asyncssh.process.TimeoutError:
-            save_config = False
 
+async def _ssh_check_only(networks, verbose, exclude, sweeper, inventory, tracer, results, udp_discovery=False,
+                            snmp_screen=False, profiler=None):
+    pool = SSHPool(tracer=tracer)
+    limiters = default_limiters()
+    udp = UBNTDiscovery() if udp_discovery else None
+    snmp = SNMPScreen() if snmp_screen else None
+
+    def on_identify(category, item, reason=None, source=None):
+        # a radio that answered UDP discovery wasn't logged in to, nor was its port 22 checked
+        if category == 'succeeded':
+            results.add(item.ip, 'udp_radio' if source == 'udp' else 'radio')
         else:
-            save_config = True
+            results.add(item, category, reason)
 
-    else:
-        save_config = True
+    if profiler:
+        profiler.watch(limiters.values())
 
-    return save_config
+    try:
+        async with profiler or nullcontext():
+            await run_pipeline(networks, verbose, pool, exclude, sweeper=sweeper, inventory=inventory, 
+                                credentials=_credential_strategy(inventory), limiters=limiters,
+                                on_identify=on_identify, retain=False, udp=udp, snmp=snmp)
+    finally:
+        await pool.close()
+        for screen in (udp, snmp):
+            if screen:
+                screen.close()
 
 
+def _ssh_check_only_mode(networks, verbose, exclude, sweeper, inventory, tracer, results, udp_discovery=False,
+                            snmp_screen=False, profiler=None):
+    return asyncio.run( _ssh_check_only(networks, verbose, exclude, sweeper, inventory, tracer, results, udp_discovery,
+                                        snmp_screen, profiler) )
 
-async def _run_ssh_commands(device_info, ntp_server_validate, flags, verbose):
-    ip = device_info.ip
 
-    if device_info.altpass:
-        async with asyncssh.connect(host=ip, username=REDACTED, password=REDACTED, known_hosts=None) as conn:
-            try:
-                save_config = await _do_ssh_commands(conn, device_info, ntp_server_validate, flags)
-            except Exception as e:
-                return (ip, False, e)
+def _configure_flags(cli_options):
+    return (cli_options.wds, cli_options.snmp, cli_options.ntp, cli_options.traffic_shaper, 
+                cli_options.timezone_, cli_options.ff_reporting_mode)
+
+
+def _announce_configure(cli_options):
+    if not any(_configure_flags(cli_options)):
+        click.echo('\nYou must enable at least 1 option in configure mode.')
+        return False
 
+    if cli_options.dry_run:
+        click.echo('\nChecking device configuration (dry run, no changes will be made)...')
     else:
-        async with asyncssh.connect(host=ip, username=REDACTED, password=REDACTED, known_hosts=None) as conn:
-            save_config = await _do_ssh_commands(conn, device_info, ntp_server_validate, flags)
+        click.echo('\nPerforming device cleanup...')
+    return True
 
 
-    if not save_config:
-        #if verbose:
-         #   click.echo(f"Save command timed out for {ip}")
-        return (ip, False, 'Save command timed out')
+async def _configure(cli_options, sweeper, inventory, tracer, results, progress=None, journal=None, plan=None,
+                        profiler=None):
+    # returns the pool stats, or None if there was nothing to scan. each device's outcome goes
+    # to `results` as soon as it is known, only the radios waiting for their restart are held
+    # on to. every step of every device goes into the journal, and a resume plan read from one
+    # picks its devices up where they stopped. a profiler charts the stages' limiters
+    networks, exclude = cli_options.networks, cli_options.exclude
+    dry_run, verbose = cli_options.dry_run, cli_options.verbose
+    flags = _configure_flags(cli_options)
+
+    ntp_server_validate = re.compile("[0-3]\.ubnt\.pool\.ntp\.org")
+
+    # discovery sessions stay open in the pool and are picked up again by the cleanup,
+    # which starts on each radio as soon as it has been identified
+    pool = SSHPool(tracer=tracer)
+    credentials = _credential_strategy(inventory)
+    monitor = LivenessMonitor(sweeper=ICMPSweeper(rate=cli_options.ping_rate, attempts=2, max_timeout=1.0))
+    limiters = default_limiters()
+    if profiler:
+        profiler.watch(limiters.values())
+    # one set of circuit breakers for discovery, configure and the restarts
+    retry = RetryEngine()
+    udp = UBNTDiscovery() if cli_options.udp_discovery else None
+    snmp = SNMPScreen() if cli_options.snmp_screen else None
+    record = journal.record if journal else lambda *args, **fields: None
+
+    async def restart_device(device):
+        restarted = await _restart_device(device, pool, credentials, limiters['configure'], monitor, retry, flags,
+                                            ntp_server_validate)
+        record('restarted' if restarted else 'restart_failed', device.ip)
+        return restarted
+
+    scheduler = RestartScheduler(restart_device, monitor, cli_options.canary_size, cli_options.canary_threshold)
+
+    def on_identify(category, item, reason=None, source=None):
+        if category == 'succeeded':
+            results.tally('radios')
+            record('discovered', item.ip, device=tuple(item))
+        else:
+            results.add(item, category, reason)
+            record('not_radio', item, category=category)
+
+    async def device_worker(device, limiter):
+        result = await _run_ssh_commands(device, ntp_server_validate, flags, verbose, pool, credentials, dry_run, limiter,
+                                            retry)
+        if result.status == 'pending':
+            scheduler.add(device, result.detail)
+            record('pending', device.ip, role=result.detail)
+        else:
+            results.add(*result)
+            record(result.status, device.ip, detail=result.detail)
+        return result
 
-    await asyncio.sleep(15)
-    
     try:
-        latency = await aioping.ping(ip) * 1000
-        #if verbose:
-         #   click.echo(f"{ip} responded in {round(latency, 2)} ms")
-        still_up = True
+        if not (plan and plan.discovery_complete):
+            summary = await run_pipeline(networks, verbose, pool, exclude, device_worker, sweeper=sweeper, 
+                                            inventory=inventory, credentials=credentials, limiters=limiters,
+                                            progress=progress, skip=plan.seen if plan else (), 
+                                            on_identify=on_identify, retain=False, retry=retry, udp=udp,
+                                            snmp=snmp)
+            if summary is None:
+                return None
+
+            results.tally('alive', summary.alive)
+            results.tally('ssh_open', summary.ssh_open)
+            record('discovery_complete')
+            if journal:
+                journal.sync()
+
+        verify = ()
+        if plan:
+            verify = await _resume_devices(plan, results, scheduler, device_worker, limiters['configure'])
+
+        # radios that were restarted just before the interruption only need watching
+        for ip in verify:
+            monitor.register(ip)
+
+        restart_statuses = await scheduler.run()
+        for ip, status in restart_statuses.items():
+            if status == 'not_restarted':
+                record('not_restarted', ip)
+        restart_statuses.update(dict.fromkeys(verify, 'restarted'))
+
+        recoveries = await monitor.wait()
+        _trace_recoveries(tracer, recoveries, monitor.deadline)
+        for ip, still_up, time_to_recovery in recoveries.values():
+            record('verified', ip, still_up=still_up, time_to_recovery=time_to_recovery)
+
+    finally:
+        await pool.close()
+        await monitor.close()
+        for screen in (udp, snmp):
+            if screen:
+                screen.close()
+
+    for x in _resolve_restarts(restart_statuses, recoveries):
+        results.add(*x)
+
+    return pool.stats
+
+
+async def _configure_mode(cli_options, sweeper, inventory, tracer, results, journal=None, plan=None, profiler=None):
+    if not _announce_configure(cli_options):
+        return
 
-    except TimeoutError:
-        await asyncio.sleep(10)
-        try:
-            latency = await aioping.ping(ip) * 1000
-        
-        except TimeoutError:
-            await asyncio.sleep(90)
-            try:
-                latency = await aioping.ping(ip) * 1000
-
-            except TimeoutError:
-                #if verbose:
-                 #   click.echo(f"{ip} timed out.")
-                still_up = False
-
-            else:
-                #if verbose:
-                 #   click.echo(f"{ip} responded in {round(latency, 2)} ms (attempt #3)")
-                still_up = True
+    if plan:
+        click.echo(f"Resuming from {cli_options.resume}: {len(plan.finished)} devices finished, "
+                    f"{len(plan.configure)} to configure, {len(plan.restart)} to restart, "
+                    f"{len(plan.verify)} to watch come back online"
+                    + ('.' if plan.discovery_complete else ', then sweeping the rest of the scope.'))
+    elif journal:
+        # the token isn't needed to resume in a single process, so it stays out of the file
+        journal.record('run', options={**cli_options._asdict(), 'token': None})
+
+    async with profiler or nullcontext():
+        pool_stats = await _configure(cli_options, sweeper, inventory, tracer, results, journal=journal, plan=plan,
+                                        profiler=profiler)
+    if pool_stats is None:
+        return
 
-        else:
-            #if verbose:
-             #   click.echo(f"{ip} responded in {round(latency, 2)} ms (attempt #2)")
-            still_up = True
+    _report_cleanup(results, cli_options.dry_run)
+    _report_pool(pool_stats)
 
-    return (ip, still_up)
 
+def _report_pool(pool_stats):
+    hits, misses, _, _, waits = pool_stats
+    waited = f", {waits} new connections waited for one to be released" if waits else ''
+    click.echo(f"\nSSH connection pool: {hits} hits, {misses} misses{waited}.")
 
 
-async def _run_ssh_commands_sem(sem, device, ntp_server_validate, flags, verbose):
-    async with sem:
-        return await _run_ssh_commands(device, ntp_server_validate, flags, verbose)
+def _shard_payload(results, pool_stats, tracer):
+    # the devices have already been streamed back one by one, only the totals are left to send
+    return results.state(), tuple(pool_stats), tracer.durations
 
 
+def _streamed_results(report):
+    # every result goes straight back to the parent process or the coordinator, which writes
+    # it to its own sinks
+    return RunResults([CallbackSink(lambda *result: report('result', result))])
 
-def _ping_only_mode(networks, verbose):
-    return find_alive_hosts(networks, verbose)
 
+def _configure_shard(shard, report):
+    # runs in a worker process, with its own event loop, limits, pool and inventory connection
+    options, scopes = shard
+    # the options namedtuple is made inside run_from_cli and can't be pickled, it comes over as a dict
+    cli_options = namedtuple('options', options)(**options)
+    if not cli_options.verbose:
+        # the parent prints the progress and the merged results
+        sys.stdout = open(os.devnull, 'w')
 
-def _ssh_check_only_mode(networks, verbose):
-    devices_ssh_open = asyncio.run( find_ssh_open(networks, verbose) )
-    succeeded, *_ = asyncio.run( check_radio_ssh(devices_ssh_open, verbose) )
-    return succeeded
+    sweeper = ICMPSweeper(rate=cli_options.ping_rate, attempts=cli_options.ping_attempts)
+    shard_options = cli_options._replace(networks=scopes, exclude=())
+    results = _streamed_results(report)
 
+    with closing(_open_inventory(cli_options)) as inventory, closing(_tracer(cli_options)) as tracer:
+        pool_stats = asyncio.run(_configure(shard_options, sweeper, inventory, tracer, results, 
+                                                progress=lambda counts: report('progress', dict(counts))))
+        return None if pool_stats is None else _shard_payload(results, pool_stats, tracer)
 
-async def _configure_mode(cli_options):
-    (networks, mode, wds, snmp, ntp, traffic_shaper, 
-                timezone_, ff_reporting_mode, verbose) = cli_options
-    flags = (wds, snmp, ntp, traffic_shaper, timezone_, ff_reporting_mode)
-    del mode
 
-    if not any(flags):
-        click.echo('\nYou must enable at least 1 option in configure mode.')
+async def _configure_unit(options, scopes, inventory, trace_path, report):
+    # one work unit from a coordinator, run by a worker agent (run_worker.py). the options
+    # come from the coordinator, the inventory and trace file are the agent's own
+    cli_options = namedtuple('options', options)(**options)._replace(networks=scopes, exclude=())
+    sweeper = ICMPSweeper(rate=cli_options.ping_rate, attempts=cli_options.ping_attempts)
+    results = _streamed_results(report)
+
+    # the coordinator's own --trace and --verbose aren't sent, the durations it may show are kept
+    with closing(Tracer(trace_path)) as tracer:
+        pool_stats = await _configure(cli_options, sweeper, inventory, tracer, results, 
+                                        progress=lambda counts: report('progress', dict(counts)))
+        return None if pool_stats is None else _shard_payload(results, pool_stats, tracer)
+
+
+def _echo_shard_progress(progress):
+    totals = {key: sum(counts[key] for counts in progress.values()) for key in ('alive', 'ssh_open', 'radios', 'done')}
+    click.echo(f"[{len(progress)} workers: {totals['alive']} alive, {totals['ssh_open']} port 22 open, "
+                f"{totals['radios']} radios, {totals['done']} done]")
+
+
+def _merge_shards(payloads, results, tracer):
+    # adds up the totals of every shard or work unit and returns the combined pool stats
+    totals = (0, 0, 0, 0, 0)
+
+    for state, shard_stats, durations in filter(None, payloads):
+        results.merge(state)
+        totals = tuple(x + y for x, y in zip(totals, shard_stats))
+        tracer.merge(durations)
+
+    return totals
+
+
+def _configure_targets(cli_options):
+    if not _announce_configure(cli_options):
+        return None
+
+    targets, invalid = _get_ips_to_ping(cli_options.networks, cli_options.exclude)
+    if invalid:
+        click.echo()
+
+    if not targets:
+        click.echo('No valid IPv4 addresses or networks entered. Quitting.')
+        return None
+    return targets
+
+
+def _report_merged(results, pool_stats, dry_run):
+    counts = results.counts
+    click.echo(f"{counts['alive']} hosts responded to ping, {counts['ssh_open']} hosts have port 22 open, "
+                f"{counts['radios']} hosts are valid radios.\n")
+
+    _report_cleanup(results, dry_run)
+    _report_pool(pool_stats)
+
+
+def _configure_sharded(cli_options, tracer, results):
+    # the targets are split into one shard per worker along /24 boundaries, each worker
+    # runs the whole configure pipeline on its shard and the parent merges the results
+    targets = _configure_targets(cli_options)
+    if not targets:
         return
 
-    devices_ssh_open = await find_ssh_open(networks, verbose)
-    succeeded, failed, airfiber, maybe_switch = await check_radio_ssh(devices_ssh_open, verbose)
+    shards = targets.split(cli_options.workers)
+    # the ping rate and the canary wave are shared out between the workers
+    shard_options = cli_options._replace(ping_rate=max(1, cli_options.ping_rate // len(shards)), 
+                                            canary_size=-(-cli_options.canary_size // len(shards)))
+
+    click.echo(f'\nScanning {len(targets)} addresses with {len(shards)} worker processes...')
+    payloads = run_workers(_configure_shard, [(shard_options._asdict(), list(x.scopes())) for x in shards], 
+                            _echo_shard_progress, on_result=lambda result: results.write(*result))
+
+    _report_merged(results, _merge_shards(payloads, results, tracer), cli_options.dry_run)
+
 
-    if not succeeded:
-        click.echo('No IPs passed device check, quitting...')
+def _echo_remote_result(name, result):
+    ip, status, detail = result
+    click.echo(f"{ip}: {status} ({name})")
+
+
+def _configure_coordinated(cli_options, tracer, results):
+    # the targets are split into work units of unit_size /24s that worker agents on other
+    # hosts pick up one at a time, see cleanup_functions/coordinator.py and run_worker.py
+    targets = _configure_targets(cli_options)
+    if not targets:
         return
 
-    if airfiber:
-        click.echo(f"airFiber ({len(airfiber)} hosts): {', '.join(airfiber)}\n")
-    
+    units = targets.split(-(-len(targets) // (254 * cli_options.unit_size)))
+    # the workers don't need to know about the coordinator's own settings
+    options = cli_options._replace(coordinate=None, token=None, trace=None, results=())._asdict()
+
+    def on_result(name, result):
+        # the coordinator passes each device on once, even when its unit was reassigned halfway
+        # through. the totals only count the unit that finished
+        results.write(*result)
+        if cli_options.verbose:
+            _echo_remote_result(name, result)
+
+    async def coordinate():
+        coordinator = Coordinator([list(x.scopes()) for x in units], options, token=cli_options.token, 
+                                    on_progress=_echo_shard_progress, on_result=on_result)
+        payloads = await coordinator.serve(cli_options.coordinate)
+        return coordinator, payloads
+
+    coordinator, payloads = asyncio.run(coordinate())
+    _report_merged(results, _merge_shards(payloads.values(), results, tracer), cli_options.dry_run)
+
+    if coordinator.reassigned:
+        click.echo(f"\n{coordinator.reassigned} work units were reassigned after a worker failed.")
+
+    for unit_id, error in coordinator.failed.items():
+        click.echo(f"\nWork unit {unit_id} failed on every attempt, not cleaned up: "
+                    f"{', '.join(coordinator.units[unit_id])}\n    {error}")
+
+
+async def _resume_devices(plan, results, scheduler, device_worker, limiter):
+    # the devices a journal already knew about carry on from the step they stopped at:
+    # reported, configured or restarted. returns the IPs that only need their recovery watched
+    results.tally('radios', len(plan.radios))
+
+    for x in plan.finished:
+        results.add(*x)
+
+    for category, ips in plan.non_radios.items():
+        for ip in ips:
+            results.add(ip, category)
+
+    for device, role in plan.restart:
+        scheduler.add(device, role)
+
+    await asyncio.gather(*(device_worker(device, limiter) for device in plan.configure))
+
+    return [device.ip for device in plan.verify]
+
+
+def _trace_recoveries(tracer, recoveries, deadline):
+    # radios that never came back are traced as having taken the whole deadline
+    for ip, still_up, time_to_recovery in recoveries.values():
+        tracer.add('recovery', ip, time_to_recovery if still_up else deadline, 
+                    outcome='still_up' if still_up else 'went_down')
+
+
+def _resolve_restarts(restart_statuses, recoveries):
+    # the final result of every pending radio, from its restart and whether it came back
+    for ip, restart_status in restart_statuses.items():
+        if restart_status == 'restarted':
+            ip, still_up, time_to_recovery = recoveries[ip]
+            yield cleanup_result(ip, 'still_up' if still_up else 'went_down', time_to_recovery)
+
+        elif restart_status == 'restart_failed':
+            yield cleanup_result(ip, 'exception', 'Restart command timed out')
+
+        else:
+            yield cleanup_result(ip, 'not_restarted', 'Left unchanged, the canary wave failed')
+
+
+def _host_list(results, *statuses):
+    # the IPs kept for the console, the result sinks have every one of them
+    ips = ', '.join(ip for status in statuses for ip, _ in results.samples.get(status, ()))
+    remaining = results.remaining(*statuses)
+    return f"{ips} and {remaining} more" if remaining else ips
+
+
+def _report_cleanup(results, dry_run):
+    counts = results.counts
+
+    if not counts['radios']:
+        click.echo('No IPs passed device check.')
+        return
+
+    if counts['airfiber']:
+        click.echo(f"airFiber ({counts['airfiber']} hosts): {_host_list(results, 'airfiber')}\n")
+
+    failed = counts['failed'] + counts['maybe_switch']
     if failed:
-        click.echo(f"Responded to ping, failed radio check ({len(failed)} hosts): {', '.join(failed)}\n")
+        click.echo(f"Responded to ping, failed radio check ({failed} hosts): "
+                    f"{_host_list(results, 'failed', 'maybe_switch')}\n")
 
-        if maybe_switch:
-            click.echo(f"Probably switch ({len(maybe_switch)} hosts): {', '.join(maybe_switch)}\n")
+        if counts['maybe_switch']:
+            click.echo(f"Probably switch ({counts['maybe_switch']} hosts): {_host_list(results, 'maybe_switch')}\n")
 
+    if dry_run:
+        click.echo(f"Dry run complete. {counts['dry_run']} out of {counts['radios']} devices would be changed.")
 
-    click.echo('\n\nPerforming device cleanup...')
-    
-    ntp_server_validate = re.compile("[0-3]\.ubnt\.pool\.ntp\.org")
+        for ip, changes in results.samples.get('dry_run', ()):
+            click.echo(f"\n{ip}:\n    " + '\n    '.join(changes))
+
+        if results.remaining('dry_run'):
+            click.echo(f"\n... and {results.remaining('dry_run')} more.")
 
-    if len(succeeded) > 255:
-        sem = asyncio.Semaphore(255)
-        tasks = [_run_ssh_commands_sem(sem, device, ntp_server_validate, flags, verbose) for device in succeeded]
     else:
-        tasks = [_run_ssh_commands(device, ntp_server_validate, flags, verbose) for device in succeeded]
+        click.echo(f"Device cleanup complete. {counts['still_up'] + counts['compliant']} out of {counts['radios']} "
+                    f"devices still online.")
 
-    still_up, went_down, exceptions = [], [], []
+    recovery_times = results.recovery_times()
+    if recovery_times:
+        median, longest = recovery_times
+        click.echo(f"Time to recovery after restart: median {median:.1f} s, max {longest:.1f} s.")
 
-    with click.progressbar(asyncio.as_completed(tasks), length=len(tasks)) as pbar:
-        for coro in pbar:
-            x = await coro
-            if len(x) == 2:
-                if x[1]:
-                    still_up.append(x[0])
-                else:
-                    went_down.append(x[0])
+    if counts['compliant']:
+        click.echo(f"\nDevices already compliant, not restarted ({counts['compliant']} hosts): "
+                    f"{_host_list(results, 'compliant')}")
+
+    if counts['went_down']:
+        click.echo(f"\nDevices that went offline ({counts['went_down']} hosts): {_host_list(results, 'went_down')}")
+
+    if counts['not_restarted']:
+        click.echo(f"\nLeft unchanged, canary wave failed ({counts['not_restarted']} hosts): "
+                    f"{_host_list(results, 'not_restarted')}")
+
+    if counts['exception']:
+        remaining = results.remaining('exception')
+        click.echo(f"\nExceptions ({counts['exception']} hosts): {results.samples['exception']}"
+                    + (f" and {remaining} more" if remaining else ''))
 
-            elif len(x) == 3:
-                exceptions.append( (x[0], x[2]) )
 
-            else:
-                click.echo('THE FUCK HAPPENED?')
-                click.echo(x)
+def _credential_strategy(inventory):
+    credentials = CredentialStrategy()
+    credentials.learn_from_inventory(inventory)
+    return credentials
 
-    click.echo(f"Device cleanup complete. {len(still_up)} out of {len(succeeded)} devices still online.")
 
-    if went_down:
-        click.echo(f'\nDevices that went offline: {went_down}')
+def _open_inventory(cli_options):
+    return DeviceInventory(cli_options.inventory, ttl=cli_options.inventory_ttl * 3600, refresh=cli_options.refresh)
 
-    if exceptions:
-        click.echo(f'\nExceptions: {exceptions}')
+
+def _profiler(cli_options):
+    if cli_options.profile:
+        return LoopProfiler(cli_options.profile, cli_options.profile_threshold / 1000, cli_options.profile_sampler)
+    return None
+
+
+def _tracer(cli_options):
+    # the durations are only kept for the histograms _report_trace shows
+    return Tracer(cli_options.trace, keep_durations=bool(cli_options.trace or cli_options.verbose))
+
+
+def _report_trace(cli_options, tracer):
+    if cli_options.trace or cli_options.verbose:
+        tracer.report()
+
+
+def _resumed_options(cli_options, plan):
+    # the run carries on with the scope and settings it was started with
+    kept = ('verbose', 'trace', 'profile', 'profile_threshold', 'profile_sampler', 'journal', 'resume', 'results')
+    options = {key: value for key, value in plan.options.items() if key in cli_options._fields and key not in kept}
+    options['networks'], options['exclude'] = tuple(options['networks']), tuple(options['exclude'])
+    return cli_options._replace(**options)
+
+
+def _open_journal(cli_options):
+    path = cli_options.resume or cli_options.journal
+    return closing(RunJournal(path)) if path else nullcontext()
 
 
 def device_cleanup(cli_options):
+    plan = None
+    if cli_options.resume:
+        plan = load_resume_plan(cli_options.resume)
+        cli_options = _resumed_options(cli_options, plan)
+
+    if (cli_options.resume or cli_options.journal) and (cli_options.workers > 1 or cli_options.coordinate):
+        click.echo('\n--journal and --resume only work in a single process, without --workers or --coordinate.')
+        return
+
+    if cli_options.profile and (cli_options.workers > 1 or cli_options.coordinate or cli_options.mode == 'ping-only'):
+        click.echo('\n--profile only watches single process configure and ssh-check-only runs, carrying on without it.')
+
     networks = cli_options.networks
+    exclude = cli_options.exclude
     mode = cli_options.mode
     verbose = cli_options.verbose
-    
-    if mode == 'configure':
-        asyncio.run(_configure_mode(cli_options))
-    
-    elif mode == 'ping-only':
-        successful = _ping_only_mode(networks, verbose)
-        if not verbose:
-            click.echo(f"Hosts Alive: {', '.join([x for x in successful])}")
-    
-    elif mode == 'ssh-check-only':
-        successful = _ssh_check_only_mode(networks, verbose)
-        if not verbose:
-            click.echo(f"Hosts with port 22 open that are valid radios: {', '.join([x.ip for x in successful])}")
+    sweeper = ICMPSweeper(rate=cli_options.ping_rate, attempts=cli_options.ping_attempts)
+    results = RunResults([open_sink(path) for path in cli_options.results])
+
+    with closing(results):
+        if mode == 'configure':
+            with closing(_tracer(cli_options)) as tracer:
+                if cli_options.coordinate:
+                    _configure_coordinated(cli_options, tracer, results)
+                elif cli_options.workers > 1:
+                    _configure_sharded(cli_options, tracer, results)
+                else:
+                    with closing(_open_inventory(cli_options)) as inventory, _open_journal(cli_options) as journal:
+                        asyncio.run(_configure_mode(cli_options, sweeper, inventory, tracer, results, journal, plan,
+                                                    _profiler(cli_options)))
+                _report_trace(cli_options, tracer)
+
+        elif mode == 'ping-only':
+            alive = _ping_only_mode(networks, verbose, exclude, sweeper, results)
+            if alive is not None and not verbose:
+                click.echo(f"Hosts Alive: {_host_list(results, 'alive')}")
+
+        elif mode == 'ssh-check-only':
+            with closing(_open_inventory(cli_options)) as inventory, closing(_tracer(cli_options)) as tracer:
+                _ssh_check_only_mode(networks, verbose, exclude, sweeper, inventory, tracer, results, 
+                                        cli_options.udp_discovery, cli_options.snmp_screen, _profiler(cli_options))
+                _report_trace(cli_options, tracer)
+            if not verbose:
+                click.echo(f"Hosts with port 22 open that are valid radios: {_host_list(results, 'radio')}")
+                if cli_options.udp_discovery:
+                    click.echo(f"Radios identified by UDP discovery, SSH not checked: {_host_list(results, 'udp_radio')}")
 
 
 if __name__ == '__main__':
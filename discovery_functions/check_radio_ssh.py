@@ -1,6 +1,11 @@
-from collections import namedtuple
+from discovery_functions.ssh_pool import SSHPool
+from discovery_functions.credentials import CredentialStrategy, login
+from discovery_functions.concurrency import AdaptiveLimiter
+from discovery_functions.timeouts import DEFAULT_TIMEOUTS
+from discovery_functions.device_table import (DeviceTable, ssh_fail_namedtuple, ssh_succeed_namedtuple,
+                                                valid_radio_namedtuple)
 import asyncio, sys, re
-import asyncssh, aioping, click
+import asyncssh, click
 
 
 def _fix_firmware_format(firmware_version):
@@ -10,37 +15,39 @@ def _fix_firmware_format(firmware_version):
     return firmware_version
 
 
-async def _radio_discovery(ip, radio_discovery_arguments):    
-    radio_validate, rocket_validate, legacy_types, ssh_namedtuples = radio_discovery_arguments
-    ssh_fail_namedtuple, ssh_succeed_namedtuple = ssh_namedtuples
+def failure_reason(error):
+    # what an ssh_fail record says about a host whose connection broke, e.g. 'connection lost'
+    # or 'connection reset by peer'
+    if isinstance(error, asyncssh.ConnectionLost):
+        return 'connection lost'
+    if isinstance(error, asyncssh.Error):
+        return f"ssh error: {error.reason}"
+    return (error.strerror or type(error).__name__).lower()
+
+
+async def _radio_discovery(ip, radio_discovery_arguments, timeouts=DEFAULT_TIMEOUTS):    
+    radio_validate, rocket_validate, legacy_types, pool, credentials = radio_discovery_arguments
     
     altpass = can_ssh = is_valid_radio = is_airrouter = is_rocket = is_airfiber = False
     device_name = firmware_version = mac = is_legacy = None
     
     try:
-        async with asyncssh.connect(host=ip, username=REDACTED, password=REDACTED, known_hosts=None) as conn:
-            mca_status = await conn.run("mca-status | head -n 1", check=True, timeout=7)
+        async with login(pool, ip, credentials, timeout=timeouts.login) as (conn, credential):
+            mca_status = await conn.run("mca-status | head -n 1", check=True, timeout=timeouts.command)
 
     except asyncssh.misc.PermissionDenied:
-        try:
-            async with asyncssh.connect(host=ip, username=REDACTED, password=REDACTED, known_hosts=None) as conn:
-                mca_status = await conn.run("mca-status | head -n 1", check=True, timeout=7)
-
-        except asyncssh.misc.PermissionDenied:
-            reason = 'invalid credentials'
-
-        except asyncssh.process.TimeoutError:
-            reason = 'connection timeout'
+        reason = 'invalid credentials'
 
-        else:
-            can_ssh = True
-            altpass = True
-
-    except asyncssh.process.TimeoutError:
+    except (asyncssh.process.TimeoutError, asyncio.TimeoutError):
         reason = 'connection timeout'
 
+    except (asyncssh.Error, OSError) as e:
+        # resets, dropped sessions and unreachable hosts only fail this host
+        reason = failure_reason(e)
+
     else:
         can_ssh = True
+        altpass = credential == 'alternate'
 
     if not can_ssh:
         return ssh_fail_namedtuple(ip, can_ssh, reason)
@@ -80,65 +87,85 @@ async def _radio_discovery(ip, radio_discovery_arguments):
     
 
 
-async def _radio_discovery_sem(sem, ip, radio_discovery_arguments):
-    async with sem:
-        return await _radio_discovery(ip, radio_discovery_arguments)
+async def _radio_discovery_limited(limiter, ip, radio_discovery_arguments):
+    async with limiter.slot(ip) as outcome:
+        result = await _radio_discovery(ip, radio_discovery_arguments)
+        outcome.timed_out = getattr(result, 'reason', None) == 'connection timeout'
+        return result
 
 
-async def check_radio_ssh(hosts, verbose):
-
-    click.echo('\n\nChecking IPs for valid radios...')
-
+def get_radio_discovery_arguments(pool, credentials):
     radio_validate = re.compile("deviceName=.+,deviceId=..:..:..:..:..:..,firmwareVersion=2?[WX][ACMW].+,platform=.+,deviceIp=.+")
     rocket_validate = re.compile("Rocket.*")
     legacy_types = {'XM','XW'}
-    ssh_namedtuples = (
-        namedtuple('ssh_fail', ('ip', 'can_ssh', 'reason') ),
-        namedtuple('ssh_succeed', ('ip','altpass','can_ssh','is_valid_radio','device_name',
-                                    'firmware_version','mac','is_airrouter',
-                                    'is_rocket','is_legacy','is_airfiber') )
-    )
-
-    radio_discovery_arguments = (radio_validate, rocket_validate, legacy_types, ssh_namedtuples)
-
-    if len(hosts) > 255:
-        sem = asyncio.Semaphore(255)
-        tasks = [_radio_discovery_sem(sem, ip, radio_discovery_arguments) for ip in hosts]
-    else:
-        tasks = [_radio_discovery(ip, radio_discovery_arguments) for ip in hosts]
 
-    succeeded, failed, airfiber, maybe_switch = [], [], [], []
-    valid_radio_namedtuple = namedtuple('device', ('ip', 'altpass', 'is_rocket', 'is_legacy', 'is_airrouter') )
+    return (radio_validate, rocket_validate, legacy_types, pool, credentials)
+
+
+def classify_radio(result, pool, rtt=None):
+    # returns which list the host belongs in ('succeeded', 'airfiber', 'maybe_switch' or 'failed')
+    # along with the device record for valid radios. only valid radios keep their pooled session
+    ip = result.ip
+
+    if not result.can_ssh:
+        return 'failed', ip
+
+    if result.is_valid_radio:
+        return 'succeeded', valid_radio_namedtuple(ip, result.altpass, result.is_rocket, 
+                                                    result.is_legacy, result.is_airrouter, rtt)
+
+    pool.discard(ip)
+
+    if result.is_airfiber:
+        return 'airfiber', ip
+
+    return 'maybe_switch', ip
+
+
+async def check_radio_ssh(hosts, verbose, pool=None, credentials=None, results=None):
+    # returns a DeviceTable of every host. when no pool is passed in, the discovery sessions
+    # are closed once the check is done. with results passed in every host goes to them as
+    # it is identified and the table stays empty
+    close_pool = pool is None
+    if close_pool:
+        pool = SSHPool()
+
+    click.echo('\n\nChecking IPs for valid radios...')
+
+    radio_discovery_arguments = get_radio_discovery_arguments(pool, credentials or CredentialStrategy())
+
+    limiter = AdaptiveLimiter('ssh', initial=64, max_limit=512, group_initial=16, group_max=64)
+    tasks = [_radio_discovery_limited(limiter, ip, radio_discovery_arguments) for ip in hosts]
+
+    table = DeviceTable()
+    radio_count = 0
 
     with click.progressbar(asyncio.as_completed(tasks), length=len(tasks)) as pbar:
         for coro in pbar:
             result = await coro
-            ip = result.ip
+            category, item = classify_radio(result, pool)
 
-            if result.can_ssh:
+            if category == 'succeeded':
+                radio_count += 1
 
-                if result.is_valid_radio:
+            if not results:
+                table.add(result)
 
-                    device = valid_radio_namedtuple(ip, result.altpass, result.is_rocket, 
-                                                    result.is_legacy, result.is_airrouter)
-                    succeeded.append(device)
-
-                elif result.is_airfiber:
-                    airfiber.append(ip)
-
-                else:
-                    failed.append(ip)
-                    maybe_switch.append(ip)
+            elif category == 'succeeded':
+                results.add(item.ip, 'radio')
 
             else:
-                failed.append(ip)
+                results.add(item, category)
+
+    if close_pool:
+        await pool.close()
             
-    click.echo(f"{len(succeeded)} hosts are valid radios.\n")
+    click.echo(f"{radio_count} hosts are valid radios (final limit: {limiter.describe()}).\n")
 
-    if verbose:
-        click.echo(f"SSH login successful, valid radios: {', '.join([x.ip for x in succeeded])}\n")
+    if verbose and not results:
+        click.echo(f"SSH login successful, valid radios: {', '.join(table.ips(table.select('succeeded')))}\n")
 
-    return (*succeeded,), (*failed,), (*airfiber,), (*maybe_switch,)
+    return table
 
 
 
@@ -0,0 +1,199 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+import asyncio, time
+
+
+# the outcome of the slot the running task holds, for record_rtt
+_current_outcome = ContextVar('current_outcome', default=None)
+
+
+def record_rtt(seconds):
+    # a connect or SSH handshake round trip measured inside a limiter slot. these are what the
+    # slot's congestion check goes by, not how long the whole operation took: a configure that
+    # saves takes ten times as long as one that only reads, on the same healthy network
+    outcome = _current_outcome.get()
+    if outcome is not None:
+        outcome.rtt = seconds if outcome.rtt is None else max(outcome.rtt, seconds)
+
+
+class _AIMDLimit:
+
+    def __init__(self, initial, min_limit, max_limit):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.min_latency = None
+        self._last_decrease = 0.0
+
+
+    def has_room(self):
+        return self.in_flight < int(self.limit)
+
+
+    def is_congested(self, rtt, timed_out, tolerance):
+        # the fastest round trip seen is the baseline, it drifts up slowly so one lucky
+        # sample doesn't mark everything after it as congested. without a round trip only
+        # a timeout counts
+        if timed_out:
+            return True
+        if rtt is None:
+            return False
+
+        if self.min_latency is None:
+            self.min_latency = rtt
+        self.min_latency = min(rtt, self.min_latency * 1.001)
+        return rtt > tolerance * self.min_latency
+
+
+    def increase(self):
+        # +1 per limit's worth of successes, i.e. roughly +1 per round of operations
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+    def decrease(self, backoff, cooldown):
+        # one congestion event shows up in many operations at once, only back off once for it
+        now = time.monotonic()
+        if now - self._last_decrease >= cooldown:
+            self.limit = max(self.min_limit, self.limit * backoff)
+            self._last_decrease = now
+
+
+class AdaptiveLimiter:
+    # AIMD limit on in-flight operations, both overall and per /24. every operation that
+    # finishes without a timeout adds to the limit, a timeout or a connect or handshake
+    # round trip (see record_rtt) well above the fastest one seen on its /24 cuts the /24's
+    # limit and the overall limit
+
+    def __init__(self, name, initial=64, min_limit=4, max_limit=512, group_initial=16, group_max=64,
+                    tolerance=3.0, backoff=0.7, cooldown=1.0):
+        self.name = name
+        self.group_initial = group_initial
+        self.group_max = group_max
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.cooldown = cooldown
+
+        self.timeouts = self.completed = 0
+        self._global = _AIMDLimit(initial, min_limit, max_limit)
+        self._groups = {}
+        self._waiters = deque()
+
+
+    @property
+    def limit(self):
+        return int(self._global.limit)
+
+
+    @property
+    def max_limit(self):
+        return self._global.max_limit
+
+
+    @property
+    def in_flight(self):
+        return self._global.in_flight
+
+
+    @property
+    def timeout_rate(self):
+        return self.timeouts / self.completed if self.completed else 0.0
+
+
+    def describe(self):
+        return f"{self.name} {self.in_flight}/{self.limit}"
+
+
+    def _group(self, ip):
+        subnet = ip.rsplit('.', 1)[0]
+        if subnet not in self._groups:
+            self._groups[subnet] = _AIMDLimit(self.group_initial, 1, self.group_max)
+        return self._groups[subnet]
+
+
+    def _take(self, group):
+        self._global.in_flight += 1
+        group.in_flight += 1
+
+
+    def _give_back(self, group):
+        self._global.in_flight -= 1
+        group.in_flight -= 1
+
+
+    def _wake_waiters(self):
+        # freed slots are handed straight to the waiters that can start, in arrival order.
+        # waiters whose /24 is still full keep their place in line
+        waiting, self._waiters = self._waiters, deque()
+        while waiting and self._global.has_room():
+            group, waiter = waiting.popleft()
+            if waiter.done():
+                continue
+            if group.has_room():
+                self._take(group)
+                waiter.set_result(None)
+            else:
+                self._waiters.append( (group, waiter) )
+        self._waiters.extend(waiting)
+
+
+    async def acquire(self, ip):
+        group = self._group(ip)
+
+        if not self._waiters and self._global.has_room() and group.has_room():
+            self._take(group)
+            return group
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append( (group, waiter) )
+        self._wake_waiters()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # cancelled just after being handed a slot
+            if waiter.done() and not waiter.cancelled():
+                self._give_back(group)
+                self._wake_waiters()
+            raise
+        return group
+
+
+    def release(self, group, rtt, timed_out, neutral=False):
+        self._give_back(group)
+
+        if not neutral:
+            self.completed += 1
+
+            if group.is_congested(rtt, timed_out, self.tolerance):
+                self.timeouts += timed_out
+                group.decrease(self.backoff, self.cooldown)
+                self._global.decrease(self.backoff, self.cooldown)
+
+            else:
+                group.increase()
+                self._global.increase()
+
+        self._wake_waiters()
+
+
+    @asynccontextmanager
+    async def slot(self, ip):
+        # callers that handle their own timeouts set outcome.timed_out, outcomes that say
+        # nothing about the network (e.g. a closed port) set outcome.neutral. round trips are
+        # set on outcome.rtt by record_rtt
+        group = await self.acquire(ip)
+        outcome = SimpleNamespace(timed_out=False, neutral=False, rtt=None)
+        token = _current_outcome.set(outcome)
+
+        try:
+            yield outcome
+
+        except TimeoutError:
+            outcome.timed_out = True
+            raise
+
+        finally:
+            _current_outcome.reset(token)
+            self.release(group, outcome.rtt, outcome.timed_out, outcome.neutral)
@@ -0,0 +1,110 @@
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import asynccontextmanager
+import time
+import asyncssh
+
+
+credential_stats = namedtuple('credential_stats', ('logins', 'failed_attempts') )
+
+CREDENTIAL_NAMES = ('primary', 'alternate')
+
+
+def _credentials(name):
+    if name == 'alternate':
+        return REDACTED, REDACTED
+    return REDACTED, REDACTED
+
+
+def _subnet(ip):
+    return ip.rsplit('.', 1)[0]
+
+
+class CredentialStrategy:
+    # remembers which login worked on each IP, MAC and /24 and tries the most likely one
+    # first, so a tower full of alternate password radios costs one handshake per radio.
+    # only the last max_hosts IPs and MACs are remembered, the /24s keep the rest
+
+    def __init__(self, max_hosts=65536):
+        self.logins = self.failed_attempts = 0
+        self.max_hosts = max_hosts
+        self._by_ip = OrderedDict()
+        self._by_mac = OrderedDict()
+        self._by_subnet = {}
+
+
+    @property
+    def stats(self):
+        return credential_stats(self.logins, self.failed_attempts)
+
+
+    def learn_from_inventory(self, inventory):
+        for ip, mac, altpass in inventory.credential_history():
+            self._learn(ip, 'alternate' if altpass else 'primary', mac)
+
+
+    def _remember(self, known, key, name):
+        known[key] = name
+        known.move_to_end(key)
+        if len(known) > self.max_hosts:
+            known.popitem(last=False)
+
+
+    def _learn(self, ip, name, mac=None):
+        self._remember(self._by_ip, ip, name)
+        if mac:
+            self._remember(self._by_mac, mac, name)
+        self._by_subnet.setdefault(_subnet(ip), Counter())[name] += 1
+
+
+    def order(self, ip, mac=None):
+        known = self._by_ip.get(ip) or self._by_mac.get(mac)
+        if known:
+            return (known, *(x for x in CREDENTIAL_NAMES if x != known))
+
+        # most successful login on this /24 first, ties keep the default order
+        prior = self._by_subnet.get(_subnet(ip), Counter())
+        return tuple(sorted(CREDENTIAL_NAMES, key=lambda x: -prior[x]))
+
+
+    def record_success(self, ip, name, mac=None, opened=True):
+        # a reused pooled session confirms the credential without a new login
+        if opened:
+            self.logins += 1
+        self._learn(ip, name, mac)
+
+
+    def record_failure(self, ip, name):
+        self.failed_attempts += 1
+        if self._by_ip.get(ip) == name:
+            del self._by_ip[ip]
+
+        prior = self._by_subnet.get(_subnet(ip))
+        if prior and prior[name]:
+            prior[name] -= 1
+
+
+@asynccontextmanager
+async def login(pool, ip, strategy, mac=None, timeout=None):
+    # yields the pooled connection and the name of the credential that was accepted.
+    # timeout covers a new connection's handshake and auth, reused ones don't need it
+    logged_in = False
+
+    for attempt, name in enumerate(strategy.order(ip, mac), 1):
+        username, password = _credentials(name)
+        start = time.monotonic()
+        try:
+            async with pool.connection(ip, username=username, password=password, timeout=timeout) as conn:
+                logged_in = True
+                pool.tracer.add('login', ip, time.monotonic() - start, credential=name, attempt=attempt,
+                                    outcome='ok' if conn.opened else 'reused')
+                strategy.record_success(ip, name, mac, conn.opened)
+                yield conn, name
+                return
+
+        except asyncssh.misc.PermissionDenied:
+            if logged_in:
+                raise
+            pool.tracer.add('login', ip, time.monotonic() - start, credential=name, attempt=attempt, outcome='denied')
+            strategy.record_failure(ip, name)
+
+    raise asyncssh.misc.PermissionDenied('None of the credentials were accepted')
@@ -0,0 +1,179 @@
+from discovery_functions.target_set import TargetSet, int_to_ip
+from array import array
+from collections import namedtuple
+from ipaddress import IPv4Address
+import math
+
+
+# what _radio_discovery returns for a host, and the record the configure stage takes for a radio
+ssh_fail_namedtuple = namedtuple('ssh_fail', ('ip', 'can_ssh', 'reason') )
+ssh_succeed_namedtuple = namedtuple('ssh_succeed', ('ip','altpass','can_ssh','is_valid_radio','device_name',
+                                                    'firmware_version','mac','is_airrouter',
+                                                    'is_rocket','is_legacy','is_airfiber') )
+# rtt is the host's smoothed round trip from discovery, None if it wasn't measured
+valid_radio_namedtuple = namedtuple('device', ('ip', 'altpass', 'is_rocket', 'is_legacy', 'is_airrouter', 'rtt'), 
+                                        defaults=(None,) )
+
+# a row per identified host, in columns: the address as a uint32, the category as a byte, the
+# role flags as bits of another byte, the RTT as a float32 and the firmware, failure reason and
+# MAC as numbers. firmware versions and reasons repeat across a fleet, each one is only stored
+# once. about 25 bytes a host against several hundred for the namedtuples and their strings,
+# so 100k+ hosts can be kept for a whole run. device records are only built for the rows asked for
+CATEGORIES = ('succeeded', 'airfiber', 'maybe_switch', 'failed')
+
+# role flags, as keyword arguments to select()
+FLAGS = ('altpass', 'is_rocket', 'is_legacy', 'is_airrouter')
+
+_CATEGORY_CODES = {category: code for code, category in enumerate(CATEGORIES)}
+_FLAG_BITS = {flag: 1 << bit for bit, flag in enumerate(FLAGS)}
+
+
+def _mac_to_int(mac):
+    return int(mac.replace(':', ''), 16) if mac else 0
+
+
+def _int_to_mac(x):
+    return ':'.join(f"{x >> shift & 255:02X}" for shift in range(40, -8, -8)) if x else None
+
+
+def _classify(result):
+    # classify_radio without the pool, the table doesn't decide which sessions are kept
+    if not result.can_ssh:
+        return 'failed'
+    if result.is_valid_radio:
+        return 'succeeded'
+    return 'airfiber' if result.is_airfiber else 'maybe_switch'
+
+
+
+class DeviceTable:
+    # rows are numbered in the order hosts were added. select() and order() work on row
+    # numbers and return lists of them, ip(), device() and devices() turn rows back into
+    # what the rest of the code uses
+
+    def __init__(self):
+        self._ips = array('I')
+        self._categories = array('B')
+        self._flags = array('B')
+        self._rtts = array('f')
+        self._firmware = array('H')
+        self._reasons = array('H')
+        self._macs = array('Q')
+
+        # index 0 is None
+        self._strings = [None]
+        self._string_ids = {None: 0}
+
+
+    def __len__(self):
+        return len(self._ips)
+
+
+    def _intern(self, string):
+        if string not in self._string_ids:
+            self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return self._string_ids[string]
+
+
+    def add(self, result, rtt=None):
+        # result is what _radio_discovery (or the inventory) returned for the host
+        flags = 0
+        for flag in FLAGS:
+            if getattr(result, flag, False):
+                flags |= _FLAG_BITS[flag]
+
+        self._ips.append(int(IPv4Address(result.ip)))
+        self._categories.append(_CATEGORY_CODES[_classify(result)])
+        self._flags.append(flags)
+        self._rtts.append(math.nan if rtt is None else rtt)
+        self._firmware.append(self._intern(getattr(result, 'firmware_version', None)))
+        self._reasons.append(self._intern(getattr(result, 'reason', None)))
+        self._macs.append(_mac_to_int(getattr(result, 'mac', None)))
+        return len(self._ips) - 1
+
+
+    def select(self, category=None, network=None, firmware=None, **flags):
+        # rows in `category` ('succeeded' for the radios), inside `network` (any scope the CLI
+        # takes), whose firmware starts with `firmware` and whose flags have the values given,
+        # e.g. select('succeeded', '10.20.0.0/16', is_rocket=True, is_legacy=False)
+        rows = range(len(self._ips))
+
+        if category is not None:
+            code = _CATEGORY_CODES[category]
+            rows = [i for i in rows if self._categories[i] == code]
+
+        if flags:
+            mask = want = 0
+            for flag, value in flags.items():
+                mask |= _FLAG_BITS[flag]
+                if value:
+                    want |= _FLAG_BITS[flag]
+            rows = [i for i in rows if self._flags[i] & mask == want]
+
+        if network is not None:
+            intervals = list(TargetSet.from_scopes([network]).intervals())
+            rows = [i for i in rows if any(start <= self._ips[i] <= end for start, end in intervals)]
+
+        if firmware is not None:
+            ids = {index for index, string in enumerate(self._strings) if string and string.startswith(firmware)}
+            rows = [i for i in rows if self._firmware[i] in ids]
+
+        return list(rows)
+
+
+    def order(self, rows=None, by='ip', reverse=False):
+        # rows sorted by 'ip', 'rtt' (unmeasured last) or 'firmware'
+        rows = range(len(self._ips)) if rows is None else rows
+
+        if by == 'ip':
+            key = self._ips.__getitem__
+        elif by == 'rtt':
+            key = lambda i: (math.isnan(self._rtts[i]), self._rtts[i])
+        elif by == 'firmware':
+            key = lambda i: self._strings[self._firmware[i]] or ''
+        else:
+            raise ValueError(f"can't sort by {by!r}, use 'ip', 'rtt' or 'firmware'")
+
+        return sorted(rows, key=key, reverse=reverse)
+
+
+    def ip(self, row):
+        return int_to_ip(self._ips[row])
+
+
+    def category(self, row):
+        return CATEGORIES[self._categories[row]]
+
+
+    def firmware(self, row):
+        return self._strings[self._firmware[row]]
+
+
+    def reason(self, row):
+        return self._strings[self._reasons[row]]
+
+
+    def mac(self, row):
+        return _int_to_mac(self._macs[row])
+
+
+    def rtt(self, row):
+        rtt = self._rtts[row]
+        return None if math.isnan(rtt) else rtt
+
+
+    def device(self, row):
+        # the record the configure stage takes, for a row of a radio
+        flags = self._flags[row]
+        return valid_radio_namedtuple(self.ip(row), *(bool(flags & _FLAG_BITS[flag]) for flag in FLAGS), self.rtt(row))
+
+
+    def ips(self, rows=None):
+        return [self.ip(i) for i in (range(len(self._ips)) if rows is None else rows)]
+
+
+    def devices(self, rows=None):
+        # device records for the radios among `rows`, all of them by default
+        rows = self.select('succeeded') if rows is None else rows
+        return (self.device(i) for i in rows)
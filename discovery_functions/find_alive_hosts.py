@@ -1,154 +1,146 @@
-from ipaddress import IPv4Address, IPv4Network
-from multiping import MultiPing
-import itertools, sys, asyncio
+from discovery_functions.target_set import TargetSet, parse_scope
+from discovery_functions.icmp_sweep import ICMPSweeper
+from discovery_functions.concurrency import AdaptiveLimiter, record_rtt
+from discovery_functions.timeouts import host_record, DEFAULT_TIMEOUTS
+from discovery_functions.retry import POLICIES, with_retries
+from ipaddress import IPv4Address
+import asyncio, time
 import click
 
 
-def _get_ranges_expanded(octets):
-    parsed_ranges = (tuple(map(int, sorted(octet.split('-')))) for octet in octets)
-    ranges = [range(r[0], r[-1] + 1) if len(r) > 1 else r for r in parsed_ranges]
-    ranges_expanded = ['.'.join(map(str, x)) for x in itertools.product(*ranges)]
-    
-    return ranges_expanded
-
-
-def _get_ips_to_ping(networks_input):
-    # in the tuple of IPs returned, anything ending in .0 or .1 will not be included
-    zero_and_one = {'0','1'}
+def _parse_scopes(networks_input):
     any_invalid = False
-    list_to_ping = []
+    scope_intervals = []
 
     for scope in networks_input:
-        invalid = False
         scope = scope.strip()
-        octets = scope.split('.')
-        first_3_octets = octets[:3]
-
-
-        if len(octets) != 4 or any('/' in x for x in first_3_octets):
-            invalid = True
-
-        
-        elif all(x in scope for x in ('-','/') ):
-            last_octet = octets[3]
-            ranges_expanded = _get_ranges_expanded(first_3_octets)
-
-            networks = [IPv4Network( '.'.join((x, last_octet)) , strict=False) for x in ranges_expanded]
-            addresses = [z for y in networks for x in y if (z:=str(x)).split('.')[-1] not in zero_and_one]
-
-        elif '-' in scope:
-            ranges_expanded = _get_ranges_expanded(octets)
-            addresses = [x for x in ranges_expanded if x.split('.')[-1] not in zero_and_one]
 
-        elif '/' in octets[-1]:
-            try:
-                network = IPv4Network(scope, strict=False)
-            except:
-                invalid = True
-            else:
-                addresses = [z for x in network if (z:=str(x)).split('.')[-1] not in zero_and_one]
-
-        elif octets[-1] not in zero_and_one:
-            addresses = (scope,)
-            
-        else:
-            invalid = True
+        try:
+            scope_intervals.append(parse_scope(scope))
 
-        
-        if invalid:
+        except ValueError:
             if ',' in scope:
                 click.echo("\nCommas should not be used to separate IP scopes, use spaces instead.")
             else:
                 click.echo()
             click.echo(f"Entry of '{scope}' is invalid. Skipping this entry.")
             any_invalid = True
-            continue
 
-        checked_addresses = []
-        for address in addresses:
-            try:
-                IPv4Address(address)
-            except:
-                click.echo(f"Entry of '{address}' is invalid. Skipping this entry.")
-                invalid = True
-                continue
-            checked_addresses.append(address)
+    return TargetSet(scope_intervals), any_invalid
+
+
+def _get_ips_to_ping(networks_input, exclude_input=()):
+    # overlapping scopes are merged and the excluded scopes removed without expanding
+    # anything, addresses are only generated while the target set is iterated over.
+    # anything ending in .0 or .1 is never yielded
+    targets, any_invalid = _parse_scopes(networks_input)
+
+    if exclude_input:
+        excluded, exclude_invalid = _parse_scopes(exclude_input)
+        targets = targets.difference(excluded)
+        any_invalid = any_invalid or exclude_invalid
+
+    return targets, any_invalid
 
-        list_to_ping.extend(checked_addresses)
 
-    return (*list_to_ping,), any_invalid
 
+def _echo_ping_result(result):
+    attempt = f" (attempt #{result.attempt})" if result.attempt > 1 else ''
+    click.echo(f"{result.ip} responded in {round(result.rtt * 1000, 2)} ms{attempt}")
 
 
-def find_alive_hosts(networks_input, verbose):
-    ips_to_ping_full, invalid = _get_ips_to_ping(networks_input)
+async def _sweep_alive_hosts(networks_input, verbose, exclude_input=(), sweeper=None, results=None):
+    # with results passed in the hosts go to them as they answer and nothing is returned.
+    # None if there was nothing valid to ping
+    ips_to_ping, invalid = _get_ips_to_ping(networks_input, exclude_input)
 
     if invalid:
         click.echo()
 
-    if not ips_to_ping_full:
+    if not ips_to_ping:
         click.echo('No valid IPv4 addresses or networks entered. Quitting.')
-        sys.exit()
+        return None
 
     click.echo('\nPinging addresses...')
 
-    ping = MultiPing(ips_to_ping_full)
-    ping.send()
-    responses_1, timeouts_1 = ping.receive(0.5)
-    responses = responses_1.copy()
+    sweeper = sweeper or ICMPSweeper()
+    responses = []
+    alive_count = 0
 
-    if verbose and responses_1:
-        click.echo(f"\nIPs responded to first ping:\n{', '.join([x for x in responses_1])}\n")
-
-    if len(ips_to_ping_full) > len(responses_1):
-        ping.send()
-        responses_2, timeouts_2 = ping.receive(5)
-        responses.update(responses_2)
-
-        if verbose and responses_2:
-            click.echo(f"\nIPs responded to second ping:\n{[x for x in responses_2]}\n")
+    async for result in sweeper.sweep(ips_to_ping):
+        if verbose:
+            _echo_ping_result(result)
+        alive_count += 1
+        if results:
+            results.add(result.ip, 'alive', result.rtt)
+        else:
+            responses.append(result.ip)
 
-    hosts_alive = sorted(responses.keys(), key=lambda x: IPv4Address(x))
+    hosts_alive = sorted(responses, key=lambda x: IPv4Address(x))
     
-    click.echo(f"{len(hosts_alive)} hosts responded to ping.\n")
+    click.echo(f"{alive_count} hosts responded to ping.\n")
     
     return (*hosts_alive,)
 
 
+def find_alive_hosts(networks_input, verbose, exclude_input=(), sweeper=None, results=None):
+    return asyncio.run( _sweep_alive_hosts(networks_input, verbose, exclude_input, sweeper, results) )
 
-async def _check_ssh_open(ip, verbose):    
-    try:
+
+
+async def stream_alive_hosts(targets, alive_queue, verbose, sweeper=None, tracer=None):
+    # hosts are put on the queue as soon as they answer instead of after the whole sweep,
+    # along with their RTT for the later stages to size their timeouts on
+    sweeper = sweeper or ICMPSweeper()
+    alive_count = 0
+
+    async for result in sweeper.sweep(targets):
+        if verbose:
+            _echo_ping_result(result)
+        if tracer:
+            tracer.add('ping', result.ip, result.rtt, attempt=result.attempt, outcome='alive')
+        alive_count += 1
+        await alive_queue.put(host_record(result.ip, result.rtt))
+
+    return alive_count
+
+
+
+async def _check_ssh_open(ip, verbose, timeouts=DEFAULT_TIMEOUTS, policy=POLICIES['port 22']):
+    # the first connect gets the connect timeout, any retry the policy allows the longer connect_retry
+    async def connect(attempt):
+        start = time.monotonic()
         conn = asyncio.open_connection(f'{ip}', 22)
-        reader, writer = await asyncio.wait_for(conn, timeout=1.5)
+        reader, writer = await asyncio.wait_for(conn, timeout=timeouts.connect if attempt == 1 else timeouts.connect_retry)
+        record_rtt(time.monotonic() - start)
         writer.close()
-        await writer.wait_closed()
-        return ip
-    except (asyncio.exceptions.TimeoutError, ConnectionRefusedError):
         try:
-            conn = asyncio.open_connection(f'{ip}', 22)
-            reader, writer = await asyncio.wait_for(conn, timeout=8)
-            writer.close()
             await writer.wait_closed()
-            return ip
-        except (asyncio.exceptions.TimeoutError, ConnectionRefusedError):
-            conn.close()
-            return
+        except OSError:
+            # reset on close, the port was open all the same
+            pass
+        return ip
+
+    try:
+        return await with_retries(policy, connect, (asyncio.exceptions.TimeoutError, ConnectionRefusedError))
+    except (asyncio.exceptions.TimeoutError, OSError):
+        # refused, reset or no route to host
+        return
 
 
-async def _check_ssh_open_sem(ip, verbose, sem):
-    async with sem:
-        return await _check_ssh_open(ip, verbose)
+async def _check_ssh_open_limited(ip, verbose, limiter):
+    async with limiter.slot(ip) as outcome:
+        ip_open = await _check_ssh_open(ip, verbose)
+        outcome.neutral = ip_open is None
+        return ip_open
 
 
 async def _do_check_ssh_tasks(alive_hosts, verbose):
 
     click.echo('\n\nScanning for port 22...')
 
-    if len(alive_hosts) > 255:
-        sem = asyncio.Semaphore(255)
-        tasks = [_check_ssh_open_sem(ip, verbose, sem) for ip in alive_hosts]
-    else:
-        tasks = [_check_ssh_open(ip, verbose) for ip in alive_hosts]
+    limiter = AdaptiveLimiter('port 22', initial=128, max_limit=1024, group_initial=32, group_max=256)
+    tasks = [_check_ssh_open_limited(ip, verbose, limiter) for ip in alive_hosts]
 
     results = []
     with click.progressbar(asyncio.as_completed(tasks), length=len(tasks)) as pbar:
@@ -159,7 +151,7 @@ async def _do_check_ssh_tasks(alive_hosts, verbose):
 
     ssh_open_ips = (*results,)
     
-    click.echo(f"{len(ssh_open_ips)} hosts have port 22 open.\n")
+    click.echo(f"{len(ssh_open_ips)} hosts have port 22 open (final limit: {limiter.describe()}).\n")
 
     if verbose:
         click.echo(f"{', '.join(ssh_open_ips)}\n")
@@ -168,8 +160,11 @@ async def _do_check_ssh_tasks(alive_hosts, verbose):
 
 
 
-async def find_ssh_open(networks_input, verbose):
-    alive_hosts = find_alive_hosts(networks_input, verbose)
+async def find_ssh_open(networks_input, verbose, exclude_input=(), sweeper=None):
+    alive_hosts = await _sweep_alive_hosts(networks_input, verbose, exclude_input, sweeper)
+    if alive_hosts is None:
+        # nothing valid to ping, already said so
+        return []
     hosts_open_ssh = await _do_check_ssh_tasks(alive_hosts, verbose)
 
     #if len(alive_hosts) > len(hosts_open_ssh):
@@ -181,5 +176,6 @@ async def find_ssh_open(networks_input, verbose):
 
 if __name__ == '__main__':
     #find_ssh_open()
-    networks_input = input('Enter IPs to ping. Enter CIDR or a range with a dash ("-"), separated by commas.: ')
-    print(_get_ips_to_ping(networks_input))
+    networks_input = input('Enter IPs to ping. Enter CIDR or a range with a dash ("-"), separated by spaces.: ')
+    targets, _ = _get_ips_to_ping(networks_input.split())
+    print(len(targets), list(targets.intervals()))
@@ -0,0 +1,244 @@
+from collections import namedtuple
+import asyncio, heapq, itertools, os, select, socket, struct, threading, time
+
+
+ping_result = namedtuple('ping_result', ('ip', 'rtt', 'attempt') )
+
+_ICMP_ECHO_REQUEST = 8
+_ICMP_ECHO_REPLY = 0
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _echo_request(ident, seq):
+    header = struct.pack('!BBHHH', _ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    payload = b'FWB_Cleanup_Radios'
+    checksum = _checksum(header + payload)
+    return struct.pack('!BBHHH', _ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+
+def _open_icmp_socket():
+    # raw sockets need root/admin, the unprivileged ICMP datagram socket is the linux fallback
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        is_raw = True
+    except PermissionError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        is_raw = False
+
+    sock.setblocking(False)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    return sock, is_raw
+
+
+def _watch_readable(loop, sock, on_readable):
+    # the proactor loop on windows has no add_reader, a thread waits on the socket instead and
+    # hands every wake up to the loop. returns what stops it
+    try:
+        loop.add_reader(sock.fileno(), on_readable)
+        return lambda: loop.remove_reader(sock.fileno())
+    except NotImplementedError:
+        pass
+
+    stopping = threading.Event()
+    def wake_up():
+        if not stopping.is_set():
+            on_readable()
+
+    def wait():
+        while not stopping.is_set():
+            try:
+                readable, _, _ = select.select([sock], [], [], 0.1)
+            except (OSError, ValueError):
+                return
+            if readable and not stopping.is_set():
+                try:
+                    loop.call_soon_threadsafe(wake_up)
+                except RuntimeError:
+                    # the loop closed under us
+                    return
+                # give the loop time to drain the socket before looking again
+                time.sleep(0.001)
+
+    threading.Thread(target=wait, name='icmp reader', daemon=True).start()
+    # not joined, the thread notices within 0.1 s and wake ups still on their way do nothing
+    return stopping.set
+
+
+class ICMPSweeper:
+    # pings a target set from inside the event loop. packets are paced at `rate` per second
+    # instead of being sent in one burst, and every host that hasn't answered is retried on its
+    # own timer. the retransmit timeout follows the RTTs seen so far in the sweep (srtt + 4 *
+    # rttvar, like TCP) and doubles on every attempt, within min_timeout and max_timeout.
+    # no new hosts are pinged while `backlog` replies are waiting to be taken from the sweep,
+    # so a slow consumer holds the sweep back instead of the replies piling up
+
+    def __init__(self, rate=2000, attempts=3, min_timeout=0.5, max_timeout=5.0, backlog=1024):
+        self.rate = rate
+        self.attempts = attempts
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.backlog = backlog
+
+        self._srtt = self._rttvar = None
+
+
+    def _retransmit_timeout(self, attempt):
+        if self._srtt is None:
+            rto = self.min_timeout
+        else:
+            rto = max(self.min_timeout, self._srtt + 4 * self._rttvar)
+        return min(rto * 2 ** (attempt - 1), self.max_timeout)
+
+
+    def _update_rtt(self, rtt):
+        if self._srtt is None:
+            self._srtt, self._rttvar = rtt, rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+
+
+    async def sweep(self, targets):
+        # async iterator of ping_result, in the order the replies come in
+        results = asyncio.Queue()
+        # set when a reply is taken, for a send loop waiting on the backlog
+        taken = asyncio.Event()
+        task = asyncio.ensure_future(self._run(iter(targets), results, taken))
+
+        try:
+            while (result := await results.get()) is not None:
+                taken.set()
+                yield result
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        # surfaces errors from the send loop, e.g. no permission to open an ICMP socket
+        task.result()
+
+
+    async def _run(self, addresses, results, taken):
+        # the None that ends sweep() goes out however this ends, opening the socket included
+        try:
+            await self._send_loop(addresses, results, taken)
+        finally:
+            results.put_nowait(None)
+
+
+    async def _send_loop(self, addresses, results, taken):
+        loop = asyncio.get_running_loop()
+        sock, is_raw = _open_icmp_socket()
+        ident = os.getpid() & 0xffff
+        seq = itertools.count()
+
+        pending = {}        # ip -> (send time, attempt)
+        retransmits = []    # heap of (deadline, ip, attempt)
+        # set once every host sent to has answered, so a sweep of a few hosts that are all up
+        # ends with the last reply instead of the last retransmit timer
+        answered = asyncio.Event()
+
+        def on_readable():
+            while True:
+                try:
+                    data, (ip, _) = sock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    return
+
+                received = time.monotonic()
+                icmp = data[(data[0] & 0x0f) * 4:] if is_raw else data
+
+                if len(icmp) < 8 or icmp[0] != _ICMP_ECHO_REPLY:
+                    continue
+                # the kernel rewrites the id on datagram sockets and only hands us our own replies
+                if is_raw and struct.unpack('!H', icmp[4:6])[0] != ident:
+                    continue
+                if ip not in pending:
+                    continue
+
+                sent, attempt = pending.pop(ip)
+                rtt = received - sent
+                self._update_rtt(rtt)
+                results.put_nowait(ping_result(ip, rtt, attempt))
+                if not pending:
+                    answered.set()
+
+        async def send(ip, attempt):
+            packet = _echo_request(ident, next(seq) & 0xffff)
+            try:
+                await loop.sock_sendto(sock, packet, (ip, 0))
+            except OSError:
+                # unreachable network/host on the local side, counts as no reply
+                pass
+            pending[ip] = (time.monotonic(), attempt)
+            heapq.heappush(retransmits, (time.monotonic() + self._retransmit_timeout(attempt), ip, attempt))
+
+        try:
+            stop_reading = _watch_readable(loop, sock, on_readable)
+        except BaseException:
+            sock.close()
+            raise
+        try:
+            interval = 1 / self.rate
+            next_send = time.monotonic()
+            exhausted = False
+
+            while not exhausted or pending:
+                now = time.monotonic()
+                # don't make up for time lost while the loop was busy with one big burst
+                next_send = max(next_send, now - 0.05)
+
+                # hosts that ran out of time get another attempt or are given up on
+                while retransmits and retransmits[0][0] <= now:
+                    _, ip, attempt = heapq.heappop(retransmits)
+                    if pending.get(ip, (None, None))[1] != attempt:
+                        continue
+                    if attempt < self.attempts:
+                        await send(ip, attempt + 1)
+                        next_send += interval
+                    else:
+                        del pending[ip]
+
+                # new hosts are paced so the sweep never bursts faster than `rate`
+                held = not exhausted and results.qsize() >= self.backlog
+                while not exhausted and not held and next_send <= now:
+                    ip = next(addresses, None)
+                    if ip is None:
+                        exhausted = True
+                        break
+                    await send(ip, 1)
+                    next_send += interval
+
+                wake_up = []
+                if not exhausted and not held:
+                    wake_up.append(next_send)
+                if retransmits:
+                    wake_up.append(retransmits[0][0])
+                if held:
+                    # until a reply is taken or a retransmit is due
+                    taken.clear()
+                    try:
+                        await asyncio.wait_for(taken.wait(), max(min(wake_up) - time.monotonic(), 0)
+                                                if wake_up else None)
+                    except asyncio.TimeoutError:
+                        pass
+                elif not exhausted:
+                    await asyncio.sleep(max(min(wake_up) - time.monotonic(), 0))
+                elif pending:
+                    # only the retransmit timers are left, the last reply can end the sweep early
+                    answered.clear()
+                    try:
+                        await asyncio.wait_for(answered.wait(), max(min(wake_up) - time.monotonic(), 0))
+                    except asyncio.TimeoutError:
+                        pass
+
+        finally:
+            stop_reading()
+            sock.close()
@@ -0,0 +1,104 @@
+from discovery_functions.check_radio_ssh import ssh_succeed_namedtuple
+from collections import namedtuple
+from pathlib import Path
+import sqlite3, time
+
+
+DEFAULT_INVENTORY_PATH = Path.home() / '.fwb_cleanup_radios' / 'inventory.sqlite3'
+
+inventory_stats = namedtuple('inventory_stats', ('hits', 'misses', 'stale') )
+
+_COLUMNS = ('altpass', 'can_ssh', 'is_valid_radio', 'device_name', 'firmware_version', 'mac',
+            'is_airrouter', 'is_rocket', 'is_legacy', 'is_airfiber')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    ip TEXT PRIMARY KEY,
+    altpass INTEGER, can_ssh INTEGER, is_valid_radio INTEGER, device_name TEXT,
+    firmware_version TEXT, mac TEXT, is_airrouter INTEGER, is_rocket INTEGER,
+    is_legacy INTEGER, is_airfiber INTEGER,
+    checked_at REAL NOT NULL, expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS devices_mac ON devices (mac);
+'''
+
+
+class DeviceInventory:
+    # on-disk record of what _radio_discovery found on each IP, so repeat runs don't log in
+    # to a known device just to run mca-status again. entries are only trusted until their
+    # expiry, after that the device is identified again and the entry replaced
+
+    def __init__(self, path=DEFAULT_INVENTORY_PATH, ttl=24 * 3600, refresh=False):
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = self.misses = self.stale = 0
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # --workers processes share the file, WAL lets them read while one of them writes
+        self._db = sqlite3.connect(str(path), timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+
+    @property
+    def stats(self):
+        return inventory_stats(self.hits, self.misses, self.stale)
+
+
+    def get(self, ip):
+        # --refresh ignores what is stored but still writes the new results
+        if self.refresh:
+            self.misses += 1
+            return None
+
+        row = self._db.execute(f"SELECT {', '.join(_COLUMNS)}, expires_at FROM devices WHERE ip = ?",
+                                (ip,) ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        *fields, expires_at = row
+        if expires_at < time.time():
+            self.misses += 1
+            self.stale += 1
+            return None
+
+        self.hits += 1
+        return ssh_succeed_namedtuple(ip, *fields)
+
+
+    def get_by_mac(self, mac):
+        row = self._db.execute("SELECT ip FROM devices WHERE mac = ? AND expires_at >= ?",
+                                (mac, time.time()) ).fetchone()
+        return row[0] if row else None
+
+
+    def credential_history(self):
+        # expired entries are still a good guess of which login a radio takes
+        return self._db.execute("SELECT ip, mac, altpass FROM devices").fetchall()
+
+
+    def put(self, result, ttl=None):
+        # hosts that couldn't be logged in to aren't facts about the device, so they aren't kept
+        if not result.can_ssh:
+            return
+
+        now = time.time()
+        with self._db:
+            if result.mac:
+                # the radio has moved to a new IP, drop the old entry
+                self._db.execute("DELETE FROM devices WHERE mac = ? AND ip != ?", (result.mac, result.ip) )
+
+            self._db.execute(f"INSERT OR REPLACE INTO devices (ip, {', '.join(_COLUMNS)}, checked_at, expires_at) "
+                                f"VALUES ({', '.join('?' * (len(_COLUMNS) + 3))})",
+                                (result.ip, *(getattr(result, x) for x in _COLUMNS), now, now + (ttl or self.ttl)) )
+
+
+    def forget(self, ip):
+        with self._db:
+            self._db.execute("DELETE FROM devices WHERE ip = ?", (ip,) )
+
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,271 @@
+from discovery_functions.find_alive_hosts import _get_ips_to_ping, stream_alive_hosts, _check_ssh_open
+from discovery_functions.check_radio_ssh import (_radio_discovery, get_radio_discovery_arguments, classify_radio,
+                                                    failure_reason, ssh_fail_namedtuple)
+from discovery_functions.device_table import DeviceTable
+from discovery_functions.credentials import CredentialStrategy
+from discovery_functions.concurrency import AdaptiveLimiter
+from discovery_functions.retry import RetryEngine, CircuitOpenError
+from discovery_functions.snmp_screen import SCREEN_CATEGORIES, screen_to_result
+from discovery_functions.timeouts import timeouts_for, smooth_rtt
+from collections import namedtuple
+import asyncio, time
+import asyncssh, click
+
+
+# devices is a DeviceTable of every identified host
+pipeline_summary = namedtuple('pipeline_summary', ('alive', 'ssh_open', 'devices', 'results') )
+
+# put on a queue by the stage feeding it once there is nothing more to come
+_DONE = object()
+
+
+async def _run_stage(worker, in_queue, out_queue, concurrency, on_error=None):
+    # `concurrency` workers pull from in_queue and hand anything that isn't None to out_queue.
+    # how many of them actually run at once is up to the stage's AdaptiveLimiter. the queues
+    # are bounded, so a slow stage holds back the stages in front of it. a connection error
+    # the worker didn't handle only costs its own host, on_error(item, error) files it
+    async def consume():
+        while (item := await in_queue.get()) is not _DONE:
+            try:
+                result = await worker(item)
+            except (asyncssh.Error, OSError) as e:
+                result = on_error(item, e) if on_error else None
+            if result is not None and out_queue is not None:
+                await out_queue.put(result)
+
+        # let the other workers of this stage see the end as well
+        await in_queue.put(_DONE)
+
+    await asyncio.gather(*(consume() for _ in range(concurrency)))
+
+    if out_queue is not None:
+        await out_queue.put(_DONE)
+
+
+async def _produce(producer, out_queue):
+    result = await producer(out_queue)
+    await out_queue.put(_DONE)
+    return result
+
+
+async def _report_progress(counts, limiters, interval=5, progress=None, echo=click.echo):
+    # progress(counts) replaces the progress line, e.g. to hand the counts to another process
+    while True:
+        await asyncio.sleep(interval)
+        if progress:
+            progress(counts)
+            continue
+
+        limits = ', '.join(limiter.describe() for limiter in limiters)
+        echo(f"[{counts['alive']} alive, {counts['ssh_open']} port 22 open, {counts['radios']} radios, "
+                    f"{counts['done']} done] in flight/limit: {limits}")
+
+
+def default_limiters():
+    return {
+        'port': AdaptiveLimiter('port 22', initial=128, max_limit=1024, group_initial=32, group_max=256),
+        'ssh': AdaptiveLimiter('ssh', initial=64, max_limit=512, group_initial=16, group_max=64),
+        'configure': AdaptiveLimiter('configure', initial=64, max_limit=512, group_initial=16, group_max=64),
+    }
+
+
+async def run_pipeline(networks_input, verbose, pool, exclude_input=(), device_worker=None, queue_size=256,
+                        sweeper=None, inventory=None, credentials=None, limiters=None, tracer=None,
+                        progress=None, skip=(), on_identify=None, retain=True, retry=None, udp=None,
+                        snmp=None, echo=click.echo):
+    # ping -> port 22 -> radio identification -> device_worker, with every host moving on
+    # to the next stage as soon as it qualifies rather than waiting for the whole stage.
+    # device_worker(device, limiter) is handed the configure limiter to hold while it works.
+    # every host gets a span per stage it reaches in the pool's tracer unless another is passed.
+    # hosts in `skip` go no further than the ping, on_identify(category, item, reason, source)
+    # sees every identified host. reason says why a 'failed' host failed, source is where the
+    # host was identified from: 'ssh', 'inventory', 'udp' or 'snmp'. with retain False the
+    # summary's device table and results stay empty, for callers that take every host from
+    # on_identify and device_worker as it goes by. logins
+    # go through retry's circuit breakers, hosts on a group that stopped answering wait out its
+    # cooldown and fail with 'circuit open' without a login being tried if it is still down. with a UBNTDiscovery as udp every host is
+    # asked for its discovery reply first, hosts that answer skip the port 22 check and the login.
+    # with an SNMPScreen as snmp hosts that didn't answer discovery are screened next, airFiber
+    # and switches skip the port 22 check and the login and only radios and unknown hosts go on.
+    # everything the pipeline has to say goes through echo
+    targets, invalid = _get_ips_to_ping(networks_input, exclude_input)
+
+    if invalid:
+        echo()
+
+    if not targets:
+        echo('No valid IPv4 addresses or networks entered. Quitting.')
+        return None
+
+    echo(f'\nScanning {len(targets)} addresses...')
+
+    alive_queue, ssh_queue = asyncio.Queue(maxsize=queue_size), asyncio.Queue(maxsize=queue_size)
+    device_queue = asyncio.Queue(maxsize=queue_size) if device_worker else None
+
+    limiters = limiters or default_limiters()
+    retry = retry or RetryEngine()
+    counts = {'alive': 0, 'ssh_open': 0, 'udp': 0, 'snmp': 0, 'radios': 0, 'done': 0}
+    # without retain these stay empty
+    devices, results = DeviceTable(), []
+    credentials = credentials or CredentialStrategy()
+    tracer = tracer or pool.tracer
+    radio_discovery_arguments = get_radio_discovery_arguments(pool, credentials)
+
+    async def check_port(host):
+        # hosts go on to identify as (host, source, result), the last two only set for hosts
+        # identified without a login so nothing has to be kept for them in between
+        ip = host.ip
+        counts['alive'] += 1
+        if ip in skip:
+            return None
+        timeouts = timeouts_for(host.rtt)
+
+        if udp:
+            with tracer.span('udp discovery', ip, rtt=host.rtt) as span:
+                async with limiters['port'].slot(ip) as outcome:
+                    result = await udp.query(ip, timeouts)
+                    # plenty of healthy hosts don't answer discovery at all
+                    outcome.neutral = result is None
+                span.outcome = 'answered' if result else 'no reply'
+
+            if result:
+                # airFiber, switches and airCubes are classified without a login, radios are
+                # only logged in to by the configure stage
+                counts['udp'] += 1
+                return host, 'udp', result
+
+        if snmp:
+            with tracer.span('snmp screen', ip, rtt=host.rtt) as span:
+                async with limiters['port'].slot(ip) as outcome:
+                    screened = await snmp.query(ip, timeouts)
+                    # radios have SNMP turned off until they are cleaned up
+                    outcome.neutral = screened.category == 'unknown'
+                span.outcome = screened.category
+
+            if screened.category in ('airfiber', 'switch'):
+                counts['snmp'] += 1
+                return host, 'snmp', screen_to_result(screened)
+
+        with tracer.span('port 22', ip, rtt=host.rtt) as span:
+            async with limiters['port'].slot(ip) as outcome:
+                start = time.monotonic()
+                ip_open = await _check_ssh_open(ip, verbose, timeouts)
+                connect_time = time.monotonic() - start
+                # closed and filtered ports time out the same way on a healthy network
+                outcome.neutral = ip_open is None
+            span.outcome = 'open' if ip_open else 'closed'
+
+        if not ip_open:
+            return None
+
+        counts['ssh_open'] += 1
+        # a connect that needed the retry says more about the first timeout than about the RTT
+        if connect_time < timeouts.connect:
+            host = host._replace(rtt=smooth_rtt(host.rtt, connect_time))
+        return host, None, None
+
+    def file_result(host, result, source):
+        category, item = classify_radio(result, pool, host.rtt)
+        if retain:
+            devices.add(result, host.rtt)
+        if on_identify:
+            on_identify(category, item, getattr(result, 'reason', None), source)
+        return category, item
+
+    def identify_failed(item, error):
+        host = item[0]
+        file_result(host, ssh_fail_namedtuple(host.ip, False, failure_reason(error)), 'ssh')
+        if verbose:
+            echo(f"{host.ip}: {failure_reason(error)}")
+
+    def skip_host(item, error):
+        # port 22 and configure file their own failures, this is only for the unforeseen
+        echo(f"{getattr(item, 'ip', item)}: {failure_reason(error)}, skipped")
+
+    async def identify(item):
+        # devices that were screened or are known from the inventory aren't logged in to
+        host, source, result = item
+        ip = host.ip
+        with tracer.span('identify', ip, rtt=host.rtt) as span:
+            span.source = source
+
+            if result is None:
+                result = inventory.get(ip) if inventory else None
+                span.source = 'inventory' if result else 'ssh'
+
+            if result is None:
+                try:
+                    # a host on a group that stopped answering waits for it outside the ssh limit
+                    await retry.wait(ip)
+                    async with retry.guard(ip) as reachable, limiters['ssh'].slot(ip) as outcome:
+                        result = await _radio_discovery(ip, radio_discovery_arguments, timeouts_for(host.rtt))
+                        reason = getattr(result, 'reason', None)
+                        outcome.timed_out = reason == 'connection timeout'
+                        # a dropped session says the path to the radio is bad as well
+                        reachable.timed_out = reason in ('connection timeout', 'connection lost')
+
+                except CircuitOpenError:
+                    result = ssh_fail_namedtuple(ip, False, 'circuit open')
+
+                if inventory:
+                    inventory.put(result)
+
+            category, item = file_result(host, result, span.source)
+            span.outcome = getattr(result, 'reason', category)
+            if result.can_ssh and span.source not in ('udp', 'snmp'):
+                span.credential = 'alternate' if result.altpass else 'primary'
+
+        if category == 'succeeded':
+            counts['radios'] += 1
+            if verbose:
+                echo(f"{item.ip} is a valid radio")
+            return item
+
+    async def handle_device(device):
+        with tracer.span('configure', device.ip) as span:
+            result = await device_worker(device, limiters['configure'])
+            span.outcome = result.status
+
+        if retain:
+            results.append(result)
+        counts['done'] += 1
+
+    stages = [
+        _produce(lambda queue: stream_alive_hosts(targets, queue, verbose, sweeper, tracer), alive_queue),
+        _run_stage(check_port, alive_queue, ssh_queue, limiters['port'].max_limit, skip_host),
+        _run_stage(identify, ssh_queue, device_queue, limiters['ssh'].max_limit, identify_failed),
+    ]
+    if device_worker:
+        stages.append(_run_stage(handle_device, device_queue, None, limiters['configure'].max_limit, skip_host))
+
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    progress = asyncio.ensure_future(_report_progress(counts, limiters.values(), progress=progress, echo=echo))
+    try:
+        alive, *_ = await asyncio.gather(*tasks)
+    finally:
+        # a failed stage would leave the others blocked on their queues
+        for task in (*tasks, progress):
+            task.cancel()
+
+    echo(f"{alive} hosts responded to ping, {counts['ssh_open']} hosts have port 22 open, "
+                f"{counts['radios']} hosts are valid radios.\n")
+
+    if udp:
+        echo(f"{counts['udp']} hosts were identified by their UDP 10001 discovery reply.\n")
+
+    if snmp:
+        screened = ', '.join(f"{snmp.counts[x]} {x}" for x in SCREEN_CATEGORIES)
+        echo(f"SNMP pre-screen: {screened}. {counts['snmp']} hosts were classified without a login.\n")
+
+    if inventory:
+        hits, misses, stale = inventory.stats
+        echo(f"Device inventory: {hits} hits, {misses} misses ({stale} stale).\n")
+
+    logins, failed_attempts = credentials.stats
+    echo(f"SSH logins: {logins}, rejected credential attempts: {failed_attempts}.\n")
+
+    if retry.tripped:
+        echo(f"Circuit breakers opened for {len(retry.tripped)} groups of radios that stopped answering: "
+                f"{', '.join(sorted(retry.tripped))}.\n")
+
+    return pipeline_summary(alive, counts['ssh_open'], devices, results)
@@ -0,0 +1,206 @@
+from collections import Counter
+from datetime import datetime, timezone
+import asyncio, json, os, sys, threading, time, traceback
+import click
+
+
+# the innermost frames kept of a blocking call's stack
+_STACK_DEPTH = 12
+
+# what the loop thread is in while it waits for the network, samples there count as idle
+_IDLE_FRAMES = {('selectors.py', 'select')}
+
+
+def _percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+
+def _frame_label(frame):
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def _collapsed(frame):
+    # 'outermost;...;innermost', the folded format flame graph tools read
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def _blocking_stack(frame):
+    return tuple(f"{os.path.basename(x.filename)}:{x.lineno} {x.name}: {x.line}"
+                    for x in traceback.extract_stack(frame, limit=_STACK_DEPTH))
+
+
+
+class LoopProfiler:
+    # watches the health of the event loop it is entered in. a task that wakes every `interval`
+    # measures how late it was woken (the loop lag) and keeps a heartbeat. a watchdog thread
+    # looks at the heartbeat, and when the loop hasn't come back to it for `threshold` seconds
+    # it takes the stack of whatever the loop thread is running, i.e. the call that blocks it.
+    # every second the in-flight count of each watched stage and the number of tasks are noted.
+    # with sampler the watchdog also samples the loop thread's stack every `sample_interval`,
+    # a statistical profile that doesn't slow the run down the way cProfile would.
+    # everything ends up in a JSON report at `path` with the same layout every run, so two can
+    # be compared
+
+    def __init__(self, path, threshold=0.1, sampler=False, interval=0.02, sample_interval=0.005):
+        self.path = path
+        self.threshold = threshold
+        self.sampler = sampler
+        self.interval = interval
+        self.sample_interval = sample_interval
+
+        self.lags = []
+        self.blocking = {}      # stack -> [times, total seconds, longest]
+        self.timeline = []
+        self.samples = Counter()
+        self._stages = []
+
+        self._heartbeat = 0.0
+        self._stall = None      # [heartbeat it started after, stack, stalled seconds when it started, until now]
+        self._stopping = threading.Event()
+        self._thread = self._tasks = None
+
+
+    def watch(self, limiters):
+        # the AdaptiveLimiters of the stages to chart, e.g. the pipeline's
+        self._stages.extend(limiters)
+
+
+    async def __aenter__(self):
+        self._started_wall, self._started = datetime.now(timezone.utc), time.monotonic()
+        self._heartbeat = self._started
+        loop_thread = threading.get_ident()
+        self._tasks = [asyncio.ensure_future(self._beat()), asyncio.ensure_future(self._chart())]
+        self._thread = threading.Thread(target=self._watch, args=(loop_thread,), name='loop watchdog', daemon=True)
+        self._thread.start()
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._stopping.set()
+        self._thread.join()
+        self._end_stall()
+
+        report = self.report()
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=2)
+        self._echo(report)
+
+
+    async def _beat(self):
+        while True:
+            start = self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - start - self.interval))
+
+
+    async def _chart(self):
+        while True:
+            await asyncio.sleep(1)
+            point = {'seconds': round(time.monotonic() - self._started, 1), 'tasks': len(asyncio.all_tasks())}
+            point.update((limiter.name, limiter.in_flight) for limiter in self._stages)
+            self.timeline.append(point)
+
+
+    def _watch(self, loop_thread):
+        # runs in the watchdog thread, the loop thread's frame is only looked at, never changed
+        tick = self.sample_interval if self.sampler else self.threshold / 4
+        while not self._stopping.wait(tick):
+            frame = sys._current_frames().get(loop_thread)
+            if frame is None:
+                continue
+            if self.sampler:
+                self.samples[_collapsed(frame)] += 1
+
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if self._stall and self._stall[0] != heartbeat:
+                self._end_stall()
+            if stalled < self.threshold:
+                continue
+
+            # callbacks that block one after the other in the same pass of the loop are each
+            # charged for their own part of the stall
+            stack = _blocking_stack(frame)
+            if self._stall is None:
+                self._stall = [heartbeat, stack, 0.0, stalled]
+            elif self._stall[1] != stack:
+                self._end_stall()
+                self._stall = [heartbeat, stack, stalled, stalled]
+            self._stall[3] = stalled
+
+
+    def _end_stall(self):
+        if self._stall is None:
+            return
+        _, stack, start, end = self._stall
+        self._stall, seconds = None, end - start
+        times, total, longest = self.blocking.get(stack, (0, 0.0, 0.0))
+        self.blocking[stack] = [times + 1, total + seconds, max(longest, seconds)]
+
+
+    def _profile(self):
+        busy = Counter({stack: n for stack, n in self.samples.items()
+                            if tuple(stack.rsplit(';', 1)[-1].split(':')) not in _IDLE_FRAMES})
+        own, inclusive = Counter(), Counter()
+        for stack, n in busy.items():
+            labels = stack.split(';')
+            own[labels[-1]] += n
+            for label in set(labels):
+                inclusive[label] += n
+
+        total = sum(self.samples.values())
+        return {'interval_ms': self.sample_interval * 1000, 'samples': total,
+                'busy_samples': sum(busy.values()),
+                'own': [{'function': x, 'samples': n} for x, n in own.most_common(30)],
+                'inclusive': [{'function': x, 'samples': n} for x, n in inclusive.most_common(30)],
+                'stacks': dict(busy.most_common(200))}
+
+
+    def report(self):
+        lags = sorted(self.lags)
+        blocking = sorted(self.blocking.items(), key=lambda x: -x[1][1])
+        peaks = {limiter.name: max((x.get(limiter.name, 0) for x in self.timeline), default=0)
+                    for limiter in self._stages}
+
+        return {
+            'started': self._started_wall.isoformat(timespec='seconds'),
+            'seconds': round(time.monotonic() - self._started, 3),
+            'threshold_ms': self.threshold * 1000,
+            'lag': {'samples': len(lags), 'p50_ms': round(_percentile(lags, 50) * 1000, 2),
+                    'p99_ms': round(_percentile(lags, 99) * 1000, 2),
+                    'max_ms': round(lags[-1] * 1000, 2) if lags else 0.0,
+                    'over_threshold': sum(x >= self.threshold for x in lags)},
+            'blocking': [{'times': times, 'total_ms': round(total * 1000, 1), 'longest_ms': round(longest * 1000, 1),
+                            'stack': list(stack)} for stack, (times, total, longest) in blocking],
+            'peak_in_flight': peaks,
+            'timeline': self.timeline,
+            'profile': self._profile() if self.sampler else None,
+        }
+
+
+    def _echo(self, report):
+        lag = report['lag']
+        click.echo(f"\nEvent loop lag: p50 {lag['p50_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms, "
+                    f"{lag['over_threshold']} of {lag['samples']} samples over {report['threshold_ms']:g} ms.")
+
+        if report['blocking']:
+            click.echo(f"Calls that blocked the loop for {report['threshold_ms']:g} ms or more:")
+            for x in report['blocking'][:5]:
+                click.echo(f"  {x['times']}x, {x['total_ms']} ms in all, longest {x['longest_ms']} ms: {x['stack'][-1]}")
+
+        if report['peak_in_flight']:
+            click.echo(f"Most in flight: {', '.join(f'{k} {v}' for k, v in report['peak_in_flight'].items())}.")
+
+        if report['profile']:
+            profile = report['profile']
+            click.echo(f"Busiest functions ({profile['busy_samples']} of {profile['samples']} samples busy): "
+                        + ', '.join(f"{x['function']} {x['samples']}" for x in profile['own'][:5]))
+
+        click.echo(f"Profile written to {self.path}")
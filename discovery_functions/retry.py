@@ -0,0 +1,181 @@
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+import asyncio, random, time
+import asyncssh
+
+
+# attempts includes the first try. the delay before retry n is base_delay * 2 ** (n - 1), at
+# most max_delay, with up to `jitter` of it taken off at random so hosts that failed together
+# don't all retry together
+retry_policy = namedtuple('retry_policy', ('attempts', 'base_delay', 'max_delay', 'jitter'), defaults=(1, 0, 0, 0.0) )
+
+POLICIES = {
+    # the second connect gets the longer connect_retry timeout instead of a delay
+    'port 22': retry_policy(attempts=2),
+    # a host that doesn't answer UDP 10001 is still identified over SSH, so it isn't asked twice
+    'udp discovery': retry_policy(attempts=1),
+    # neither is a host that doesn't answer SNMP, most radios have it turned off until they're cleaned up
+    'snmp screen': retry_policy(attempts=1),
+    # a radio that is still busy after its save gets one more restart
+    'restart': retry_policy(attempts=2, base_delay=30, max_delay=30, jitter=0.3),
+}
+
+# what counts against a breaker: the radio didn't answer in time or the session dropped.
+# a refused connection or a rejected password means the path to the radio is fine
+_UNREACHABLE = (asyncio.TimeoutError, TimeoutError, asyncssh.ConnectionLost)
+
+
+def backoff_delay(policy, attempt):
+    delay = min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1))
+    return delay * (1 - random.uniform(0, policy.jitter))
+
+
+async def with_retries(policy, operation, retry_on=_UNREACHABLE):
+    # operation(attempt) is tried as often as the policy allows while it raises one of retry_on
+    for attempt in range(1, policy.attempts + 1):
+        try:
+            return await operation(attempt)
+
+        except retry_on:
+            if attempt == policy.attempts:
+                raise
+
+        await asyncio.sleep(backoff_delay(policy, attempt))
+
+
+def _subnet(ip):
+    return ip.rsplit('.', 1)[0] + '.0/24'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+
+class CircuitBreaker:
+    # trips after `threshold` unreachable radios in a row in one group. while it is open calls
+    # for the group are turned away, once `cooldown` seconds have passed a single probe call is
+    # let through to find out whether the group is back
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.failures = self.trips = 0
+        self.open_until = 0.0
+        self.probing = False
+        # set when the probe call is done, for the calls waiting on its answer
+        self.probed = asyncio.Event()
+
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+
+    @property
+    def cooling_down(self):
+        return self.is_open and time.monotonic() < self.open_until
+
+
+    def admit(self):
+        # 'closed' to go ahead, 'probe' for the one call that tests an open breaker, None to stay out
+        if not self.is_open:
+            return 'closed'
+        if not self.probing and time.monotonic() >= self.open_until:
+            self.probing = True
+            self.probed.clear()
+            return 'probe'
+        return None
+
+
+    def release(self, admitted, timed_out, neutral):
+        # neutral outcomes say nothing about the group, an open breaker lets the next call probe
+        if admitted == 'probe':
+            self.probing = False
+            self.probed.set()
+
+        if neutral:
+            return
+
+        if not timed_out:
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.failures == self.threshold:
+            self.trips += 1
+        if self.is_open:
+            # a little jitter so the breakers of a whole site don't all probe at once
+            self.open_until = time.monotonic() + self.cooldown * random.uniform(1, 1.2)
+
+
+
+class RetryEngine:
+    # the retry policies and one circuit breaker per group of radios, shared by every stage of
+    # a run. groups are /24s unless group_of(ip) says otherwise, e.g. the AP a CPE hangs off.
+    # when a tower's backhaul drops its breaker opens after a few radios, and the rest of the
+    # tower fails straight away instead of each radio using up its whole timeout and a
+    # concurrency slot. work that shouldn't be given up on that easily waits for the group
+    # first, up to `defer` seconds
+
+    def __init__(self, threshold=5, cooldown=30, defer=60, policies=POLICIES, group_of=_subnet):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.defer = defer
+        self.policies = policies
+        self.group_of = group_of
+        self._breakers = {}
+
+
+    def breaker(self, ip):
+        group = self.group_of(ip)
+        if group not in self._breakers:
+            self._breakers[group] = CircuitBreaker(self.threshold, self.cooldown)
+        return self._breakers[group]
+
+
+    @property
+    def tripped(self):
+        # {group: times its breaker opened}
+        return {group: breaker.trips for group, breaker in self._breakers.items() if breaker.trips}
+
+
+    async def wait(self, ip, defer=None):
+        # waits out the cooldown of ip's group, for up to `defer` seconds (the engine's by default).
+        # meant for before a concurrency slot is taken, so waiting radios don't hold one
+        breaker = self.breaker(ip)
+        deadline = time.monotonic() + (self.defer if defer is None else defer)
+
+        while breaker.cooling_down and (now := time.monotonic()) < deadline:
+            await asyncio.sleep(min(breaker.open_until, deadline) - now)
+
+
+    @asynccontextmanager
+    async def guard(self, ip):
+        # raises CircuitOpenError if ip's group is cooling down, while another call probes the
+        # group this one waits for the answer. like AdaptiveLimiter.slot, callers that handle
+        # their own timeouts set outcome.timed_out and outcomes that say nothing about the path
+        # to the radio set outcome.neutral. like wait(), meant for before a concurrency slot is taken
+        breaker = self.breaker(ip)
+        while (admitted := breaker.admit()) is None and breaker.probing:
+            await breaker.probed.wait()
+
+        if admitted is None:
+            raise CircuitOpenError(f"{self.group_of(ip)} stopped answering, circuit breaker open")
+
+        outcome = SimpleNamespace(timed_out=False, neutral=False)
+        try:
+            yield outcome
+
+        except _UNREACHABLE:
+            outcome.timed_out = True
+            raise
+
+        except BaseException:
+            outcome.neutral = True
+            raise
+
+        finally:
+            breaker.release(admitted, outcome.timed_out, outcome.neutral)
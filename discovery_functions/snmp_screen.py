@@ -0,0 +1,288 @@
+from discovery_functions.device_table import ssh_succeed_namedtuple
+from discovery_functions.retry import POLICIES, with_retries
+from discovery_functions.concurrency import record_rtt
+from discovery_functions.timeouts import DEFAULT_TIMEOUTS
+from cleanup_functions.system_config import SNMP_SETTINGS
+from collections import Counter, namedtuple
+import asyncio, itertools, random, re, socket, time
+
+
+# SNMPv2c over UDP 161. one GetBulk per host asks for sysDescr, sysObjectID and sysName and the
+# first objects under the Ubiquiti enterprise tree, which is enough to tell an airMAX radio
+# (UBNT-AirMAX-MIB) from an airFiber (UBNT-AirFIBER-MIB) or a switch or router before any SSH
+# work. the messages are BER encoded here, only the handful of types an agent answers with
+SNMP_PORT = 161
+
+GET_BULK = 0xa5
+RESPONSE = 0xa2
+
+# what an agent puts in a varbind after the last object of its MIB
+END_OF_MIB_VIEW = object()
+
+_VERSION_2C = 1
+_INTEGER, _OCTET_STRING, _NULL, _OID, _SEQUENCE = 0x02, 0x04, 0x05, 0x06, 0x30
+_IP_ADDRESS = 0x40
+# Counter32, Gauge32, TimeTicks, Counter64
+_UNSIGNED = {0x41, 0x42, 0x43, 0x46}
+# noSuchObject, noSuchInstance, endOfMibView
+_EXCEPTIONS = {0x80: None, 0x81: None, 0x82: END_OF_MIB_VIEW}
+
+SYS_DESCR = (1, 3, 6, 1, 2, 1, 1, 1)
+SYS_OBJECT_ID = (1, 3, 6, 1, 2, 1, 1, 2)
+SYS_NAME = (1, 3, 6, 1, 2, 1, 1, 5)
+UBNT = (1, 3, 6, 1, 4, 1, 41112)
+UBNT_AIRFIBER = UBNT + (1, 3)
+UBNT_AIRMAX = UBNT + (1, 4)
+
+# EdgeSwitch and UniFi switches report the Broadcom FASTPATH tree, EdgeRouters and USGs the EdgeOS one
+_SWITCH_OBJECT_IDS = ((1, 3, 6, 1, 4, 1, 4413), UBNT + (1, 5))
+_SWITCH_DESCR = re.compile(r"EdgeSwitch|ToughSwitch|EdgeOS|EdgeRouter|UniFi|USG")
+
+# airMAX radio, airFiber, switch (or router) and unknown, which is every host that didn't
+# answer or didn't say enough
+SCREEN_CATEGORIES = ('radio', 'airfiber', 'switch', 'unknown')
+
+# name is the sysName, None if the host didn't give one
+screen_result = namedtuple('screen_result', ('ip', 'category', 'name') )
+
+# how many objects of the Ubiquiti tree are asked for, the first one already tells the MIBs apart
+_MAX_REPETITIONS = 4
+
+
+def _encode_length(length):
+    if length < 0x80:
+        return bytes((length,))
+    raw = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((0x80 | len(raw),)) + raw
+
+
+def _tlv(tag, value):
+    return bytes((tag,)) + _encode_length(len(value)) + value
+
+
+def _encode_int(x):
+    return _tlv(_INTEGER, x.to_bytes(x.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def _encode_oid(oid):
+    raw = bytearray((oid[0] * 40 + oid[1],))
+    for x in oid[2:]:
+        chunk = [x & 0x7f]
+        while x := x >> 7:
+            chunk.append(0x80 | x & 0x7f)
+        raw.extend(reversed(chunk))
+    return _tlv(_OID, bytes(raw))
+
+
+def _encode_value(value):
+    if value is None:
+        return _tlv(_NULL, b'')
+    if value is END_OF_MIB_VIEW:
+        return _tlv(0x82, b'')
+    if isinstance(value, int):
+        return _encode_int(value)
+    if isinstance(value, tuple):
+        return _encode_oid(value)
+    return _tlv(_OCTET_STRING, value.encode() if isinstance(value, str) else value)
+
+
+def encode_message(community, pdu_type, request_id, a, b, varbinds):
+    # a and b are non-repeaters and max-repetitions for GetBulk, error status and index otherwise.
+    # varbinds are (oid, value) pairs, value None for requests
+    varbinds = b''.join(_tlv(_SEQUENCE, _encode_oid(oid) + _encode_value(value)) for oid, value in varbinds)
+    pdu = _tlv(pdu_type, _encode_int(request_id) + _encode_int(a) + _encode_int(b) + _tlv(_SEQUENCE, varbinds))
+    return _tlv(_SEQUENCE, _encode_int(_VERSION_2C) + _tlv(_OCTET_STRING, community.encode()) + pdu)
+
+
+def _decode(data, offset=0):
+    # (tag, value, offset after it) of the TLV at offset
+    if offset + 2 > len(data):
+        raise ValueError('truncated')
+    tag, length = data[offset], data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    if offset + length > len(data):
+        raise ValueError('truncated')
+    return tag, data[offset:offset + length], offset + length
+
+
+def _decode_oid(raw):
+    if not raw:
+        raise ValueError('empty OID')
+    oid, x = [raw[0] // 40, raw[0] % 40], 0
+    for byte in raw[1:]:
+        x = x << 7 | byte & 0x7f
+        if not byte & 0x80:
+            oid.append(x)
+            x = 0
+    return tuple(oid)
+
+
+def _decode_value(tag, raw):
+    if tag == _INTEGER:
+        return int.from_bytes(raw, 'big', signed=True)
+    if tag in _UNSIGNED:
+        return int.from_bytes(raw, 'big')
+    if tag == _OID:
+        return _decode_oid(raw)
+    if tag == _IP_ADDRESS:
+        return '.'.join(str(x) for x in raw)
+    if tag == _NULL:
+        return None
+    if tag in _EXCEPTIONS:
+        return _EXCEPTIONS[tag]
+    return bytes(raw)
+
+
+def _children(raw):
+    # [(tag, value)] of the TLVs inside a constructed value
+    items, offset = [], 0
+    while offset < len(raw):
+        tag, value, offset = _decode(raw, offset)
+        items.append( (tag, value) )
+    return items
+
+
+def parse_message(data):
+    # (community, pdu type, request id, a, b, varbinds) of an SNMPv2c message, raises ValueError
+    # for anything else
+    try:
+        tag, message, _ = _decode(data)
+        (_, version), (_, community), (pdu_type, pdu) = _children(message)
+        if tag != _SEQUENCE or _decode_value(_INTEGER, version) != _VERSION_2C:
+            raise ValueError('not SNMPv2c')
+
+        (_, request_id), (_, a), (_, b), (_, varbinds) = _children(pdu)
+        pairs = []
+        for _, varbind in _children(varbinds):
+            (_, oid), (value_tag, value) = _children(varbind)
+            pairs.append( (_decode_oid(oid), _decode_value(value_tag, value)) )
+
+    except ValueError as e:
+        raise ValueError(f"not an SNMP message: {e}")
+
+    return (community.decode(errors='replace'), pdu_type, *(_decode_value(_INTEGER, x) for x in (request_id, a, b)),
+                pairs)
+
+
+def _text(value):
+    return value.decode(errors='replace') if isinstance(value, bytes) else None
+
+
+def classify(ip, varbinds):
+    # the screen_result for the varbinds of a GetBulk response
+    descr = object_id = name = None
+    subtrees = set()
+    for oid, value in varbinds:
+        if value is None or value is END_OF_MIB_VIEW:
+            continue
+        if oid[:len(SYS_DESCR)] == SYS_DESCR:
+            descr = _text(value)
+        elif oid[:len(SYS_OBJECT_ID)] == SYS_OBJECT_ID:
+            object_id = value if isinstance(value, tuple) else None
+        elif oid[:len(SYS_NAME)] == SYS_NAME:
+            name = _text(value) or None
+        elif oid[:len(UBNT_AIRMAX)] in (UBNT_AIRMAX, UBNT_AIRFIBER):
+            subtrees.add(oid[:len(UBNT_AIRMAX)])
+
+    if UBNT_AIRFIBER in subtrees or object_id and object_id[:len(UBNT_AIRFIBER)] == UBNT_AIRFIBER:
+        category = 'airfiber'
+    elif UBNT_AIRMAX in subtrees:
+        category = 'radio'
+    elif object_id and any(object_id[:len(x)] == x for x in _SWITCH_OBJECT_IDS) or descr and _SWITCH_DESCR.search(descr):
+        category = 'switch'
+    else:
+        category = 'unknown'
+
+    return screen_result(ip, category, name)
+
+
+def screen_to_result(screened):
+    # the ssh_succeed record for an airFiber or a switch, classify_radio files it the way it
+    # would have after a login. like a discovery reply, can_ssh only means the host answered
+    return ssh_succeed_namedtuple(screened.ip, False, True, False, screened.name, None, None, False, False, None,
+                                    screened.category == 'airfiber')
+
+
+
+class _ScreenProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, waiting):
+        self.waiting = waiting
+
+
+    def datagram_received(self, data, address):
+        try:
+            _, pdu_type, request_id, error_status, _, varbinds = parse_message(data)
+        except ValueError:
+            return
+
+        ip, future = self.waiting.get(request_id, (None, None))
+        # a late answer to an earlier request or one from another host is dropped
+        if pdu_type != RESPONSE or ip != address[0] or future.done():
+            return
+        future.set_result(None if error_status else varbinds)
+
+
+
+class SNMPScreen:
+    # sorts hosts into SCREEN_CATEGORIES with one GetBulk each, over one UDP socket shared by
+    # every query and matched up by request id, so thousands can be in flight at once. query()
+    # returns the host's screen_result, category 'unknown' if it didn't answer. requests wait
+    # the connect timeout, like the port 22 check
+
+    def __init__(self, community=SNMP_SETTINGS['snmp.community'], port=SNMP_PORT, policy=POLICIES['snmp screen']):
+        self.community = community
+        self.port = port
+        self.policy = policy
+        self.counts = Counter()
+
+        self._waiting = {}      # request id -> (ip, future of its response)
+        self._ids = itertools.count(random.randrange(1 << 30))
+        self._transport = None
+        self._opening = None
+
+
+    async def _open(self):
+        # the first queries all come in at once, they share one socket
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _ScreenProtocol(self._waiting), local_addr=('0.0.0.0', 0), family=socket.AF_INET))
+        self._transport, _ = await asyncio.shield(self._opening)
+
+
+    async def query(self, ip, timeouts=DEFAULT_TIMEOUTS):
+        await self._open()
+        request_id = next(self._ids) & 0x7fffffff
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = (ip, future)
+        request = encode_message(self.community, GET_BULK, request_id, 3, _MAX_REPETITIONS,
+                                    [(SYS_DESCR, None), (SYS_OBJECT_ID, None), (SYS_NAME, None), (UBNT, None)])
+
+        async def ask(attempt):
+            self._transport.sendto(request, (ip, self.port))
+            timeout = timeouts.connect if attempt == 1 else timeouts.connect_retry
+            start = time.monotonic()
+            answer = await asyncio.wait_for(asyncio.shield(future), timeout)
+            record_rtt(time.monotonic() - start)
+            return answer
+
+        try:
+            varbinds = await with_retries(self.policy, ask, asyncio.TimeoutError)
+        except asyncio.TimeoutError:
+            varbinds = None
+        finally:
+            del self._waiting[request_id]
+
+        screened = classify(ip, varbinds or ())
+        self.counts[screened.category] += 1
+        return screened
+
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+        self._transport = self._opening = None
@@ -0,0 +1,175 @@
+from discovery_functions.tracing import Tracer, TracedConnection
+from discovery_functions.concurrency import record_rtt
+from collections import OrderedDict, deque, namedtuple
+from contextlib import asynccontextmanager
+import asyncio, time
+import asyncssh
+
+
+# waits counts new connections that had to wait for a pooled one to be released
+pool_stats = namedtuple('pool_stats', ('hits', 'misses', 'evictions', 'open', 'waits') )
+_pooled_conn = namedtuple('pooled_conn', ('conn', 'username', 'password') )
+
+
+class SSHPool:
+    # keeps one SSH connection per IP open so the configure stage can reuse the
+    # session opened during radio discovery instead of doing a second handshake.
+    # at most max_size connections are open or being opened, once every one of them
+    # is in use a new connection waits until one is released
+
+    def __init__(self, max_size=1024, idle_timeout=120, keepalive_interval=15, keepalive_count_max=3, tracer=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count_max = keepalive_count_max
+        self.tracer = tracer or Tracer()
+
+        self.hits = self.misses = self.evictions = self.waits = 0
+        self._conns = OrderedDict()
+        self._last_used = {}
+        self._in_use = {}
+        self._locks = {}        # ip -> [lock, tasks holding or waiting for it]
+        self._opening = 0
+        self._waiters = deque() # futures of new connections waiting for room
+        self._reaper = None
+
+
+    @property
+    def stats(self):
+        return pool_stats(self.hits, self.misses, self.evictions, len(self._conns), self.waits)
+
+
+    def _start_reaper(self):
+        if self._reaper is None and self.idle_timeout:
+            self._reaper = asyncio.ensure_future(self._reap_idle())
+
+
+    async def _reap_idle(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 1))
+            now = time.monotonic()
+            idle = [ip for ip in self._conns
+                        if not self._in_use.get(ip) and now - self._last_used[ip] > self.idle_timeout]
+            for ip in idle:
+                self.evictions += 1
+                self.discard(ip)
+
+
+    def _evict_lru(self):
+        # oldest connections that nobody is currently using are dropped first
+        for ip in list(self._conns):
+            if len(self._conns) < self.max_size:
+                return
+            if not self._in_use.get(ip):
+                self.evictions += 1
+                self.discard(ip)
+
+
+    async def _make_room(self):
+        # idle connections are evicted to make room, when every one is in use this waits
+        # for one to be released or dropped and looks again
+        waited = False
+        while True:
+            self._evict_lru()
+            if len(self._conns) + self._opening < self.max_size:
+                self.waits += waited
+                return
+
+            waited = True
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+
+    def _wake_waiters(self):
+        waiting, self._waiters = self._waiters, deque()
+        for waiter in waiting:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+    def discard(self, ip):
+        pooled = self._conns.pop(ip, None)
+        self._last_used.pop(ip, None)
+        if pooled:
+            pooled.conn.close()
+            self._wake_waiters()
+
+
+    async def _get(self, ip, username, password, timeout):
+        pooled = self._conns.get(ip)
+
+        if pooled and not pooled.conn.is_closed() and pooled[1:] == (username, password):
+            self.hits += 1
+            self._conns.move_to_end(ip)
+            return pooled.conn, False
+
+        self.misses += 1
+        self.discard(ip)
+        await self._make_room()
+        self._start_reaper()
+
+        start = time.monotonic()
+        # the slot is taken for the whole handshake, so opens running at once can't overshoot max_size
+        self._opening += 1
+        try:
+            with self.tracer.span('handshake', ip):
+                conn = await asyncssh.connect(host=ip, username=username, password=password, known_hosts=None,
+                                                keepalive_interval=self.keepalive_interval,
+                                                keepalive_count_max=self.keepalive_count_max,
+                                                connect_timeout=timeout)
+        except BaseException:
+            self._opening -= 1
+            self._wake_waiters()
+            raise
+
+        self._opening -= 1
+        record_rtt(time.monotonic() - start)
+        self._conns[ip] = _pooled_conn(conn, username, password)
+        return conn, True
+
+
+    @asynccontextmanager
+    async def connection(self, ip, username, password, timeout=None):
+        # the lock only lives while someone is getting a connection to ip, a sweep over a big
+        # scope would otherwise leave one behind for every host it touched
+        entry = self._locks.setdefault(ip, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                conn, opened = await self._get(ip, username, password, timeout)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[ip]
+
+        self._in_use[ip] = self._in_use.get(ip, 0) + 1
+        try:
+            yield TracedConnection(conn, self.tracer, ip, opened)
+
+        except (asyncssh.DisconnectError, ConnectionError):
+            self.discard(ip)
+            raise
+
+        finally:
+            self._in_use[ip] -= 1
+            if not self._in_use[ip]:
+                del self._in_use[ip]
+                # it can be evicted now
+                self._wake_waiters()
+            if ip in self._conns:
+                self._last_used[ip] = time.monotonic()
+
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+
+        conns = [pooled.conn for pooled in self._conns.values()]
+        self._conns.clear()
+        self._last_used.clear()
+
+        for conn in conns:
+            conn.close()
+        await asyncio.gather(*(conn.wait_closed() for conn in conns), return_exceptions=True)
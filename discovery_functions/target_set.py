@@ -0,0 +1,185 @@
+from array import array
+from bisect import bisect_right
+from heapq import merge
+from ipaddress import IPv4Address, IPv4Network
+import itertools
+
+
+def int_to_ip(x):
+    return f"{x >> 24}.{x >> 16 & 255}.{x >> 8 & 255}.{x & 255}"
+
+
+def _count_last_octet(start, end, last_octet):
+    # how many addresses in [start, end] end in .<last_octet>
+    return (end - last_octet) // 256 - (start - 1 - last_octet) // 256
+
+
+def _interval_len(start, end):
+    # addresses in [start, end] that are handed out, i.e. not ending in .0 or .1
+    return end - start + 1 - _count_last_octet(start, end, 0) - _count_last_octet(start, end, 1)
+
+
+def _parse_octet_range(octet):
+    bounds = tuple(map(int, octet.split('-')))
+    if len(bounds) > 2 or any(not 0 <= x <= 255 for x in bounds):
+        raise ValueError(octet)
+    return min(bounds), max(bounds)
+
+
+def _range_intervals(octet_ranges):
+    # trailing octets that cover 0-255 form one contiguous block together with the
+    # octet in front of them, so 10.0-3.0-255.0-255 is a single interval, not 1024.
+    # a last octet that stops short leaves a gap in every /24: 10.0-255.0-255.0-254 is
+    # 65,536 intervals of two 4 byte ints each, still far less than 16.7 million strings
+    contiguous = 3
+    while contiguous > 0 and octet_ranges[contiguous] == (0, 255):
+        contiguous -= 1
+
+    shift = 8 * (3 - contiguous)
+    lo, hi = octet_ranges[contiguous]
+    leading = (range(a, b + 1) for a, b in octet_ranges[:contiguous])
+
+    for prefix in itertools.product(*leading):
+        base = 0
+        for octet in prefix:
+            base = base << 8 | octet
+        base <<= 8 * (4 - contiguous)
+        yield base | lo << shift, base | hi << shift | (1 << shift) - 1
+
+
+def _network_intervals(first_3_ranges, last_octet):
+    for prefix in itertools.product(*(range(a, b + 1) for a, b in first_3_ranges)):
+        network = IPv4Network('.'.join((*map(str, prefix), last_octet)), strict=False)
+        yield int(network.network_address), int(network.broadcast_address)
+
+
+def parse_scope(scope):
+    # returns a generator of (start, end) intervals sorted by start. the scope is fully
+    # validated here, so a ValueError is raised before any address is expanded
+    octets = scope.split('.')
+    first_3_octets = octets[:3]
+
+    if len(octets) != 4 or any('/' in x for x in first_3_octets):
+        raise ValueError(scope)
+
+    elif all(x in scope for x in ('-', '/') ):
+        first_3_ranges = [_parse_octet_range(x) for x in first_3_octets]
+        last_network = IPv4Network(f"0.0.0.{octets[3]}", strict=False)
+
+        if last_network.prefixlen >= 24:
+            last_range = (int(last_network.network_address), int(last_network.broadcast_address))
+            return _range_intervals((*first_3_ranges, last_range))
+        return _network_intervals(first_3_ranges, octets[3])
+
+    elif '-' in scope:
+        return _range_intervals([_parse_octet_range(x) for x in octets])
+
+    elif '/' in octets[-1]:
+        network = IPv4Network(scope, strict=False)
+        return iter(( (int(network.network_address), int(network.broadcast_address)), ))
+
+    elif octets[-1] not in ('0', '1'):
+        address = int(IPv4Address(scope))
+        return iter(( (address, address), ))
+
+    raise ValueError(scope)
+
+
+class TargetSet:
+    # sorted, merged, inclusive integer intervals of IPv4 addresses. addresses ending
+    # in .0 or .1 are never handed out, they are skipped while iterating
+
+    def __init__(self, intervals=()):
+        self._starts = array('I')
+        self._ends = array('I')
+
+        for start, end in merge(*intervals):
+            if self._ends and start <= self._ends[-1] + 1:
+                self._ends[-1] = max(self._ends[-1], end)
+            else:
+                self._starts.append(start)
+                self._ends.append(end)
+
+
+    @classmethod
+    def from_scopes(cls, scopes):
+        return cls(parse_scope(scope.strip()) for scope in scopes)
+
+
+    def intervals(self):
+        return zip(self._starts, self._ends)
+
+
+    def difference(self, other):
+        return TargetSet( (self._subtract(other),) )
+
+
+    def _subtract(self, other):
+        excluded = list(other.intervals())
+        i = 0
+        for start, end in self.intervals():
+            while i < len(excluded) and excluded[i][1] < start:
+                i += 1
+            j = i
+            while start <= end and j < len(excluded) and excluded[j][0] <= end:
+                ex_start, ex_end = excluded[j]
+                if ex_start > start:
+                    yield start, ex_start - 1
+                start = max(start, ex_end + 1)
+                j += 1
+            if start <= end:
+                yield start, end
+
+
+    def _subnet_intervals(self):
+        # every interval cut at /24 boundaries
+        for start, end in self.intervals():
+            while start <= end:
+                subnet_end = min(end, start | 255)
+                yield start, subnet_end
+                start = subnet_end + 1
+
+
+    def split(self, parts):
+        # about equal sized target sets that never split a /24 between them, so the per /24
+        # limits and restart waves still see a whole subnet. empty parts are left out
+        total = len(self)
+        shards, current, size = [], [], 0
+
+        for start, end in self._subnet_intervals():
+            current.append( (start, end) )
+            size += _interval_len(start, end)
+            if size >= total * (len(shards) + 1) / parts and len(shards) < parts - 1:
+                shards.append(TargetSet( (current,) ))
+                current = []
+
+        if current:
+            shards.append(TargetSet( (current,) ))
+        return [x for x in shards if x]
+
+
+    def scopes(self):
+        # the same addresses as scope strings parse_scope understands, one per /24
+        for start, end in self._subnet_intervals():
+            yield f"{int_to_ip(start)}-{end & 255}"
+
+
+    def __len__(self):
+        return sum(_interval_len(start, end) for start, end in self.intervals())
+
+
+    def __bool__(self):
+        return any(True for _ in self)
+
+
+    def __contains__(self, ip):
+        x = int(IPv4Address(ip)) if isinstance(ip, str) else ip
+        i = bisect_right(self._starts, x) - 1
+        return i >= 0 and x <= self._ends[i] and x & 255 > 1
+
+
+    def __iter__(self):
+        for start, end in self.intervals():
+            for x in range(start, end + 1):
+                if x & 255 > 1:
+                    yield int_to_ip(x)
@@ -0,0 +1,43 @@
+from collections import namedtuple
+
+
+# what the pipeline passes from stage to stage for each host, rtt is the smoothed round trip in seconds
+host_record = namedtuple('host', ('ip', 'rtt') )
+
+host_timeouts = namedtuple('host_timeouts', ('connect', 'connect_retry', 'login', 'command', 'cfg', 'save',
+                                                'restart') )
+
+# the fixed timeouts from before RTTs were kept, still used for hosts whose RTT isn't known.
+# login None leaves the SSH handshake without a timeout of its own
+DEFAULT_TIMEOUTS = host_timeouts(connect=1.5, connect_retry=8, login=None, command=7, cfg=15, save=20, restart=15)
+
+
+def smooth_rtt(srtt, sample, alpha=0.25):
+    # a host only gets a handful of samples (ping reply, TCP connect), so each one counts for a quarter
+    if srtt is None:
+        return sample
+    return (1 - alpha) * srtt + alpha * sample
+
+
+def _clamp(value, floor, ceiling):
+    return max(floor, min(ceiling, value))
+
+
+def timeouts_for(rtt):
+    # an allowance for the work done on the radio plus a multiple of the host's smoothed RTT.
+    # the floors keep a lucky fast ping from cutting a slow radio short, the ceilings stop a
+    # single bad sample from turning into a minute long wait
+    if rtt is None:
+        return DEFAULT_TIMEOUTS
+
+    return host_timeouts(
+        connect=_clamp(4 * rtt, 0.25, 1.5),
+        connect_retry=_clamp(16 * rtt, 1, 8),
+        # key exchange and auth are a few round trips plus the radio's crypto
+        login=_clamp(2 + 12 * rtt, 4, 30),
+        command=_clamp(3 + 8 * rtt, 3, 14),
+        cfg=_clamp(3 + 8 * rtt, 3, 30),
+        # save writes flash, which takes a while on older radios whatever the link is like
+        save=_clamp(8 + 8 * rtt, 8, 40),
+        restart=_clamp(8 + 8 * rtt, 8, 30),
+    )
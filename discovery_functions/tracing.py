@@ -0,0 +1,150 @@
+from bisect import bisect_right
+from contextlib import contextmanager
+from types import SimpleNamespace
+import json, random, time
+import click
+
+
+# upper edges of the histogram buckets, in seconds. anything slower goes in the last bucket
+_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+_BUCKET_LABELS = ('<10ms', '<50ms', '<100ms', '<500ms', '<1s', '<5s', '<10s', '<30s', '>=30s')
+# durations kept per stage for the p50 and p99, a uniform sample once a stage has more spans
+_SAMPLE_SIZE = 1024
+
+
+def _command_label(command):
+    # 'cat > /tmp/system.cfg.new && mv ...' -> 'cat > /tmp/system.cfg.new', 'mca-status | head' -> 'mca-status'
+    return command.split('&&')[0].split('|')[0].strip()
+
+
+def _record(durations, duration):
+    # count, bucket and reservoir sample one span of a stage
+    durations[0] += 1
+    durations[1][bisect_right(_BUCKETS, duration)] += 1
+    sample = durations[2]
+    if len(sample) < _SAMPLE_SIZE:
+        sample.append(duration)
+    else:
+        i = random.randrange(durations[0])
+        if i < _SAMPLE_SIZE:
+            sample[i] = duration
+
+
+class Tracer:
+    # timing spans for each device in each stage (ping, port 22, handshake, login, identify,
+    # configure, restart, recovery) and for every remote command. each span is one JSON line
+    # in `path` if one is given. for the end of run histograms each stage keeps its span count,
+    # bucket counts and a sample of at most _SAMPLE_SIZE durations, however many hosts there are,
+    # unless keep_durations is False, e.g. when no histograms will be shown
+
+    def __init__(self, path=None, keep_durations=True):
+        self.path = path
+        self.keep_durations = keep_durations
+        self._file = open(path, 'a', buffering=1) if path else None
+        self._durations = {}
+
+
+    def add(self, stage, ip, duration, start=None, **attrs):
+        # for spans that were timed somewhere else, e.g. a ping's round trip
+        if self.keep_durations:
+            _record(self._durations.setdefault(stage, [0, [0] * len(_BUCKET_LABELS), []]), duration)
+
+        if self._file:
+            span = {'stage': stage, 'ip': ip, 'start': round(start or time.time() - duration, 6),
+                    'duration': round(duration, 6), **attrs}
+            self._file.write(json.dumps(span, default=str) + '\n')
+
+
+    @contextmanager
+    def span(self, stage, ip=None, **attrs):
+        # the caller sets span.outcome and anything else it knows about on the yielded span,
+        # an exception leaving the block becomes the outcome
+        span = SimpleNamespace(outcome='ok', **attrs)
+        start_wall, start = time.time(), time.monotonic()
+
+        try:
+            yield span
+
+        except BaseException as e:
+            span.outcome = type(e).__name__
+            raise
+
+        finally:
+            self.add(stage, ip, time.monotonic() - start, start_wall, **vars(span))
+
+
+    @property
+    def durations(self):
+        # {stage: [count, bucket counts, sample]}, small enough to send back from a worker process
+        return self._durations
+
+
+    def merge(self, durations):
+        # durations of another tracer, e.g. one in a worker process, for the combined histograms
+        for stage, (count, buckets, sample) in durations.items():
+            if stage not in self._durations:
+                self._durations[stage] = [count, list(buckets), list(sample)]
+                continue
+
+            mine = self._durations[stage]
+            total = mine[0] + count
+            # each side keeps a share of the sample in proportion to how many spans it stands for
+            kept = min(len(sample), round(_SAMPLE_SIZE * count / total))
+            mine[2] = random.sample(mine[2], min(len(mine[2]), _SAMPLE_SIZE - kept)) + random.sample(sample, kept)
+            mine[0] = total
+            mine[1] = [x + y for x, y in zip(mine[1], buckets)]
+
+
+    def histograms(self):
+        # {stage: (count, p50, p99, bucket counts)}, the percentiles are exact up to _SAMPLE_SIZE spans
+        histograms = {}
+        for stage, (count, buckets, sample) in self._durations.items():
+            ordered = sorted(sample)
+            histograms[stage] = (count, ordered[len(ordered) // 2],
+                                    ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], buckets)
+        return histograms
+
+
+    def report(self):
+        histograms = self.histograms()
+        if not histograms:
+            return
+
+        click.echo(f"\nLatency by stage:\n{'stage':<32}{'count':>7}{'p50 ms':>10}{'p99 ms':>10} "
+                    + ''.join(f"{x:>8}" for x in _BUCKET_LABELS))
+        for stage, (count, p50, p99, buckets) in histograms.items():
+            click.echo(f"{stage:<32}{count:>7}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f} "
+                        + ''.join(f"{x:>8}" for x in buckets))
+
+        if self.path:
+            click.echo(f"\nTrace written to {self.path}")
+
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+
+class TracedConnection:
+    # a pooled SSH connection whose run() calls are recorded as 'run <command>' spans,
+    # everything else is passed through to the connection. opened is True when the pool
+    # had to log in for it, False when it was reused
+
+    def __init__(self, conn, tracer, ip, opened=False):
+        self._conn = conn
+        self._tracer = tracer
+        self._ip = ip
+        self.opened = opened
+
+
+    async def run(self, command, *args, **kwargs):
+        with self._tracer.span(f"run {_command_label(command)}", self._ip) as span:
+            result = await self._conn.run(command, *args, **kwargs)
+            span.exit_status = result.exit_status
+            return result
+
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
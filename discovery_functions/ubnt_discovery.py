@@ -0,0 +1,136 @@
+from discovery_functions.check_radio_ssh import _fix_firmware_format
+from discovery_functions.device_table import ssh_succeed_namedtuple
+from discovery_functions.retry import POLICIES, with_retries
+from discovery_functions.concurrency import record_rtt
+from discovery_functions.timeouts import DEFAULT_TIMEOUTS
+import asyncio, re, socket, struct, time
+
+
+# the Ubiquiti discovery protocol: a 4 byte version 1 request to UDP 10001 gets one datagram back
+# with the MAC, name, firmware and model as TLVs (type byte, 2 byte length, value), so a device
+# can be identified with one packet instead of an SSH login and mca-status
+DISCOVERY_PORT = 10001
+DISCOVERY_REQUEST = b'\x01\x00\x00\x00'
+
+_TLV_MAC = 0x01
+_TLV_MAC_IP = 0x02
+_TLV_FIRMWARE = 0x03
+_TLV_HOSTNAME = 0x0b
+_TLV_PLATFORM = 0x0c
+_TLV_MODEL = 0x14
+
+# the firmwareVersion part of the radio check in get_radio_discovery_arguments
+_RADIO_FIRMWARE = re.compile("2?[WX][ACMW]")
+_ROCKET = re.compile("Rocket.*")
+_LEGACY_TYPES = {'XM', 'XW'}
+
+
+def _format_mac(raw):
+    return ':'.join(f"{x:02X}" for x in raw)
+
+
+def parse_reply(data):
+    # {tlv type: value} of a version 1 reply, raises ValueError for anything else
+    if len(data) < 4 or data[0] != 1 or data[1] != 0:
+        raise ValueError('not a discovery reply')
+
+    end = min(len(data), 4 + struct.unpack('!H', data[2:4])[0])
+    fields, offset = {}, 4
+    while offset + 3 <= end:
+        kind, length = data[offset], struct.unpack('!H', data[offset + 1:offset + 3])[0]
+        # a datagram cut short keeps the fields that came in whole
+        if offset + 3 + length > end:
+            break
+        fields.setdefault(kind, data[offset + 3:offset + 3 + length])
+        offset += 3 + length
+
+    return fields
+
+
+def reply_to_result(ip, fields):
+    # the ssh_succeed record _radio_discovery would have made from mca-status. a login hasn't
+    # been tried, so can_ssh only means the device answered and altpass is left False
+    raw_firmware = fields.get(_TLV_FIRMWARE, b'').decode(errors='replace')
+    platform = (fields.get(_TLV_MODEL) or fields.get(_TLV_PLATFORM) or b'').decode(errors='replace')
+    mac = fields.get(_TLV_MAC) or fields.get(_TLV_MAC_IP, b'')[:6]
+
+    is_valid_radio = bool(_RADIO_FIRMWARE.match(raw_firmware))
+    firmware_version = _fix_firmware_format(raw_firmware) if raw_firmware else None
+    is_legacy = firmware_version.split('.', 1)[0] in _LEGACY_TYPES if is_valid_radio else None
+
+    return ssh_succeed_namedtuple(ip, False, True, is_valid_radio,
+                                    fields.get(_TLV_HOSTNAME, b'').decode(errors='replace') or None,
+                                    firmware_version, _format_mac(mac) if mac else None,
+                                    is_valid_radio and 'AirRouter' in platform,
+                                    is_valid_radio and bool(_ROCKET.match(platform)), is_legacy,
+                                    raw_firmware.startswith('AF') or 'airFiber' in platform)
+
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, waiting):
+        self.waiting = waiting
+
+
+    def datagram_received(self, data, address):
+        future = self.waiting.get(address[0])
+        if future is None or future.done():
+            return
+        try:
+            future.set_result(parse_reply(data))
+        except ValueError:
+            # something else on 10001, keep waiting for the real answer
+            pass
+
+
+
+class UBNTDiscovery:
+    # asks hosts for their discovery reply over one UDP socket shared by every query.
+    # query() returns the host's ssh_succeed record, or None if it didn't answer. like the
+    # port 22 check the first request waits the connect timeout and any retry connect_retry
+
+    def __init__(self, policy=POLICIES['udp discovery']):
+        self.policy = policy
+        self.replies = 0
+
+        self._waiting = {}      # ip -> future of its reply
+        self._transport = None
+        self._opening = None
+
+
+    async def _open(self):
+        # the first queries all come in at once, they share one socket
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _DiscoveryProtocol(self._waiting), local_addr=('0.0.0.0', 0), family=socket.AF_INET))
+        self._transport, _ = await asyncio.shield(self._opening)
+
+
+    async def query(self, ip, timeouts=DEFAULT_TIMEOUTS):
+        await self._open()
+        future = self._waiting[ip] = asyncio.get_running_loop().create_future()
+
+        async def ask(attempt):
+            self._transport.sendto(DISCOVERY_REQUEST, (ip, DISCOVERY_PORT))
+            timeout = timeouts.connect if attempt == 1 else timeouts.connect_retry
+            start = time.monotonic()
+            answer = await asyncio.wait_for(asyncio.shield(future), timeout)
+            record_rtt(time.monotonic() - start)
+            return answer
+
+        try:
+            fields = await with_retries(self.policy, ask, asyncio.TimeoutError)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            del self._waiting[ip]
+
+        self.replies += 1
+        return reply_to_result(ip, fields)
+
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+        self._transport = self._opening = None
@@ -0,0 +1,56 @@
+from api import Session, concurrency
+from cleanup_functions.job_server import JobServer
+from discovery_functions.inventory import DeviceInventory, DEFAULT_INVENTORY_PATH
+from contextlib import closing
+import asyncio
+import click
+
+CONTEXT_SETTINGS = {'help_option_names':('-h', '--help')}
+
+command_help = ("Keeps the event loop, SSH connections and device inventory warm and runs discovery and cleanup jobs handed to it over a Unix socket and/or localhost HTTP, streaming each job's results back as JSON lines. Jobs run side by side and share one set of concurrency limits.\n\n"
+                "Examples: \n\n"
+                "cleanup_daemon.exe --socket /run/fwb-cleanup.sock --http 7710\n\n"
+                "echo '{\"type\": \"cleanup\", \"targets\": [\"10.0.40.0/29\"], \"dry_run\": true}' | socat - UNIX-CONNECT:/run/fwb-cleanup.sock\n\n"
+                "curl -N -d '{\"targets\": [\"10.0.40.0/29\"]}' http://127.0.0.1:7710/cleanup")
+
+socket_path_help = ("-"*43 + "\nTake jobs on this Unix socket, one JSON object per line. Only the user running the daemon can connect.")
+
+http_port_help = ("-"*43 + "\nTake jobs over HTTP on this port on 127.0.0.1: POST /discover, POST /cleanup, GET /status.")
+
+max_jobs_help = ("-"*43 + "\nMaximum number of jobs that run at once, the rest wait their turn.")
+
+ping_rate_help = ("-"*43 + "\nMaximum ICMP echo requests per second for each job's ping sweep.")
+
+inventory_help = ("-"*43 + "\nSQLite file the daemon keeps its device inventory in.")
+
+inventory_ttl_help = ("-"*43 + "\nHours an inventory record is trusted before the device is identified again.")
+
+token_help = ("-"*43 + "\nShared secret every job has to carry, as \"token\" on the socket or as an \"Authorization: Bearer\" header over HTTP.")
+
+@click.command(help=command_help, context_settings=CONTEXT_SETTINGS, options_metavar='[options]')
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False), metavar='<path>', help=socket_path_help)
+@click.option('--http', 'http_port', type=click.IntRange(1, 65535), metavar='<port>', help=http_port_help)
+@click.option('--max-jobs', type=click.IntRange(min=1), default=8, show_default=True, help=max_jobs_help)
+@click.option('--ping-rate', type=click.IntRange(min=1), default=2000, show_default=True, metavar='<pps>', help=ping_rate_help)
+@click.option('--inventory', type=click.Path(dir_okay=False), default=str(DEFAULT_INVENTORY_PATH), show_default=True, help=inventory_help)
+@click.option('--inventory-ttl', type=click.FloatRange(min=0), default=24, show_default=True, metavar='<hours>', help=inventory_ttl_help)
+@click.option('--token', envvar='FWB_CLEANUP_TOKEN', help=token_help)
+def run_daemon(socket_path, http_port, max_jobs, ping_rate, inventory, inventory_ttl, token):
+
+    if not socket_path and not http_port:
+        raise click.UsageError('Give --socket, --http or both.')
+
+    async def serve():
+        async with Session(device_inventory, concurrency(ping_rate=ping_rate)) as session:
+            await JobServer(session, max_jobs, token).serve(socket_path, http_port)
+
+    with closing(DeviceInventory(inventory, ttl=inventory_ttl * 3600)) as device_inventory:
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            click.echo('\nStopped.')
+
+
+
+if __name__ == '__main__':
+    run_daemon()
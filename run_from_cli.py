@@ -1,4 +1,5 @@
 from device_cleanup import device_cleanup
+from discovery_functions.inventory import DEFAULT_INVENTORY_PATH
 from collections import namedtuple
 import click
 
@@ -11,10 +12,27 @@ command_help = ("This tool is designed for use on Ubiquiti airMAX equipment for
                 "Examples: \n\n"
                 "cleanup_radios.exe -o --no-wds --no-snmp --no-ntp 10.8.85.0/26\n\n"
                 "cleanup_radios.exe --no-ts 9-10.7-8.10-20.0-123\n\n"
-                "cleanup_radios.exe -vv -m ping-only 10.7.76-79.0/24 10.7.176-179.0/24")
+                "cleanup_radios.exe -vv -m ping-only 10.7.76-79.0/24 10.7.176-179.0/24\n\n"
+                "cleanup_radios.exe -x 10.7.77.0/24 -x 10.7.78.5 10.7.76-79.0/24")
+
+exclude_help = ("-"*43 + "\nIPv4 address or network to leave out of the scan, in the same CIDR or range notation as the networks. Can be used multiple times.")
 
 mode_help = ("-"*43 + "\nChange the mode of the script. default is to make configuration changes. ping-only & ssh-check-only are good for testing connectivity to radios. Even with the configuration flags set to True, the configuration will not run unless in 'configure' mode.")
 
+ping_rate_help = ("-"*43 + "\nMaximum number of ping packets sent per second. Lower this on congested links so large sweeps don't lose replies.")
+
+ping_attempts_help = ("-"*43 + "\nNumber of pings sent to a host before it is considered down. The wait before each retry is based on the response times seen during the sweep.")
+
+inventory_help = ("-"*43 + "\nSQLite file that stores what was found on each IP (MAC, name, firmware, platform, credentials), so known devices aren't logged in to again just to identify them.")
+
+inventory_ttl_help = ("-"*43 + "\nHours an inventory entry is trusted before the device is identified again.")
+
+udp_discovery_help = ("-"*43 + "\nAsk every host that answers ping for its Ubiquiti discovery reply on UDP 10001 first. Hosts that answer are identified from the reply (MAC, name, firmware, model) without an SSH login, so airFiber, switches and airCubes are sorted out up front and radios are only logged in to when they are configured. Hosts that don't answer are identified over SSH as usual.")
+
+snmp_screen_help = ("-"*43 + "\nScreen every host that answers ping with one SNMP GetBulk (sysDescr, sysObjectID and the Ubiquiti MIB, using the FWB community) before port 22 is checked. airFiber, switches and routers are sorted out without an SSH login, only airMAX radios and hosts that don't answer SNMP are identified over SSH. Runs after --udp-discovery when both are set.")
+
+refresh_help = ("-"*43 + "\nIgnore the stored inventory and identify every device again. The inventory is updated with the new results.")
+
 wds_help = ("-"*43 + "\nEnable/Disable the script's WDS configuration. When flag is True, this will turn WDS on for all radios that are confiured, except airRouters. On an airRouter, the script will turn WDS off.")
 
 snmp_help = ("-"*43 + "\nEnable/Disable the script's SNMP configuration. When flag is True, this will ensure that SNMP is enabled as well as set FWB for the location, contact, community fields if it is not set to FWB already.")
@@ -27,28 +45,89 @@ timezone_help = ("-"*43 + "\nEnable/Disable the script's timezone configuration.
 
 ff_reporting_mode_help = ("-"*43 + "\nEnable/Disable the script's fixed frame capacity reporting mode configuration. When flag is True, this will ensure that the fixed frame capacity reporting mode is set to DL/UL split based. Rocket AC's should be the only types of equipment that have this setting. DL/UL split based show more accurate throughput values on the dashboard on the radio when fixed frame timing allocations are in use.")
 
+canary_size_help = ("-"*43 + "\nNumber of radios restarted first as a canary wave. The rest are only restarted once the canaries are back online.")
+
+canary_threshold_help = ("-"*43 + "\nFraction of canary radios that may stay offline before the remaining restarts are called off. Radios that are not restarted keep their saved configuration.")
+
+workers_help = ("-"*43 + "\nSplit the scope into this many parts along /24 boundaries and clean each up in its own process, so SSH handshakes and crypto use more than one core. The ping rate and the canary wave are shared out between the workers. Only used in 'configure' mode.")
+
+coordinate_help = ("-"*43 + "\nRun as a coordinator instead of cleaning up from this host: listen on <host:port> or unix:<path> and hand the scope out in work units to worker agents (run_worker.py) that connect to it. Units from a worker that dies are given to another one. Only used in 'configure' mode.")
+
+unit_size_help = ("-"*43 + "\nNumber of /24s in each work unit handed out by --coordinate.")
+
+token_help = ("-"*43 + "\nShared secret worker agents have to present to the coordinator.")
+
+dry_run_help = ("-"*43 + "\nLog in to every radio and report the configuration changes that would be made, without changing, saving or restarting anything. Only used in 'configure' mode.")
+
+trace_help = ("-"*43 + "\nWrite a timing span for every device in every stage (ping, port 22, SSH login, identification, each remote command, configure, restart and recovery) to this file as JSON lines, and print latency histograms per stage at the end of the run. Histograms are also printed in verbose mode.")
+
+profile_help = ("-"*43 + "\nWatch the event loop while the tool runs and write a JSON report to this file: how late the loop gets to its work (lag percentiles), the stack of every call that blocks it for longer than --profile-threshold, and how many operations each stage has in flight second by second. Reports from two runs have the same layout and can be compared. Only used in single process 'configure' and 'ssh-check-only' runs.")
+
+profile_threshold_help = ("-"*43 + "\nHow long a call has to block the event loop before --profile records its stack.")
+
+profile_sampler_help = ("-"*43 + "\nAlso sample the event loop's stack every 5 ms while profiling and add the busiest functions and stacks (in the folded format flame graph tools read) to the --profile report.")
+
+journal_help = ("-"*43 + "\nRecord every device's progress through the configure run in this file, so that an interrupted run can be picked up again with --resume.")
+
+resume_help = ("-"*43 + "\nCarry on with the configure run recorded in this journal: devices that are done are reported, the rest continue from the step they stopped at and whatever hadn't been swept yet is swept. The networks and options come from the journal.")
+
+results_help = ("-"*43 + "\nWrite every device's outcome to this file as soon as it is known: CSV if the name ends in .csv, JSON lines otherwise, '-' for JSON lines on stdout. Can be given more than once. The console report only lists the first 100 hosts of each outcome.")
+
 show_options_help = ("-"*43 + "\nPrint out all of the options as they are set before the tool runs.")
 
 verbose_help = ("-"*43 + "\nEnable verbose mode. Prints additional information as the tool runs.")
 
 @click.command(help=command_help, context_settings=CONTEXT_SETTINGS, options_metavar='[options]')
 @click.option('--mode', '-m', type=click.Choice( ('configure', 'ping-only', 'ssh-check-only'), case_sensitive=False), default='configure', show_default=True, help=mode_help)
+@click.option('--exclude', '-x', multiple=True, metavar='<network>', help=exclude_help)
+@click.option('--ping-rate', type=click.IntRange(min=1), default=2000, show_default=True, metavar='<pps>', help=ping_rate_help)
+@click.option('--ping-attempts', type=click.IntRange(min=1), default=3, show_default=True, help=ping_attempts_help)
+@click.option('--inventory', type=click.Path(dir_okay=False), default=str(DEFAULT_INVENTORY_PATH), show_default=True, help=inventory_help)
+@click.option('--inventory-ttl', type=click.FloatRange(min=0), default=24, show_default=True, metavar='<hours>', help=inventory_ttl_help)
+@click.option('--refresh', is_flag=True, help=refresh_help)
+@click.option('--udp-discovery', is_flag=True, help=udp_discovery_help)
+@click.option('--snmp-screen', is_flag=True, help=snmp_screen_help)
 @click.option('--wds/--no-wds', default=True, show_default=True, help=wds_help)
 @click.option('--snmp/--no-snmp', default=True, show_default=True, help=snmp_help)
 @click.option('--ntp/--no-ntp', default=True, show_default=True, help=ntp_help)
 @click.option('--traffic-shaper-disable/--no-traffic-shaper-disable', '--ts/--no-ts', 'traffic_shaper', default=True, show_default=True, help=traffic_shaper_help)
 @click.option('--timezone/--no-timezone', '--tz/--no-tz', 'timezone_', default=True, show_default=True, help=timezone_help)
 @click.option('--ff-reporting-mode/--no-ff-reporting-mode', '--ffrm/--no-ffrm', default=True, show_default=True, help=ff_reporting_mode_help)
+@click.option('--canary-size', type=click.IntRange(min=0), default=5, show_default=True, help=canary_size_help)
+@click.option('--canary-threshold', type=click.FloatRange(0, 1), default=0.2, show_default=True, help=canary_threshold_help)
+@click.option('--workers', '-w', type=click.IntRange(min=1), default=1, show_default=True, help=workers_help)
+@click.option('--coordinate', metavar='<address>', help=coordinate_help)
+@click.option('--unit-size', type=click.IntRange(min=1), default=4, show_default=True, help=unit_size_help)
+@click.option('--token', envvar='FWB_CLEANUP_TOKEN', help=token_help)
+@click.option('--dry-run', '-n', is_flag=True, help=dry_run_help)
+@click.option('--trace', type=click.Path(dir_okay=False), metavar='<file>', help=trace_help)
+@click.option('--profile', type=click.Path(dir_okay=False), metavar='<file>', help=profile_help)
+@click.option('--profile-threshold', type=click.FloatRange(min=1), default=100, show_default=True, metavar='<ms>', help=profile_threshold_help)
+@click.option('--profile-sampler', is_flag=True, help=profile_sampler_help)
+@click.option('--journal', type=click.Path(dir_okay=False), metavar='<file>', help=journal_help)
+@click.option('--resume', type=click.Path(exists=True, dir_okay=False), metavar='<journal>', help=resume_help)
+@click.option('--results', '-r', multiple=True, type=click.Path(dir_okay=False, allow_dash=True), metavar='<file>', help=results_help)
 @click.option('--show-options', '-o', is_flag=True, help=show_options_help)
 @click.option('-v', '--verbose', is_flag=True, help=verbose_help)
-@click.argument('networks', nargs=-1, required=True, metavar='<*networks>')
-def run_from_cli(networks, mode, wds, snmp, ntp, traffic_shaper, timezone_, ff_reporting_mode, show_options, verbose):
-
-    options_nt = namedtuple('options', ('networks', 'mode', 'wds', 'snmp', 'ntp', 'traffic_shaper', 'timezone_', 
-                                            'ff_reporting_mode', 'verbose') )
-
-    cli_options = options_nt(networks, mode, wds, snmp, ntp, traffic_shaper, timezone_, 
-                                ff_reporting_mode, verbose) 
+@click.argument('networks', nargs=-1, metavar='<*networks>')
+def run_from_cli(networks, exclude, mode, ping_rate, ping_attempts, inventory, inventory_ttl, refresh, udp_discovery,
+                    snmp_screen, wds, snmp, ntp, traffic_shaper, timezone_, ff_reporting_mode, canary_size, canary_threshold, 
+                    workers, coordinate, unit_size, token, dry_run, trace, profile, profile_threshold,
+                    profile_sampler, journal, resume, results, show_options, verbose):
+
+    if not networks and not resume:
+        raise click.UsageError("Missing argument '<*networks>'.")
+
+    options_nt = namedtuple('options', ('networks', 'exclude', 'mode', 'ping_rate', 'ping_attempts', 'inventory', 
+                                            'inventory_ttl', 'refresh', 'udp_discovery', 'snmp_screen', 'wds', 'snmp', 'ntp', 'traffic_shaper', 
+                                            'timezone_', 'ff_reporting_mode', 'canary_size', 'canary_threshold', 
+                                            'workers', 'coordinate', 'unit_size', 'token', 'dry_run', 'trace', 
+                                            'profile', 'profile_threshold', 'profile_sampler', 'journal', 'resume', 'results', 'verbose') )
+
+    cli_options = options_nt(networks, exclude, mode, ping_rate, ping_attempts, inventory, inventory_ttl, refresh, 
+                                udp_discovery, snmp_screen, wds, snmp, ntp, traffic_shaper, timezone_, ff_reporting_mode, canary_size, canary_threshold, 
+                                workers, coordinate, unit_size, token, dry_run, trace, profile, profile_threshold, 
+                                profile_sampler, journal, resume, results, verbose) 
 
     if show_options:
         click.echo(cli_options, '\n')
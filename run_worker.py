@@ -0,0 +1,53 @@
+from device_cleanup import _configure_unit
+from cleanup_functions.coordinator import run_agent
+from discovery_functions.inventory import DeviceInventory, DEFAULT_INVENTORY_PATH
+from contextlib import closing
+import asyncio
+import click
+
+CONTEXT_SETTINGS = {'help_option_names':('-h', '--help')}
+
+command_help = ("Worker agent for a cleanup run started with --coordinate. Connects to the coordinator at <address> (<host:port> or unix:<path>), cleans up the work units it is handed from this host and streams the results back, until the coordinator has no more work.\n\n"
+                "The cleanup options come from the coordinator, the inventory and trace file are this host's own.\n\n"
+                "Example: \n\n"
+                "cleanup_worker.exe --token secret coordinator.example.net:7700")
+
+name_help = ("-"*43 + "\nName the coordinator shows for this worker. Defaults to the hostname.")
+
+token_help = ("-"*43 + "\nShared secret the coordinator was started with.")
+
+inventory_help = ("-"*43 + "\nSQLite file this worker keeps its device inventory in.")
+
+trace_help = ("-"*43 + "\nWrite this worker's timing spans to this file as JSON lines.")
+
+verbose_help = ("-"*43 + "\nEnable verbose mode. Prints additional information as the tool runs.")
+
+@click.command(help=command_help, context_settings=CONTEXT_SETTINGS, options_metavar='[options]')
+@click.option('--name', help=name_help)
+@click.option('--token', envvar='FWB_CLEANUP_TOKEN', help=token_help)
+@click.option('--inventory', type=click.Path(dir_okay=False), default=str(DEFAULT_INVENTORY_PATH), show_default=True, help=inventory_help)
+@click.option('--trace', type=click.Path(dir_okay=False), metavar='<file>', help=trace_help)
+@click.option('-v', '--verbose', is_flag=True, help=verbose_help)
+@click.argument('address', metavar='<address>')
+def run_worker(name, token, inventory, trace, verbose, address):
+
+    async def run_unit(unit_id, scopes, options, report):
+        click.echo(f"\nWork unit {unit_id}: {', '.join(scopes)}")
+        # this host's inventory, kept for as long as the coordinator's run wants it
+        device_inventory.ttl = options['inventory_ttl'] * 3600
+        device_inventory.refresh = options['refresh']
+        options = {**options, 'inventory': inventory, 'verbose': verbose or options['verbose']}
+        return await _configure_unit(options, scopes, device_inventory, trace, report)
+
+    async def agent():
+        await run_agent(address, run_unit, name, token)
+
+    with closing(DeviceInventory(inventory)) as device_inventory:
+        asyncio.run(agent())
+
+    click.echo('\nNo more work from the coordinator.')
+
+
+
+if __name__ == '__main__':
+    run_worker()
@@ -0,0 +1,117 @@
+from cleanup_functions.coordinator import Coordinator, _receive, _send, run_agent
+import asyncio
+
+
+UNITS = [['10.0.0.0/24'], ['10.0.1.0/24']]
+
+
+async def _finished(unit_id, scopes, options, report):
+    report('result', [scopes[0], 'compliant', None])
+    return {'unit': unit_id, 'scopes': scopes}
+
+
+async def _take_a_unit(address):
+    # a worker that says hello and waits for its first unit, then does what the test wants
+    reader, writer = await asyncio.open_unix_connection(address)
+    await _send(writer, 'hello', name='flaky')
+    unit = await _receive(reader, 5)
+    assert unit['type'] == 'unit'
+    return unit['unit_id'], reader, writer
+
+
+def _run(coordinator, address, flaky):
+    async def run():
+        serving = asyncio.ensure_future(coordinator.serve(f"unix:{address}"))
+        while not address.exists():
+            await asyncio.sleep(0.01)
+
+        taken, reader, writer = await _take_a_unit(str(address))
+        await flaky(writer)
+        await run_agent(f"unix:{address}", _finished, name='steady', heartbeat_interval=0.05)
+        writer.close()
+        return taken, await asyncio.wait_for(serving, 10)
+
+    return asyncio.run(run())
+
+
+def test_unit_goes_to_another_worker_after_a_disconnect(tmp_path):
+    results = []
+    coordinator = Coordinator(UNITS, {'mode': 'configure'}, heartbeat_timeout=5,
+                                on_result=lambda name, result: results.append( (name, result) ))
+
+    async def disconnect(writer):
+        writer.close()
+        await writer.wait_closed()
+
+    taken, payloads = _run(coordinator, tmp_path / 'c.sock', disconnect)
+
+    assert payloads == {0: {'unit': 0, 'scopes': UNITS[0]}, 1: {'unit': 1, 'scopes': UNITS[1]}}
+    assert coordinator.reassigned == 1
+    assert not coordinator.failed
+    assert coordinator._attempts[taken] == 2
+    assert sorted( (name, result[0]) for name, result in results ) == [('steady', x[0]) for x in UNITS]
+
+
+def test_unit_goes_to_another_worker_after_heartbeats_stop(tmp_path):
+    coordinator = Coordinator(UNITS, {'mode': 'configure'}, heartbeat_timeout=0.2)
+
+    async def go_quiet(writer):
+        # the connection stays up, nothing more is sent on it
+        await asyncio.sleep(0.3)
+
+    taken, payloads = _run(coordinator, tmp_path / 'c.sock', go_quiet)
+
+    assert sorted(payloads) == [0, 1]
+    assert coordinator.reassigned == 1
+    assert coordinator._attempts[taken] == 2
+
+
+def test_unit_fails_after_max_attempts(tmp_path):
+    coordinator = Coordinator(UNITS[:1], {'mode': 'configure'}, heartbeat_timeout=5, max_attempts=2)
+
+    async def broken(unit_id, scopes, options, report):
+        raise RuntimeError('no route to 10.0.0.0/24')
+
+    async def run():
+        address = tmp_path / 'c.sock'
+        serving = asyncio.ensure_future(coordinator.serve(f"unix:{address}"))
+        while not address.exists():
+            await asyncio.sleep(0.01)
+        await run_agent(f"unix:{address}", broken, heartbeat_interval=0.05)
+        return await asyncio.wait_for(serving, 10)
+
+    assert asyncio.run(run()) == {}
+    assert coordinator.reassigned == 1
+    assert 'no route' in coordinator.failed[0]
+
+
+def test_devices_of_a_reassigned_unit_are_reported_once(tmp_path):
+    results = []
+    coordinator = Coordinator(UNITS[:1], {'mode': 'configure'}, heartbeat_timeout=5,
+                                on_result=lambda name, result: results.append( (name, *result) ))
+
+    async def finish_one_then_disconnect(writer):
+        await _send(writer, 'result', result=['10.0.0.2', 'still_up', 31.5])
+        writer.close()
+        await writer.wait_closed()
+
+    async def run_again(unit_id, scopes, options, report):
+        # the radio the first worker restarted is compliant by now
+        report('result', ['10.0.0.2', 'compliant', None])
+        report('result', ['10.0.0.3', 'still_up', 29.0])
+        return {}
+
+    async def run():
+        address = tmp_path / 'c.sock'
+        serving = asyncio.ensure_future(coordinator.serve(f"unix:{address}"))
+        while not address.exists():
+            await asyncio.sleep(0.01)
+
+        _, _, writer = await _take_a_unit(str(address))
+        await finish_one_then_disconnect(writer)
+        await run_agent(f"unix:{address}", run_again, name='steady', heartbeat_interval=0.05)
+        return await asyncio.wait_for(serving, 10)
+
+    assert asyncio.run(run()) == {0: {}}
+    assert results == [('flaky', '10.0.0.2', 'still_up', 31.5), ('steady', '10.0.0.3', 'still_up', 29.0)]
+    assert not coordinator._reported
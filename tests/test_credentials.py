@@ -0,0 +1,57 @@
+from discovery_functions.credentials import CredentialStrategy, _credentials, login
+from discovery_functions.tracing import Tracer
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+import asyncio
+import asyncssh
+import pytest
+
+
+class _Pool:
+    # accepts `password` on every host and keeps the session once logged in, like SSHPool
+
+    def __init__(self, password):
+        self.password = password
+        self.tracer = Tracer()
+        self.open = set()
+
+
+    @asynccontextmanager
+    async def connection(self, ip, username, password, timeout=None):
+        if password != self.password:
+            raise asyncssh.misc.PermissionDenied('denied')
+        opened = ip not in self.open
+        self.open.add(ip)
+        yield SimpleNamespace(opened=opened)
+
+
+
+async def _log_in(pool, strategy, ip):
+    async with login(pool, ip, strategy) as (_, name):
+        return name
+
+
+def test_reused_sessions_are_not_counted_as_logins():
+    pool, strategy = _Pool(_credentials('primary')[1]), CredentialStrategy()
+
+    async def run():
+        for _ in range(3):
+            await _log_in(pool, strategy, '10.0.0.2')
+        await _log_in(pool, strategy, '10.0.0.3')
+
+    asyncio.run(run())
+    assert strategy.stats == (2, 0)
+
+
+def test_rejected_credentials_are_counted():
+    alternate = _credentials('alternate')[1]
+    if alternate == _credentials('primary')[1]:
+        pytest.skip('the primary and alternate passwords are the same here')
+    pool, strategy = _Pool(alternate), CredentialStrategy()
+
+    async def run():
+        return [await _log_in(pool, strategy, '10.0.0.2') for _ in range(2)]
+
+    # the second time the alternate password is tried first, on the session already open
+    assert asyncio.run(run()) == ['alternate', 'alternate']
+    assert strategy.stats == (1, 1)
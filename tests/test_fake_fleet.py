@@ -0,0 +1,251 @@
+from benchmarks.fake_fleet import FakeFleet, fleet_mix
+from discovery_functions.pipeline import run_pipeline
+from discovery_functions.icmp_sweep import ICMPSweeper
+from discovery_functions.ssh_pool import SSHPool
+from discovery_functions.credentials import CredentialStrategy
+from discovery_functions.ubnt_discovery import UBNTDiscovery
+from cleanup_functions.system_config import parse_system_cfg, render_system_cfg, write_system_cfg
+from discovery_functions.concurrency import AdaptiveLimiter
+from cleanup_functions.liveness_monitor import LivenessMonitor
+from cleanup_functions.restart_scheduler import RestartScheduler
+from discovery_functions.credentials import login
+from device_cleanup import _run_ssh_commands, _restart_device
+import asyncio, re
+import asyncssh, pytest
+
+
+# seed 7 builds 7 radios, 3 airFiber, 2 switches and 2 airCubes on it
+NETWORK = '127.41.0.0/28'
+MIX = fleet_mix(altpass=0.3, airfiber=0.15, switch=0.15, airrouter=0.2, ap=0.2, legacy=0.3, aircube=0.15)
+FLAGS = (True, True, True, True, True, True)
+NTP_SERVER = re.compile(r"[0-3]\.ubnt\.pool\.ntp\.org")
+
+# what the pipeline files each kind of device as
+CATEGORIES = {'radio': 'succeeded', 'airfiber': 'airfiber', 'switch': 'maybe_switch', 'aircube': 'maybe_switch'}
+
+
+def _run_fleet(test, **fleet_options):
+    # a small fleet on loopback, binding port 22 needs root
+    async def run():
+        fleet = FakeFleet(NETWORK, MIX, latency=0.002, jitter=0.2, seed=7, **fleet_options)
+        try:
+            await fleet.start()
+        except PermissionError:
+            await fleet.close()
+            pytest.skip('the emulated fleet needs root to bind port 22')
+        try:
+            return await test(fleet)
+        finally:
+            await fleet.close()
+
+    return asyncio.run(run())
+
+
+async def _identify(fleet, udp=None, device_worker=None, pool=None, credentials=None):
+    # ip -> (category, source) of every host the pipeline identified, and the summary
+    identified = {}
+    pool = pool or SSHPool()
+
+    def on_identify(category, item, reason=None, source=None):
+        identified[getattr(item, 'ip', item)] = (category, source)
+
+    try:
+        summary = await run_pipeline([fleet.network], False, pool, sweeper=ICMPSweeper(), udp=udp,
+                                        credentials=credentials or CredentialStrategy(), on_identify=on_identify,
+                                        device_worker=device_worker, echo=lambda *x: None)
+    finally:
+        await pool.close()
+        if udp:
+            udp.close()
+    return identified, summary
+
+
+def test_identify_over_ssh():
+    async def test(fleet):
+        identified, summary = await _identify(fleet)
+
+        # airCubes have no SSH, the rest are told apart by their login
+        expected = {ip: CATEGORIES[x.kind] for ip, x in fleet.radios.items() if x.kind != 'aircube'}
+        assert {ip: category for ip, (category, _) in identified.items()} == expected
+        assert {source for _, source in identified.values()} == {'ssh'}
+        assert summary.ssh_open == len(expected)
+
+        radios = {x.ip: x for x in summary.devices.devices()}
+        assert {ip for ip, x in fleet.radios.items() if x.kind == 'radio'} == set(radios)
+        for ip, device in radios.items():
+            radio = fleet.radios[ip]
+            assert device.is_airrouter == radio.is_airrouter
+            # AirRouters run the legacy firmware too
+            assert device.is_legacy == (radio.is_legacy or radio.is_airrouter)
+
+    _run_fleet(test)
+
+
+def test_identify_from_discovery_replies():
+    async def test(fleet):
+        identified, summary = await _identify(fleet, udp=UBNTDiscovery())
+
+        assert {ip: category for ip, (category, _) in identified.items()} == \
+                {ip: CATEGORIES[x.kind] for ip, x in fleet.radios.items()}
+        assert {source for _, source in identified.values()} == {'udp'}
+        # nothing was logged in to or had its port 22 checked
+        assert summary.ssh_open == 0
+        assert fleet.connections == 0
+
+    _run_fleet(test)
+
+
+def _configure_worker(pool, credentials, dry_run=False):
+    async def device_worker(device, limiter):
+        return await _run_ssh_commands(device, NTP_SERVER, FLAGS, False, pool, credentials, dry_run, limiter)
+    return device_worker
+
+
+async def _configure_pass(fleet, dry_run=False):
+    # the configure stage of a run, {ip: status} of every radio and the device records
+    pool, credentials = SSHPool(), CredentialStrategy()
+    _, summary = await _identify(fleet, device_worker=_configure_worker(pool, credentials, dry_run), pool=pool,
+                                    credentials=credentials)
+    return {x.ip: x for x in summary.results}, summary.devices.devices()
+
+
+async def _restart(devices):
+    # the restart waves of a run without the canary check, [restarted] of every device and the recoveries
+    pool, credentials, monitor = SSHPool(), CredentialStrategy(), LivenessMonitor(initial_delay=0)
+    limiter = AdaptiveLimiter('restart')
+    try:
+        restarted = await asyncio.gather(*(_restart_device(x, pool, credentials, limiter, monitor, None, FLAGS,
+                                                            NTP_SERVER) for x in devices))
+        return restarted, await monitor.wait()
+    finally:
+        await pool.close()
+        await monitor.close()
+
+
+def test_changes_are_only_written_with_the_restart():
+    async def test(fleet):
+        radios = [x for x in fleet.radios.values() if x.kind == 'radio']
+        untouched = {x.ip: x.saved_cfg for x in radios}
+
+        results, devices = await _configure_pass(fleet)
+        assert {ip: x.status for ip, x in results.items()} == dict.fromkeys(untouched, 'pending')
+        assert {x.ip: x.saved_cfg for x in radios} == untouched
+        assert all(x.running_cfg == x.saved_cfg for x in radios)
+
+        # the restart writes and saves the changes in its own session
+        restarted, recoveries = await _restart(devices)
+        assert all(restarted)
+        assert all(x.still_up for x in recoveries.values())
+        for radio in radios:
+            cfg = parse_system_cfg(radio.saved_cfg)
+            assert cfg['snmp.status'] == 'enabled'
+            assert cfg['tshaper.status'] == 'disabled'
+            assert radio.restarts == 1
+        # the rest of the gear is left alone
+        assert all(parse_system_cfg(x.saved_cfg)['snmp.status'] == 'disabled'
+                    for x in fleet.radios.values() if x.kind != 'radio')
+
+        results, _ = await _configure_pass(fleet)
+        assert {x.status for x in results.values()} == {'compliant'}
+
+    _run_fleet(test, reboot_time=0.2)
+
+
+def test_radios_of_an_aborted_canary_wave_are_changed_next_run():
+    async def test(fleet):
+        radios = [x for x in fleet.radios.values() if x.kind == 'radio']
+        untouched = {x.ip: x.saved_cfg for x in radios}
+        _, devices = await _configure_pass(fleet)
+
+        async def restart_times_out(device):
+            return False
+
+        scheduler = RestartScheduler(restart_times_out, LivenessMonitor(initial_delay=0), canary_size=2,
+                                        echo=lambda *x: None)
+        for device in devices:
+            scheduler.add(device, 'cpe')
+        restart_statuses = await scheduler.run()
+
+        assert scheduler.aborted
+        assert list(restart_statuses.values()).count('not_restarted') == len(radios) - 2
+        # nothing was written, so the next run still finds every radio needs its changes
+        assert {x.ip: x.saved_cfg for x in radios} == untouched
+        results, _ = await _configure_pass(fleet)
+        assert {ip: x.status for ip, x in results.items()} == dict.fromkeys(untouched, 'pending')
+        assert all(x.restarts == 0 for x in radios)
+
+    _run_fleet(test)
+
+
+async def _write(radio, text):
+    pool = SSHPool()
+    try:
+        async with login(pool, radio.ip, CredentialStrategy()) as (conn, _):
+            await write_system_cfg(conn, text)
+    finally:
+        await pool.close()
+
+
+def test_system_cfg_is_replaced_through_a_new_file():
+    async def test(fleet):
+        radio = next(x for x in fleet.radios.values() if x.kind == 'radio')
+        saved, text = radio.saved_cfg, render_system_cfg(radio.running_cfg, {'snmp.status': 'enabled'})
+
+        await _write(radio, text)
+        assert radio.running_cfg == text
+        assert radio.new_cfg is None
+        # only a save puts it in flash
+        assert radio.saved_cfg == saved
+
+    _run_fleet(test)
+
+
+def test_interrupted_write_leaves_system_cfg_whole():
+    async def test(fleet):
+        radio = next(x for x in fleet.radios.values() if x.kind == 'radio')
+        untouched, text = radio.running_cfg, render_system_cfg(radio.running_cfg, {'snmp.status': 'enabled'})
+        radio.interrupt_writes = True
+
+        with pytest.raises((asyncssh.Error, OSError)):
+            await _write(radio, text)
+        assert radio.running_cfg == untouched
+        assert radio.new_cfg == text[:len(text) // 2]
+
+        # a restart whose write is cut off saves and restarts nothing
+        _, devices = await _configure_pass(fleet)
+        device = next(x for x in devices if x.ip == radio.ip)
+        restarted, _ = await _restart([device])
+        assert restarted == [False]
+        assert radio.saved_cfg == radio.running_cfg == untouched
+        assert radio.restarts == 0
+
+        # the next one writes over what was left behind
+        radio.interrupt_writes = False
+        restarted, _ = await _restart([device])
+        assert restarted == [True]
+        assert radio.new_cfg is None
+        assert parse_system_cfg(radio.saved_cfg)['snmp.status'] == 'enabled'
+        assert radio.restarts == 1
+
+        results, _ = await _configure_pass(fleet)
+        assert results[radio.ip].status == 'compliant'
+        assert results[radio.ip].detail is None
+
+    _run_fleet(test, reboot_time=0.2)
+
+
+def test_dry_run_lists_the_changes_and_writes_nothing():
+    async def test(fleet):
+        radios = [x for x in fleet.radios.values() if x.kind == 'radio']
+        untouched = {x.ip: x.running_cfg for x in radios}
+
+        results, _ = await _configure_pass(fleet, dry_run=True)
+        assert {ip: x.status for ip, x in results.items()} == dict.fromkeys(untouched, 'dry_run')
+        for ip, result in results.items():
+            assert 'snmp.status: disabled -> enabled' in result.detail
+            assert 'tshaper.status: enabled -> disabled' in result.detail
+
+        assert all(x.running_cfg == x.saved_cfg == untouched[x.ip] and x.new_cfg is None for x in radios)
+        assert all(x.restarts == 0 for x in radios)
+
+    _run_fleet(test)
@@ -0,0 +1,7 @@
+from discovery_functions.find_alive_hosts import find_ssh_open
+import asyncio
+
+
+def test_nothing_valid_to_scan(capsys):
+    assert asyncio.run(find_ssh_open(['10.0.0.300', 'tower-7'], False)) == []
+    assert 'No valid IPv4 addresses' in capsys.readouterr().out
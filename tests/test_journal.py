@@ -0,0 +1,37 @@
+from cleanup_functions.journal import RunJournal, load_resume_plan
+
+
+DEVICE = (False, False, False, False, 0.01)
+
+
+def test_resume_plan(tmp_path):
+    path = tmp_path / 'run.jsonl'
+    journal = RunJournal(path)
+    journal.record('run', options={'networks': ['10.0.0.0/24']})
+    for i in range(2, 8):
+        journal.record('discovered', f"10.0.0.{i}", device=(f"10.0.0.{i}", *DEVICE))
+    journal.record('compliant', '10.0.0.2')
+    journal.record('pending', '10.0.0.3', role='cpe')
+    journal.record('pending', '10.0.0.4', role='ap')
+    journal.record('not_restarted', '10.0.0.4')
+    journal.record('pending', '10.0.0.5', role='cpe')
+    journal.record('restarted', '10.0.0.5')
+    journal.record('pending', '10.0.0.6', role='cpe')
+    journal.record('restarted', '10.0.0.6')
+    journal.record('verified', '10.0.0.6', still_up=True, time_to_recovery=42.0)
+    journal.record('not_radio', '10.0.0.8', category='airfiber')
+    journal.close()
+    # the line that was being written when the run died
+    with open(path, 'a') as f:
+        f.write('{"t": 1, "state": "pend')
+
+    plan = load_resume_plan(path)
+
+    assert plan.options == {'networks': ['10.0.0.0/24']}
+    assert not plan.discovery_complete
+    assert sorted(plan.finished) == [('10.0.0.2', 'compliant', None), ('10.0.0.6', 'still_up', 42.0)]
+    assert [(device.ip, role) for device, role in plan.restart] == [('10.0.0.3', 'cpe')]
+    assert [x.ip for x in plan.verify] == ['10.0.0.5']
+    # a radio left unchanged by an aborted canary wave is configured again, like one never reached
+    assert sorted(x.ip for x in plan.configure) == ['10.0.0.4', '10.0.0.7']
+    assert plan.non_radios == {'airfiber': ['10.0.0.8']}
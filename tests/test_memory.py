@@ -0,0 +1,69 @@
+from discovery_functions.pipeline import run_pipeline
+from discovery_functions.icmp_sweep import ICMPSweeper
+from discovery_functions.ssh_pool import SSHPool
+from discovery_functions.concurrency import AdaptiveLimiter
+from discovery_functions.ubnt_discovery import parse_reply, reply_to_result
+from discovery_functions.tracing import Tracer
+from test_ubnt_discovery import AIRFIBER_5X
+import asyncio, gc, tracemalloc
+import pytest
+
+
+class _Discovery:
+    # every other host answers discovery as an airFiber, the rest go on to the port 22 check,
+    # which nothing on these loopback addresses listens on
+
+    async def query(self, ip, timeouts):
+        await asyncio.sleep(0)
+        if int(ip.rsplit('.', 1)[1]) % 2 == 0:
+            return reply_to_result(ip, parse_reply(AIRFIBER_5X))
+
+
+    def close(self):
+        pass
+
+
+
+def _limiters():
+    return {name: AdaptiveLimiter(name, initial=8, max_limit=8, group_initial=8, group_max=8)
+                for name in ('port', 'ssh', 'configure')}
+
+
+def _peak_memory(network):
+    # the highest traced allocation of a whole pipeline run over `network`, and how many hosts it identified.
+    # the pings in flight and their retransmit timers come to rate * timeout, not the scope size
+    identified = []
+
+    async def run():
+        pool = SSHPool()
+        try:
+            await run_pipeline([network], False, pool, sweeper=ICMPSweeper(rate=4000, backlog=64),
+                                udp=_Discovery(), limiters=_limiters(), queue_size=16, tracer=Tracer(),
+                                retain=False, on_identify=lambda *x: identified.append(1), echo=lambda *x: None)
+        finally:
+            await pool.close()
+
+    # the refused port 22 connects leave reference cycles behind, collected often so they don't blur the peak
+    thresholds = gc.get_threshold()
+    gc.collect()
+    gc.set_threshold(100, 2, 2)
+    tracemalloc.start()
+    try:
+        asyncio.run(run())
+    except PermissionError:
+        pytest.skip('pinging needs an ICMP socket')
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        gc.set_threshold(*thresholds)
+    return peak, len(identified)
+
+
+def test_memory_does_not_grow_with_the_target_count():
+    small, small_identified = _peak_memory('127.64.0.0/23')
+    large, large_identified = _peak_memory('127.64.0.0/20')
+
+    # the even hosts of each /24, .2 to .254
+    assert (small_identified, large_identified) == (2 * 127, 16 * 127)
+    # eight times the hosts, about the same peak
+    assert large < small * 1.2
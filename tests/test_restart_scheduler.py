@@ -0,0 +1,66 @@
+from cleanup_functions.restart_scheduler import RestartScheduler
+from cleanup_functions.liveness_monitor import recovery
+from discovery_functions.device_table import valid_radio_namedtuple
+import asyncio
+
+
+class _Monitor:
+    # every radio restarted comes back unless it is in `down`
+
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.registered = []
+
+
+    async def wait(self):
+        return {ip: recovery(ip, ip not in self.down, None if ip in self.down else 1.0) for ip in self.registered}
+
+
+
+def _run(fail=(), down=(), canary_size=5, abort_threshold=0.2, cpes=10):
+    monitor = _Monitor(down)
+
+    async def restart_device(device):
+        if device.ip in fail:
+            return False
+        monitor.registered.append(device.ip)
+        return True
+
+    scheduler = RestartScheduler(restart_device, monitor, canary_size, abort_threshold, echo=lambda *x: None)
+    for i in range(cpes):
+        scheduler.add(valid_radio_namedtuple(f"10.0.{i}.10", False, False, False, False, None), 'cpe')
+    scheduler.add(valid_radio_namedtuple('10.0.0.2', False, False, False, False, None), 'ap')
+    return scheduler, asyncio.run(scheduler.run())
+
+
+def test_healthy_canaries_let_the_rest_restart():
+    scheduler, statuses = _run()
+    assert not scheduler.aborted
+    assert set(statuses.values()) == {'restarted'}
+
+
+def test_canary_that_stays_down_aborts():
+    scheduler, statuses = _run(down={'10.0.0.10', '10.0.1.10'})
+    assert scheduler.aborted
+    assert statuses['10.0.0.2'] == 'not_restarted'
+
+
+def test_failed_canary_restarts_count_toward_the_threshold():
+    # 2 of 5 canaries couldn't be restarted, the 3 that were came back
+    scheduler, statuses = _run(fail={'10.0.0.10', '10.0.1.10'})
+    assert scheduler.aborted
+    assert list(statuses.values()).count('restart_failed') == 2
+    assert list(statuses.values()).count('not_restarted') == 6
+
+
+def test_no_canary_restarted_aborts():
+    scheduler, statuses = _run(fail={f"10.0.{i}.10" for i in range(5)})
+    assert scheduler.aborted
+    assert 'restarted' not in statuses.values()
+
+
+def test_within_the_threshold():
+    # 1 of 5 is 20%, not over it
+    scheduler, statuses = _run(fail={'10.0.0.10'})
+    assert not scheduler.aborted
+    assert list(statuses.values()).count('restarted') == 10
@@ -0,0 +1,57 @@
+from discovery_functions.retry import RetryEngine, CircuitOpenError
+from discovery_functions.concurrency import AdaptiveLimiter
+from discovery_functions.device_table import valid_radio_namedtuple
+from discovery_functions.ssh_pool import SSHPool
+from device_cleanup import _run_ssh_commands
+import asyncio
+import pytest
+
+
+async def _trip(retry, ip):
+    # one radio that doesn't answer trips a threshold=1 breaker
+    with pytest.raises(asyncio.TimeoutError):
+        async with retry.guard(ip):
+            raise asyncio.TimeoutError()
+
+
+async def _call(retry, ip, order, name, fail=False):
+    try:
+        async with retry.guard(ip):
+            order.append(name)
+            await asyncio.sleep(0.05)
+            if fail:
+                raise asyncio.TimeoutError()
+    except (CircuitOpenError, asyncio.TimeoutError) as e:
+        order.append( (name, type(e).__name__) )
+
+
+def test_calls_wait_for_the_probe_answer():
+    async def run(probe_fails):
+        retry, order = RetryEngine(threshold=1, cooldown=0.05), []
+        await _trip(retry, '10.0.0.2')
+        await asyncio.sleep(0.07)
+        # the first call probes the group, the others wait for how it went
+        await asyncio.gather(_call(retry, '10.0.0.2', order, 'probe', probe_fails),
+                                *(_call(retry, f"10.0.0.{i}", order, i) for i in (3, 4)))
+        return order
+
+    assert asyncio.run(run(False)) == ['probe', 3, 4]
+    assert asyncio.run(run(True)) == ['probe', ('probe', 'TimeoutError'), (3, 'CircuitOpenError'),
+                                        (4, 'CircuitOpenError')]
+
+
+def test_radio_waiting_on_its_group_holds_no_configure_slot():
+    async def run():
+        retry, limiter, pool = RetryEngine(threshold=1, cooldown=30, defer=0.05), AdaptiveLimiter('configure'), SSHPool()
+        await _trip(retry, '10.0.0.2')
+        device = valid_radio_namedtuple('10.0.0.3', False, False, False, False, None)
+
+        configuring = asyncio.ensure_future(_run_ssh_commands(device, None, (True,) * 6, False, pool, None, False,
+                                                                limiter, retry))
+        await asyncio.sleep(0.02)
+        assert limiter.in_flight == 0
+        return await configuring, limiter.completed
+
+    result, completed = asyncio.run(run())
+    assert result.status == 'exception' and isinstance(result.detail, CircuitOpenError)
+    assert completed == 0
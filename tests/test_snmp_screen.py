@@ -0,0 +1,126 @@
+from discovery_functions.snmp_screen import (END_OF_MIB_VIEW, GET_BULK, RESPONSE, SYS_DESCR, SYS_NAME,
+                                                SYS_OBJECT_ID, UBNT, UBNT_AIRFIBER, UBNT_AIRMAX, classify,
+                                                encode_message, parse_message, screen_to_result)
+import pytest
+
+
+SYS_DESCR_0, SYS_OBJECT_ID_0, SYS_NAME_0 = SYS_DESCR + (0,), SYS_OBJECT_ID + (0,), SYS_NAME + (0,)
+
+
+def _response(varbinds, error_status=0):
+    return parse_message(encode_message('FWB', RESPONSE, 77, error_status, 0, varbinds))[5]
+
+
+def _with_value(message, old, new):
+    # swaps the encoding of one value for a type encode_message doesn't write, of the same length
+    assert message.count(old) == 1
+    return message.replace(old, new)
+
+
+def test_get_bulk_round_trip():
+    request = [(SYS_DESCR, None), (SYS_OBJECT_ID, None), (SYS_NAME, None), (UBNT, None)]
+    message = encode_message('FWB', GET_BULK, 0x7fffffff, 3, 4, request)
+
+    assert parse_message(message) == ('FWB', GET_BULK, 0x7fffffff, 3, 4, request)
+
+
+def test_response_round_trip():
+    varbinds = [(SYS_DESCR_0, b'Linux 2.6.32.71 #1 Tue Aug 17 2021 mips'),
+                (SYS_OBJECT_ID_0, (1, 3, 6, 1, 4, 1, 10002, 1)),
+                (SYS_NAME_0, b'TWR-North-AP3'),
+                (UBNT_AIRMAX + (1, 1, 2, 1), 2),
+                (UBNT_AIRMAX + (1, 1, 3, 1), 5820),
+                (UBNT_AIRMAX + (1, 1, 4, 1), -90),
+                (UBNT + (9, 9), END_OF_MIB_VIEW)]
+
+    community, pdu_type, request_id, error_status, error_index, parsed = parse_message(
+        encode_message('FWB', RESPONSE, 12345, 0, 0, varbinds))
+
+    assert (community, pdu_type, request_id, error_status, error_index) == ('FWB', RESPONSE, 12345, 0, 0)
+    assert parsed == varbinds
+    assert parsed[-1][1] is END_OF_MIB_VIEW
+
+
+def test_long_values_round_trip():
+    # over 127 bytes the length takes more than one byte
+    descr = b'EdgeSwitch 24-Port 500W, 1.9.3.5320343, Linux 3.6.5-f4a26ed5, 0.0.0.0000000 ' * 3
+    assert _response([(SYS_DESCR_0, descr)]) == [(SYS_DESCR_0, descr)]
+
+
+@pytest.mark.parametrize('tag', [0x80, 0x81])
+def test_no_such_object_and_instance(tag):
+    message = _with_value(encode_message('FWB', RESPONSE, 1, 0, 0, [(SYS_NAME, None)]), b'\x05\x00', bytes((tag, 0)))
+    assert parse_message(message)[5] == [(SYS_NAME, None)]
+
+
+def test_unsigned_and_address_values():
+    message = encode_message('FWB', RESPONSE, 1, 0, 0, [(UBNT_AIRMAX + (1,), b'\x0a\x14\x1e\x29')])
+    assert parse_message(_with_value(message, b'\x04\x04\x0a\x14\x1e\x29', b'\x40\x04\x0a\x14\x1e\x29'))[5] == \
+            [(UBNT_AIRMAX + (1,), '10.20.30.41')]
+    # a Counter32 with the top bit set reads as unsigned
+    assert parse_message(_with_value(message, b'\x04\x04\x0a\x14\x1e\x29', b'\x41\x04\xff\xff\xff\xfe'))[5] == \
+            [(UBNT_AIRMAX + (1,), 0xfffffffe)]
+
+
+def test_error_status_comes_back():
+    message = encode_message('FWB', RESPONSE, 9, 2, 1, [(SYS_DESCR, None)])
+    assert parse_message(message)[3:5] == (2, 1)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x30',
+    encode_message('FWB', RESPONSE, 1, 0, 0, [(SYS_NAME_0, b'TWR-North-AP3')])[:-4],
+    # the discovery reply from a radio
+    b'\x01\x00\x00\x09\x0b\x00\x06TWR-N1',
+    # SNMPv1
+    encode_message('FWB', RESPONSE, 1, 0, 0, [])[:4] + b'\x00' + encode_message('FWB', RESPONSE, 1, 0, 0, [])[5:],
+])
+def test_not_snmp(data):
+    with pytest.raises(ValueError):
+        parse_message(data)
+
+
+def test_classify_airmax_radio():
+    screened = classify('10.0.0.2', _response([(SYS_DESCR_0, b'Linux 2.6.32.71'),
+                                                (SYS_OBJECT_ID_0, (1, 3, 6, 1, 4, 1, 10002, 1)),
+                                                (SYS_NAME_0, b'TWR-North-AP3'),
+                                                (UBNT_AIRMAX + (1, 1, 2, 1), 2)]))
+    assert screened == ('10.0.0.2', 'radio', 'TWR-North-AP3')
+
+
+def test_classify_airfiber():
+    # by the MIB it answers from, or by its sysObjectID when the walk ends early
+    assert classify('10.0.0.3', _response([(UBNT_AIRFIBER + (1, 1, 2, 1), 1)])).category == 'airfiber'
+    assert classify('10.0.0.3', _response([(SYS_OBJECT_ID_0, UBNT_AIRFIBER + (1,)),
+                                            (UBNT + (9,), END_OF_MIB_VIEW)])).category == 'airfiber'
+
+
+def test_classify_switch():
+    assert classify('10.0.0.4', _response([(SYS_OBJECT_ID_0, (1, 3, 6, 1, 4, 1, 4413)),
+                                            (UBNT, END_OF_MIB_VIEW)])).category == 'switch'
+    router = _response([(SYS_DESCR_0, b'EdgeOS v2.0.9-hotfix.6'), (SYS_OBJECT_ID_0, (1, 3, 6, 1, 4, 1, 8072, 3, 2, 10))])
+    assert classify('10.0.0.5', router).category == 'switch'
+
+
+def test_classify_end_of_mib_view_and_no_such_object():
+    # a plain linux box whose walk runs off the end of its MIB, with no sysName set
+    message = _with_value(encode_message('FWB', RESPONSE, 1, 0, 0, [(SYS_DESCR_0, b'Linux 5.10'),
+                                                                        (SYS_NAME, None),
+                                                                        (UBNT, END_OF_MIB_VIEW),
+                                                                        (UBNT_AIRMAX, END_OF_MIB_VIEW)]),
+                            b'\x05\x00', b'\x80\x00')
+    screened = classify('10.0.0.6', parse_message(message)[5])
+    assert screened == ('10.0.0.6', 'unknown', None)
+
+
+def test_classify_no_answer():
+    assert classify('10.0.0.7', ()) == ('10.0.0.7', 'unknown', None)
+
+
+def test_screen_to_result():
+    result = screen_to_result(classify('10.0.0.3', _response([(SYS_NAME_0, b'BH-South-A'),
+                                                                (UBNT_AIRFIBER + (1, 1, 2, 1), 1)])))
+    assert result.can_ssh and not result.is_valid_radio
+    assert result.is_airfiber
+    assert result.device_name == 'BH-South-A'
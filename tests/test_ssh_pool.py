@@ -0,0 +1,119 @@
+from discovery_functions.ssh_pool import SSHPool
+from types import SimpleNamespace
+import asyncio
+import asyncssh
+import pytest
+
+
+class _Conn:
+
+    def __init__(self):
+        self.closed = False
+
+
+    def is_closed(self):
+        return self.closed
+
+
+    def close(self):
+        self.closed = True
+
+
+    async def wait_closed(self):
+        pass
+
+
+
+@pytest.fixture
+def handshakes(monkeypatch):
+    # the host of every asyncssh.connect, hosts in refused turn the connection down
+    made = SimpleNamespace(hosts=[], refused=set())
+
+    async def connect(host, **kwargs):
+        made.hosts.append(host)
+        await asyncio.sleep(0.01)
+        if host in made.refused:
+            raise ConnectionRefusedError(111, 'Connection refused')
+        return _Conn()
+
+    monkeypatch.setattr(asyncssh, 'connect', connect)
+    return made
+
+
+async def _use(pool, ip):
+    async with pool.connection(ip, 'ubnt', 'pw') as conn:
+        await asyncio.sleep(0.01)
+        return conn.opened
+
+
+def test_one_handshake_per_host_and_no_locks_left(handshakes):
+    async def run():
+        pool = SSHPool(idle_timeout=0)
+        opened = await asyncio.gather(*(_use(pool, f"10.0.0.{i % 4 + 2}") for i in range(20)))
+        assert not pool._locks
+        await pool.close()
+        return opened
+
+    opened = asyncio.run(run())
+    assert sorted(handshakes.hosts) == [f"10.0.0.{i}" for i in range(2, 6)]
+    assert opened.count(True) == 4
+
+
+def test_lock_is_dropped_after_a_failed_connect(handshakes):
+    handshakes.refused.add('10.0.0.9')
+
+    async def run():
+        pool = SSHPool(idle_timeout=0)
+        results = await asyncio.gather(*(_use(pool, '10.0.0.9') for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(x, ConnectionRefusedError) for x in results)
+        assert not pool._locks
+
+        # a discarded host gets a new lock, and a new connection, the next time
+        handshakes.refused.clear()
+        assert await _use(pool, '10.0.0.9')
+        pool.discard('10.0.0.9')
+        assert not pool._locks and not pool._conns
+        await pool.close()
+
+    asyncio.run(run())
+
+
+def test_full_pool_waits_for_a_connection_to_be_released(handshakes):
+    async def run():
+        pool = SSHPool(max_size=2, idle_timeout=0)
+        release, sizes = asyncio.Event(), []
+
+        async def hold(ip):
+            async with pool.connection(ip, 'ubnt', 'pw'):
+                sizes.append(len(pool._conns))
+                await release.wait()
+
+        holders = [asyncio.ensure_future(hold(f"10.0.0.{i}")) for i in (2, 3)]
+        await asyncio.sleep(0.05)
+        # both connections are in use, the third can't evict either of them
+        waiting = asyncio.ensure_future(_use(pool, '10.0.0.4'))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        assert handshakes.hosts == ['10.0.0.2', '10.0.0.3']
+
+        release.set()
+        await asyncio.gather(*holders)
+        assert await waiting
+        assert max(sizes) <= 2 and len(pool._conns) == 2
+        assert pool.stats.waits == 1 and pool.stats.evictions == 1
+        await pool.close()
+
+    asyncio.run(run())
+
+
+def test_failed_connect_gives_its_slot_back(handshakes):
+    handshakes.refused.add('10.0.0.9')
+
+    async def run():
+        pool = SSHPool(max_size=1, idle_timeout=0)
+        results = await asyncio.gather(_use(pool, '10.0.0.9'), _use(pool, '10.0.0.2'), return_exceptions=True)
+        assert isinstance(results[0], ConnectionRefusedError) and results[1] is True
+        assert pool.stats.waits == 1
+        await pool.close()
+
+    asyncio.run(run())
@@ -0,0 +1,145 @@
+from cleanup_functions.system_config import (SNMP_SETTINGS, TIMEZONE, parse_system_cfg, _ntp_changes, _snmp_changes,
+                                                compute_changes, render_system_cfg, describe_changes)
+from discovery_functions.device_table import valid_radio_namedtuple
+import re
+import pytest
+
+
+NTP_SERVER = re.compile(r"[0-3]\.ubnt\.pool\.ntp\.org")
+FLAGS = (True, True, True, True, True, True)
+
+# a radio that already matches every option
+COMPLIANT = '\n'.join([
+    'wireless.1.wds.status=enabled',
+    'radio.1.mode=managed',
+    'radio.1.ff_cap_rep=1',
+    f"system.timezone={TIMEZONE}",
+    'tshaper.status=disabled',
+    'ntpclient.status=enabled',
+    'ntpclient.1.status=enabled',
+    'ntpclient.1.server=2.ubnt.pool.ntp.org',
+    'snmp.status=enabled',
+    *(f"{key}={value}" for key, value in SNMP_SETTINGS.items()),
+    'wpasupplicant.profile.1.network.1.psk=s3cr=t==',
+]) + '\n'
+
+ROCKET = valid_radio_namedtuple('10.0.0.2', False, True, False, False)
+LEGACY_ROCKET = valid_radio_namedtuple('10.0.0.2', False, True, True, False)
+AIRROUTER = valid_radio_namedtuple('10.0.0.2', False, False, True, True)
+
+
+def _edit(text, **edits):
+    # the cfg with some keys set to new values, None drops the key
+    cfg = parse_system_cfg(text)
+    for key, value in edits.items():
+        key = key.replace('__', '.')
+        if value is None:
+            cfg.pop(key, None)
+        else:
+            cfg[key] = value
+    return cfg
+
+
+def _pooled(changes):
+    # the NTP server is picked at random from the pool, any of them will do
+    server = changes.get('ntpclient.1.server')
+    if server is not None and NTP_SERVER.fullmatch(server):
+        changes['ntpclient.1.server'] = 'pool'
+    return changes
+
+
+@pytest.mark.parametrize('cfg, device, flags, expected', [
+    (_edit(COMPLIANT), ROCKET, FLAGS, {}),
+    (_edit(COMPLIANT, wireless__1__wds__status='disabled'), ROCKET, FLAGS, {'wireless.1.wds.status': 'enabled'}),
+    (_edit(COMPLIANT), AIRROUTER, FLAGS, {'wireless.1.wds.status': 'disabled'}),
+    (_edit(COMPLIANT, radio__1__ff_cap_rep='0'), ROCKET, FLAGS, {'radio.1.ff_cap_rep': '1'}),
+    # only airMAX ac Rockets have the reporting mode
+    (_edit(COMPLIANT, radio__1__ff_cap_rep='0'), LEGACY_ROCKET, FLAGS, {}),
+    (_edit(COMPLIANT, system__timezone='GMT'), ROCKET, FLAGS, {'system.timezone': TIMEZONE}),
+    # a missing timezone is taken to be the default
+    (_edit(COMPLIANT, system__timezone=None), ROCKET, FLAGS, {}),
+    (_edit(COMPLIANT, tshaper__status='enabled'), ROCKET, FLAGS, {'tshaper.status': 'disabled'}),
+    (_edit(COMPLIANT, snmp__status=None), ROCKET, FLAGS, {'snmp.status': 'enabled'}),
+    (_edit(COMPLIANT, ntpclient__1__server='time.example.net'), ROCKET, FLAGS, {'ntpclient.1.server': 'pool'}),
+    # options that are turned off are left alone
+    (_edit(COMPLIANT, tshaper__status='enabled', snmp__status='disabled'), ROCKET, (True,) * 3 + (False,) * 3,
+        {'snmp.status': 'enabled'}),
+    (_edit(COMPLIANT, tshaper__status='enabled', snmp__status='disabled'), ROCKET, (False,) * 6, {}),
+])
+def test_compute_changes(cfg, device, flags, expected):
+    assert _pooled(compute_changes(cfg, device, flags, NTP_SERVER)) == expected
+
+
+@pytest.mark.parametrize('edits, expected', [
+    ({}, {}),
+    ({'ntpclient__status': 'disabled', 'ntpclient__1__status': 'disabled'},
+        {'ntpclient.status': 'enabled', 'ntpclient.1.status': 'enabled'}),
+    ({'ntpclient__1__server': 'pool.ntp.org'}, {'ntpclient.1.server': 'pool'}),
+    # with the section there but no server nothing is added
+    ({'ntpclient__1__server': None}, {}),
+    ({'ntpclient__status': None, 'ntpclient__1__status': None, 'ntpclient__1__server': None},
+        {'ntpclient.status': 'enabled', 'ntpclient.1.status': 'enabled', 'ntpclient.1.server': 'pool'}),
+])
+def test_ntp_changes(edits, expected):
+    assert _pooled(_ntp_changes(_edit(COMPLIANT, **edits), NTP_SERVER)) == expected
+
+
+@pytest.mark.parametrize('edits, expected', [
+    ({}, {}),
+    ({'snmp__status': 'disabled'}, {'snmp.status': 'enabled'}),
+    ({'snmp__community': 'public'}, {'snmp.community': SNMP_SETTINGS['snmp.community']}),
+    ({key.replace('.', '__'): None for key in ('snmp.status', *SNMP_SETTINGS)},
+        {'snmp.status': 'enabled', **SNMP_SETTINGS}),
+])
+def test_snmp_changes(edits, expected):
+    assert _snmp_changes(_edit(COMPLIANT, **edits)) == expected
+
+
+def test_values_keep_their_equals_signs():
+    cfg = parse_system_cfg('a.b=c=d\nnot a setting\ne.f=\n')
+    assert cfg == {'a.b': 'c=d', 'e.f': ''}
+
+
+@pytest.mark.parametrize('text, changes, expected', [
+    # edited in place, every other line kept where it was
+    ('snmp.status=disabled\nradio.1.mode=master\n', {'snmp.status': 'enabled'},
+        'snmp.status=enabled\nradio.1.mode=master\n'),
+    # a new key goes after the last line of its section
+    ('snmp.status=enabled\nsnmp.contact=x\nradio.1.mode=master\n', {'snmp.community': 'c'},
+        'snmp.status=enabled\nsnmp.contact=x\nsnmp.community=c\nradio.1.mode=master\n'),
+    # or at the end when the section is missing
+    ('radio.1.mode=master\n', {'snmp.status': 'enabled', 'snmp.community': 'c'},
+        'radio.1.mode=master\nsnmp.status=enabled\nsnmp.community=c\n'),
+    # values with '=' in them are written and kept whole
+    ('psk.1=a=b\nsnmp.community=x\n', {'snmp.community': 'c=d'}, 'psk.1=a=b\nsnmp.community=c=d\n'),
+    # lines that aren't settings stay, a missing last newline is added
+    ('# comment\nsnmp.status=disabled', {'snmp.status': 'enabled'}, '# comment\nsnmp.status=enabled\n'),
+    ('', {'snmp.status': 'enabled'}, 'snmp.status=enabled\n'),
+])
+def test_render_system_cfg(text, changes, expected):
+    assert render_system_cfg(text, changes) == expected
+
+
+def test_render_then_parse_has_every_change():
+    cfg = _edit(COMPLIANT, snmp__status=None, ntpclient__1__server='x', tshaper__status='enabled')
+    text = ''.join(f"{key}={value}\n" for key, value in cfg.items())
+    changes = compute_changes(cfg, ROCKET, FLAGS, NTP_SERVER)
+    rendered = parse_system_cfg(render_system_cfg(text, changes))
+
+    assert rendered == {**cfg, **changes}
+    # the keys that were there keep their order, the new one follows the rest of its section
+    keys = list(rendered)
+    assert [x for x in keys if x != 'snmp.status'] == list(cfg)
+    assert keys.index('snmp.status') == keys.index(list(SNMP_SETTINGS)[-1]) + 1
+    assert compute_changes(rendered, ROCKET, FLAGS, NTP_SERVER) == {}
+
+
+@pytest.mark.parametrize('cfg, changes, expected', [
+    ({}, {}, []),
+    ({'snmp.status': 'disabled'}, {'snmp.status': 'enabled', 'snmp.contact': 'noc'},
+        ['snmp.status: disabled -> enabled', 'snmp.contact: <missing> -> noc']),
+    ({'a.b': 'c=d'}, {'a.b': 'e=f'}, ['a.b: c=d -> e=f']),
+])
+def test_describe_changes(cfg, changes, expected):
+    # what a dry run prints for each radio
+    assert describe_changes(cfg, changes) == expected
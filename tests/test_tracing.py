@@ -0,0 +1,30 @@
+from discovery_functions.tracing import Tracer, _SAMPLE_SIZE
+import random
+
+
+def test_durations_stay_bounded_and_merge():
+    here, worker = Tracer(), Tracer()
+    for _ in range(20000):
+        here.add('login', None, random.uniform(0.1, 0.2))
+    for _ in range(500):
+        worker.add('login', None, random.uniform(10, 11))
+    for _ in range(5):
+        worker.add('restart', None, 0.002)
+
+    assert len(here.durations['login'][2]) == _SAMPLE_SIZE
+    here.merge(worker.durations)
+    histograms = here.histograms()
+
+    count, p50, p99, buckets = histograms['login']
+    assert count == sum(buckets) == 20500
+    assert len(here.durations['login'][2]) == _SAMPLE_SIZE
+    # 2.4% of the logins were the worker's slow ones
+    assert 0.1 <= p50 < 0.2 and 10 <= p99 < 11
+    assert histograms['restart'] == (5, 0.002, 0.002, [5, 0, 0, 0, 0, 0, 0, 0, 0])
+
+
+def test_nothing_kept_without_histograms():
+    tracer = Tracer(keep_durations=False)
+    with tracer.span('identify', '10.0.0.2'):
+        pass
+    assert tracer.histograms() == {}
@@ -0,0 +1,97 @@
+from discovery_functions.ubnt_discovery import _DiscoveryProtocol, parse_reply, reply_to_result
+import asyncio
+import pytest
+
+
+# replies as they come off the wire from a Rocket M5 on XW firmware and an airFiber 5X
+ROCKET_M5 = (b'\x01\x00\x00v\x02\x00\nx\x8a \xd4\xe1\xf2\n\x14\x1e)\x01\x00\x06x\x8a \xd4\xe1\xf2\n\x00\x04'
+                b'\x00\x01\xe2@\x03\x00"XW.ar934x.v6.3.6.33330.210818.1610\x0b\x00\rTWR-North-AP3\x0c\x00\t'
+                b'Rocket-M5\r\x00\tFWB-North\x14\x00\tRocket M5')
+AIRFIBER_5X = (b'\x01\x00\x00W\x02\x00\n\xf0\x9f\xc2\xa1\xb2\xc3\n\x14\x1f\x02\x01\x00\x06\xf0\x9f\xc2\xa1\xb2'
+                b'\xc3\x03\x00#AF5X.ar934x.v4.1.0.1234.200101.1200\x0b\x00\nBH-South-A\x0c\x00\x0bairFiber 5X')
+
+
+def test_rocket_reply():
+    result = reply_to_result('10.20.30.41', parse_reply(ROCKET_M5))
+
+    assert result.ip == '10.20.30.41'
+    assert result.can_ssh and not result.altpass
+    assert result.is_valid_radio
+    assert result.device_name == 'TWR-North-AP3'
+    assert result.firmware_version == 'XW.v6.3.6'
+    assert result.mac == '78:8A:20:D4:E1:F2'
+    assert result.is_rocket and not result.is_airrouter
+    assert result.is_legacy
+    assert not result.is_airfiber
+
+
+def test_airfiber_reply():
+    # no model TLV, the platform one names it
+    result = reply_to_result('10.20.31.2', parse_reply(AIRFIBER_5X))
+
+    assert not result.is_valid_radio
+    assert result.is_airfiber
+    assert result.device_name == 'BH-South-A'
+    assert result.firmware_version == 'AF5X.v4.1.0'
+    assert result.is_legacy is None
+
+
+def test_mac_from_mac_ip_field():
+    # older firmware only sends the MAC together with the IP
+    fields = parse_reply(ROCKET_M5)
+    del fields[0x01]
+    assert reply_to_result('10.20.30.41', fields).mac == '78:8A:20:D4:E1:F2'
+
+
+def test_truncated_reply_keeps_whole_fields():
+    # cut off in the middle of the firmware TLV
+    cut = ROCKET_M5.index(b'XW.ar934x') + 5
+    fields = parse_reply(ROCKET_M5[:cut])
+
+    assert fields[0x01] == bytes.fromhex('788a20d4e1f2')
+    assert 0x03 not in fields and 0x0b not in fields
+
+    result = reply_to_result('10.20.30.41', fields)
+    assert not result.is_valid_radio
+    assert result.firmware_version is None
+    assert result.device_name is None
+
+
+def test_length_past_the_end_of_the_datagram():
+    # the header says there is more than arrived, the fields that did arrive whole are kept
+    header_only = ROCKET_M5[:4]
+    assert parse_reply(header_only) == {}
+    assert parse_reply(ROCKET_M5 + b'\x00\x00') == parse_reply(ROCKET_M5)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x01\x00',
+    # version 2 discovery, as UniFi devices send it
+    b'\x02\x06\x00\x10\x02\x00\n\xf0\x9f\xc2\xa1\xb2\xc3\n\x14\x1f\x02',
+    # an SNMP response that landed on the socket
+    b'0\x1a\x02\x01\x01\x04\x03FWB\xa2\x10\x02\x01\x01\x02\x01\x00\x02\x01\x000\x00',
+    b'SSH-2.0-dropbear_2019.78\r\n',
+])
+def test_foreign_datagrams_are_rejected(data):
+    with pytest.raises(ValueError):
+        parse_reply(data)
+
+
+def test_protocol_waits_past_foreign_datagrams():
+    async def run():
+        future = asyncio.get_running_loop().create_future()
+        protocol = _DiscoveryProtocol({'10.20.30.41': future})
+
+        protocol.datagram_received(b'SSH-2.0-dropbear\r\n', ('10.20.30.41', 10001))
+        # a reply from a host nobody asked
+        protocol.datagram_received(AIRFIBER_5X, ('10.20.31.2', 10001))
+        assert not future.done()
+
+        protocol.datagram_received(ROCKET_M5, ('10.20.30.41', 10001))
+        # a second copy of the answer is dropped
+        protocol.datagram_received(AIRFIBER_5X, ('10.20.30.41', 10001))
+        return future.result()
+
+    fields = asyncio.run(run())
+    assert fields[0x0b] == b'TWR-North-AP3'
@@ -0,0 +1,38 @@
+from cleanup_functions.workers import WorkerError, run_workers
+import os, time
+import pytest
+
+
+def _shard(args, report):
+    # reports its radio as configured, then does what the test asked of it
+    n, then = args
+    report('result', [f"10.0.{n}.2", 'pending', 'cpe'])
+    if then == 'hangs':
+        time.sleep(60)
+    elif then == 'raises':
+        raise RuntimeError(f"lost the route to 10.0.{n}.0/24")
+    elif then == 'dies':
+        # gives the queue a moment to send the result, then goes like an OOM kill would
+        time.sleep(0.5)
+        os._exit(9)
+    return n
+
+
+def test_results_come_back_in_shard_order():
+    results = []
+    assert run_workers(_shard, [(i, None) for i in range(3)], on_result=results.append) == [0, 1, 2]
+    assert sorted(x[0] for x in results) == ['10.0.0.2', '10.0.1.2', '10.0.2.2']
+
+
+@pytest.mark.parametrize('then, error', [('raises', 'lost the route to 10.0.1.0/24'), ('dies', 'exited with code 9')])
+def test_a_shard_failing_mid_run_stops_the_rest(then, error):
+    results, started = [], time.monotonic()
+
+    with pytest.raises(WorkerError, match=error):
+        run_workers(_shard, [(0, 'hangs'), (1, then)], on_result=results.append)
+
+    # the hanging shard was terminated rather than waited for
+    assert time.monotonic() - started < 30
+    # the radios were only reported as pending, nothing was written before a restart wave ran
+    assert {x[1] for x in results} == {'pending'}
+    assert ['10.0.1.2', 'pending', 'cpe'] in results